@@ -0,0 +1,172 @@
+import os
+import re
+import time
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pbpy import pbconfig
+from pbpy import pblog
+from pbpy import pbtools
+
+# Engine archives are extracted with the 7-Zip command line tool, which decompresses with multiple threads.
+# Extraction of an archive runs while the next one downloads, e.g. the editor while its symbols are downloaded.
+sevenzip_names = ["7z", "7za", "7zz"]
+progress_pattern = re.compile(r"(\d+)%")
+# 7z l -slt describes the archive itself first, then every entry after a "----------" line
+listing_separator = "\n----------\n"
+path_pattern = re.compile(r"^Path = (.+?)\s*$", re.MULTILINE)
+size_pattern = re.compile(r"^Size = (\d+)\s*$", re.MULTILINE)
+progress_interval_seconds = 5
+engine_folder = "Engine"
+
+
+def get_7z_executable():
+    # The path can be set with [ue4v-user] sevenzip, otherwise 7-Zip is looked up in PATH and its default location
+    candidates = []
+    configured = pbconfig.get_user("ue4v-user", "sevenzip")
+    if configured:
+        candidates.append(configured)
+    candidates.extend(sevenzip_names)
+    if os.name == "nt":
+        candidates.append(os.path.join(os.environ.get("ProgramFiles", "C:\\Program Files"), "7-Zip", "7z.exe"))
+    for candidate in candidates:
+        executable = shutil.which(candidate)
+        if executable is not None:
+            return executable
+    return None
+
+
+def get_extract_threads():
+    return pbconfig.get_user_config().getint("ue4v-user", "extract_threads", fallback=os.cpu_count() or 1)
+
+
+def list_archive(sevenzip, archive_path):
+    # Paths of the entries and their unpacked size, or None if the archive can't be read
+    proc = pbtools.run_with_output([sevenzip, "l", "-slt", archive_path])
+    if proc.returncode != 0 or listing_separator not in proc.stdout:
+        return None
+    entries = proc.stdout.split(listing_separator, 1)[1]
+    paths = [path.replace("\\", "/") for path in path_pattern.findall(entries)]
+    return paths, sum(int(size) for size in size_pattern.findall(entries))
+
+
+def get_root_folder(paths):
+    # Engine archives are extracted into the install folder, so they have to contain Engine/ at their root, or in a
+    # single top-level folder, which is left out. Returns "" or the name of that folder, None for any other layout.
+    top_levels = {path.split("/", 1)[0] for path in paths}
+    if engine_folder in top_levels:
+        return ""
+    if len(top_levels) == 1:
+        root_folder = next(iter(top_levels))
+        if any(path.split("/")[1:2] == [engine_folder] for path in paths):
+            return root_folder
+    return None
+
+
+def move_tree(source, destination):
+    # Merge source into destination, e.g. symbols into an existing install
+    for dir_path, _, file_names in os.walk(source):
+        target_dir = os.path.join(destination, os.path.relpath(dir_path, source))
+        os.makedirs(target_dir, exist_ok=True)
+        for file_name in file_names:
+            os.replace(os.path.join(dir_path, file_name), os.path.join(target_dir, file_name))
+
+
+def log_progress(archive_name, percent, unpacked_size, elapsed):
+    if unpacked_size and elapsed > 0:
+        extracted = unpacked_size * percent / 100
+        pblog.info(f"Extracting {archive_name}: {percent}%, {extracted / (1000 * 1000):.0f}MB of {unpacked_size / (1000 * 1000):.0f}MB ({extracted / elapsed / (1000 * 1000):.1f}MB/s)")
+    else:
+        pblog.info(f"Extracting {archive_name}: {percent}%")
+
+
+def extract(archive_path, destination, sevenzip=None):
+    sevenzip = sevenzip or get_7z_executable()
+    if sevenzip is None:
+        pblog.error("7-Zip was not found")
+        return False
+    archive_name = os.path.basename(archive_path)
+    listing = list_archive(sevenzip, archive_path)
+    if listing is None:
+        pblog.error(f"Failed to read {archive_name}")
+        return False
+    paths, unpacked_size = listing
+    root_folder = get_root_folder(paths)
+    if root_folder is None:
+        top_levels = sorted({path.split("/", 1)[0] for path in paths})
+        pblog.error(f"{archive_name} has an unexpected layout, there is no {engine_folder} folder in {', '.join(top_levels[:10]) or 'the empty archive'}")
+        return False
+    # an archive with a top-level folder is extracted beside the install, then its contents are moved into it
+    output_path = f"{destination}.extracting" if root_folder else destination
+    if root_folder:
+        shutil.rmtree(output_path, ignore_errors=True)
+    threads = get_extract_threads()
+    pblog.info(f"Extracting {archive_name} ({unpacked_size / (1000 * 1000):.0f}MB) into {destination} with {threads} threads...")
+
+    start = time.perf_counter()
+    last_log = start
+
+    def on_output(chunk):
+        # progress is redrawn in place with backspaces, so it never ends with a line break
+        nonlocal last_log
+        matches = progress_pattern.findall(chunk)
+        now = time.perf_counter()
+        if matches and now - last_log >= progress_interval_seconds:
+            last_log = now
+            log_progress(archive_name, int(matches[-1]), unpacked_size, now - start)
+
+    # -bso0 hides the file list, -bsp1 writes progress to stdout
+    cmd = [sevenzip, "x", "-y", f"-mmt{threads}", "-bso0", "-bsp1", f"-o{output_path}", archive_path]
+    proc = pbtools.run_process(cmd, on_output=on_output)
+    if proc.returncode != 0:
+        pblog.error(f"Extraction of {archive_name} failed with {proc.returncode}")
+        pblog.error(progress_pattern.sub("", proc.stdout.replace("\b", "")).strip())
+        if root_folder:
+            shutil.rmtree(output_path, ignore_errors=True)
+        return False
+    if root_folder:
+        try:
+            move_tree(os.path.join(output_path, root_folder), destination)
+        except OSError as e:
+            pblog.error(f"Failed to move the contents of {archive_name} into {destination}: {e}")
+            return False
+        finally:
+            shutil.rmtree(output_path, ignore_errors=True)
+    elapsed = time.perf_counter() - start
+    throughput = unpacked_size / elapsed / (1000 * 1000) if elapsed > 0 else 0
+    pblog.info(f"Extracted {archive_name} in {elapsed:.1f}s ({throughput:.1f}MB/s)")
+    return True
+
+
+def download_and_extract(archives, destination, keep_archives=False):
+    # archives is a list of (archive path, download callable) pairs, downloaded in order. Every archive is extracted
+    # as soon as its download completes, while the next one is still downloading.
+    sevenzip = get_7z_executable()
+    if sevenzip is None:
+        pblog.error("7-Zip was not found")
+        return False
+
+    def extract_archive(archive_path):
+        if not extract(archive_path, destination, sevenzip):
+            # the next attempt extracts it again without downloading
+            pblog.error(f"Keeping {archive_path}, remove it if the download is corrupt")
+            return False
+        if not keep_archives:
+            pbtools.remove_file(archive_path)
+        return True
+
+    extractions = []
+    downloaded = True
+    # a single extraction at a time, 7-Zip already uses every core
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for archive_path, download in archives:
+            if not os.path.isfile(archive_path):
+                pblog.info(f"Downloading {os.path.basename(archive_path)}...")
+                if not download() or not os.path.isfile(archive_path):
+                    pblog.error(f"Failed to download {os.path.basename(archive_path)}")
+                    downloaded = False
+                    break
+            extractions.append(executor.submit(extract_archive, archive_path))
+        results = [extraction.result() for extraction in extractions]
+    return downloaded and all(results)
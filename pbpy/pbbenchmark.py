@@ -0,0 +1,194 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+
+from pbpy import pbconfig
+from pbpy import pblog
+from pbpy import pbtools
+from pbpy import pbgit
+from pbpy import pbstandin
+
+# Git LFS fetch benchmark against a local stand-in server. The link can be shaped to model a remote connection
+# with the [lfs] benchmark_latency_ms and benchmark_rate_mbps options of the user config.
+# Git status benchmark on a synthetic workspace, sized with [git] benchmark_files.
+benchmark_concurrency_levels = [1, 2, 4, 8, 16, 32]
+default_object_count = 64
+default_object_size_mb = 4
+default_latency_ms = 30
+# concurrency levels within this fraction of the best throughput are considered as good
+recommendation_tolerance = 0.05
+default_status_files = 100000
+status_files_per_directory = 500
+status_runs = 3
+
+
+def create_objects(objects_dir, count, size):
+    # Random LFS objects, as an oid -> size mapping
+    os.makedirs(objects_dir, exist_ok=True)
+    objects = {}
+    for _ in range(count):
+        data = os.urandom(size)
+        oid = hashlib.sha256(data).hexdigest()
+        with open(os.path.join(objects_dir, oid), "wb") as object_file:
+            object_file.write(data)
+        objects[oid] = size
+    return objects
+
+
+def create_repository(repo_path, remote_url, objects):
+    # A repository with a single commit of LFS pointers, which git lfs fetch can download again and again
+    git = pbgit.get_git_executable()
+    os.makedirs(repo_path)
+    if pbtools.run([git, "init", "-q", repo_path]).returncode != 0:
+        return False
+    for i, (oid, size) in enumerate(objects.items()):
+        with open(os.path.join(repo_path, f"object{i}.bin"), "w", newline="\n") as pointer_file:
+            pointer_file.write(f"version https://git-lfs.github.com/spec/v1\noid sha256:{oid}\nsize {size}\n")
+    commands = [
+        [git, "-C", repo_path, "remote", "add", "origin", remote_url],
+        [git, "-C", repo_path, "add", "."],
+        [git, "-C", repo_path, "-c", "user.name=PBSync", "-c", "user.email=pbsync@localhost", "commit", "-q", "-m", "LFS benchmark"]
+    ]
+    return all(pbtools.run(command).returncode == 0 for command in commands)
+
+
+def get_tuning_args(settings):
+    args = []
+    for key, value in settings.items():
+        args.extend(["-c", f"{key}={value}"])
+    return args
+
+
+def fetch(repo_path, concurrency, settings):
+    # Time a git lfs fetch of every object, starting from an empty local LFS store. The benchmark repository doesn't
+    # inherit the workspace config, so the transfer settings are passed on the command line.
+    shutil.rmtree(os.path.join(repo_path, ".git", "lfs"), ignore_errors=True)
+    settings = {**settings, "lfs.concurrenttransfers": concurrency}
+    start = time.perf_counter()
+    proc = pbtools.run_with_combined_output([pbgit.get_git_executable(), "-C", repo_path, *get_tuning_args(settings), "lfs", "fetch", "origin", "HEAD"])
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        pblog.error(proc.stdout)
+        return None
+    return elapsed
+
+
+def lfs_benchmark():
+    user_config = pbconfig.get_user_config()
+    count = user_config.getint("lfs", "benchmark_objects", fallback=default_object_count)
+    size = int(user_config.getfloat("lfs", "benchmark_object_size_mb", fallback=default_object_size_mb) * 1000 * 1000)
+    latency = user_config.getfloat("lfs", "benchmark_latency_ms", fallback=default_latency_ms) / 1000
+    rate_mbps = user_config.getfloat("lfs", "benchmark_rate_mbps", fallback=0)
+    connection_rate = int(rate_mbps * 1000 * 1000 / 8) if rate_mbps > 0 else None
+    # transfers use the tuned settings of the workspace, except for the concurrency which is benchmarked.
+    # fetchinclude/fetchexclude would filter the benchmark objects, so they are left out.
+    tuning = pbgit.get_lfs_tuning()
+    settings = {key: tuning[key] for key in ("lfs.transfer.batchSize", "lfs.transfer.maxretries") if key in tuning}
+    batch_size = user_config.get("lfs", "benchmark_batch_size", fallback=None)
+    if batch_size:
+        settings["lfs.transfer.batchSize"] = batch_size
+
+    total_size = count * size
+    pblog.info(f"Benchmarking Git LFS fetch of {count} objects ({total_size / (1000 * 1000):.1f}MB), with {latency * 1000:.0f}ms latency"
+               + (f" and {rate_mbps:.0f}Mbps per connection" if connection_rate else "")
+               + f", batch size {settings.get('lfs.transfer.batchSize', 'default')}")
+
+    root = tempfile.mkdtemp(prefix="pbsync_lfs_benchmark")
+    server = None
+    try:
+        objects = create_objects(os.path.join(root, "lfs", "objects"), count, size)
+        server = pbstandin.start_server(root, latency=latency, connection_rate=connection_rate)
+        repo_path = os.path.join(root, "repo")
+        if not create_repository(repo_path, f"{server.url}/benchmark.git", objects):
+            pblog.error("Failed to create the benchmark repository")
+            return False
+
+        results = {}
+        for concurrency in benchmark_concurrency_levels:
+            server.batch_sizes.clear()
+            elapsed = fetch(repo_path, concurrency, settings)
+            if elapsed is None:
+                pblog.error(f"Git LFS fetch failed with {concurrency} concurrent transfers")
+                return False
+            results[concurrency] = total_size / elapsed
+            pblog.info(f"{concurrency} concurrent transfers: {elapsed:.2f}s ({results[concurrency] / (1000 * 1000):.1f}MB/s), "
+                       f"{len(server.batch_sizes)} batch requests of up to {max(server.batch_sizes, default=0)} objects")
+    finally:
+        if server is not None:
+            pbstandin.stop_server(server)
+        shutil.rmtree(root, ignore_errors=True)
+
+    # more transfers cost connections and memory, so prefer the lowest level that is about as fast as the best one
+    best = max(results.values())
+    recommended = min(concurrency for concurrency, throughput in results.items() if throughput >= best * (1 - recommendation_tolerance))
+    current = pbgit.get_lfs_tuning().get("lfs.concurrenttransfers", "default")
+    pblog.info(f"Recommended setting: concurrenttransfers = {recommended} in the [lfs] section of {pbconfig.get_user_config_filename()} (current: {current})")
+    return True
+
+
+def create_workspace(repo_path, file_count):
+    git = pbgit.get_git_executable()
+    if pbtools.run([git, "init", "-q", repo_path]).returncode != 0:
+        return False
+    for i in range(file_count):
+        directory = os.path.join(repo_path, f"dir{i // status_files_per_directory}")
+        if i % status_files_per_directory == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f"file{i}.txt"), "w") as workspace_file:
+            workspace_file.write(str(i))
+    commands = [
+        [git, "-C", repo_path, "add", "."],
+        [git, "-C", repo_path, "-c", "user.name=PBSync", "-c", "user.email=pbsync@localhost", "commit", "-q", "-m", "Status benchmark"]
+    ]
+    return all(pbtools.run_with_output(command).returncode == 0 for command in commands)
+
+
+def time_status(repo_path, fsmonitor, untracked_cache):
+    # Best of a few warm runs, like the repeated status calls of a sync
+    cmd = [pbgit.get_git_executable(), "-C", repo_path, "-c", f"core.fsmonitor={str(fsmonitor).lower()}", "-c", f"core.untrackedcache={str(untracked_cache).lower()}", "status", "--porcelain=v2"]
+    timings = []
+    for _ in range(status_runs + 1):
+        start = time.perf_counter()
+        if pbtools.run_with_output(cmd).returncode != 0:
+            return None
+        timings.append(time.perf_counter() - start)
+    # the first run fills the caches
+    return min(timings[1:])
+
+
+def status_benchmark():
+    file_count = pbconfig.get_user_config().getint("git", "benchmark_files", fallback=default_status_files)
+    pblog.info(f"Benchmarking git status in a workspace of {file_count} files...")
+
+    root = tempfile.mkdtemp(prefix="pbsync_status_benchmark")
+    repo_path = os.path.join(root, "repo")
+    fsmonitor_supported = pbgit.is_fsmonitor_supported()
+    try:
+        if not create_workspace(repo_path, file_count):
+            pblog.error("Failed to create the benchmark workspace")
+            return False
+        configurations = [("no caches", False, False), ("untracked cache", False, True)]
+        if fsmonitor_supported:
+            configurations.append(("file system monitor and untracked cache", True, True))
+        else:
+            pblog.info("The file system monitor is not supported on this platform")
+        results = {}
+        for name, fsmonitor, untracked_cache in configurations:
+            elapsed = time_status(repo_path, fsmonitor, untracked_cache)
+            if elapsed is None:
+                pblog.error(f"git status failed with {name}")
+                return False
+            results[name] = elapsed
+            pblog.info(f"git status with {name}: {elapsed:.3f}s")
+    finally:
+        if fsmonitor_supported:
+            pbtools.run_with_output([pbgit.get_git_executable(), "-C", repo_path, "fsmonitor--daemon", "stop"])
+        shutil.rmtree(root, ignore_errors=True)
+
+    baseline = results["no caches"]
+    best_name = min(results, key=results.get)
+    if results[best_name] > 0:
+        pblog.info(f"Fastest configuration is {best_name}, {baseline / results[best_name]:.1f}x faster than no caches")
+    return True
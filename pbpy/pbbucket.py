@@ -0,0 +1,137 @@
+import os
+import json
+import shutil
+import configparser
+
+from urllib.parse import urlparse, unquote, quote
+
+from pbpy import pbconfig
+from pbpy import pblog
+from pbpy import pbhttp
+from pbpy import pbtools
+
+# Engine builds are read from a bucket over HTTP(S), like ue4versionator does, or from a local directory
+# (e.g. a mirror on a file share, or a test bucket). Object names always use forward slashes.
+# Listing also works with gs:// URIs, through gsutil.
+stream_size_limit = 64 * 1024 * 1024
+
+
+def get_versionator_baseurl(fallback=None):
+    ue4v_config = configparser.ConfigParser()
+    ue4v_config.read(".ue4versionator")
+    return ue4v_config.get("ue4versionator", "baseurl", fallback=fallback)
+
+
+def get_bucket_url():
+    # The bucket can be overridden in the user config, e.g. to use a local mirror
+    return pbconfig.get_user("ue4v-user", "bucket") or get_versionator_baseurl()
+
+
+def is_remote(bucket_url):
+    return urlparse(bucket_url).scheme in ("http", "https")
+
+
+def get_local_root(bucket_url):
+    parsed = urlparse(bucket_url)
+    if parsed.scheme == "file":
+        return unquote(parsed.path)
+    return bucket_url
+
+
+def is_supported(bucket_url):
+    # gs:// and other schemes are only reachable through gsutil
+    return bucket_url is not None and (is_remote(bucket_url) or os.path.isdir(get_local_root(bucket_url)))
+
+
+def is_gcs(bucket_url):
+    return bucket_url.startswith("gs://")
+
+
+def list_objects(bucket_url, prefix):
+    # Names of the objects which start with prefix, or None if the bucket can't be listed.
+    # gs:// buckets are listed with gsutil, plain HTTP(S) buckets have no listing.
+    if is_gcs(bucket_url):
+        proc = pbtools.run_with_output(["gsutil", "ls", f"{bucket_url.rstrip('/')}/{prefix}*"])
+        if proc.returncode != 0:
+            if "matched no objects" in proc.stderr:
+                return []
+            pblog.error(proc.stderr.strip())
+            return None
+        return [line.strip().rsplit("/", 1)[-1] for line in proc.stdout.splitlines() if line.strip()]
+    if is_remote(bucket_url):
+        return None
+    try:
+        return [name for name in os.listdir(get_local_root(bucket_url)) if name.startswith(prefix)]
+    except OSError as e:
+        pblog.error(str(e))
+        return None
+
+
+def get_listing_token(bucket_url):
+    # A value which changes whenever objects are added or removed, if the bucket can tell that cheaply.
+    # Only directories can, through their modification time.
+    if is_gcs(bucket_url) or is_remote(bucket_url):
+        return None
+    try:
+        return os.stat(get_local_root(bucket_url)).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_object_url(bucket_url, name):
+    return f"{bucket_url.rstrip('/')}/{quote(name)}"
+
+
+def get_local_object_path(bucket_url, name):
+    return os.path.join(get_local_root(bucket_url), *name.split("/"))
+
+
+def read_json(bucket_url, name):
+    # Returns None if the object does not exist
+    try:
+        if is_remote(bucket_url):
+            status, data = pbhttp.get_json(get_object_url(bucket_url, name))
+            return data if status == 200 else None
+        with open(get_local_object_path(bucket_url, name)) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        pblog.exception(str(e))
+        return None
+
+
+def get_size(bucket_url, name):
+    # Size of an object, or None if it is unknown
+    try:
+        if is_remote(bucket_url):
+            _, size, _ = pbhttp.resolve_download(get_object_url(bucket_url, name))
+            return size
+        return os.path.getsize(get_local_object_path(bucket_url, name))
+    except Exception as e:
+        pblog.debug(f"Could not get the size of {name}: {e}")
+        return None
+
+
+def download(bucket_url, name, file_path, size=None):
+    # Download an object into file_path. The file only appears once it is complete.
+    # Objects of unknown size are treated as large ones.
+    part_path = f"{file_path}.part"
+    try:
+        if is_remote(bucket_url):
+            url = get_object_url(bucket_url, name)
+            if size is None or size >= stream_size_limit:
+                # large objects are split into parallel range requests, and resumed if interrupted
+                if not pbhttp.download_file(url, file_path, resume_key=name):
+                    return False
+                return True
+            pbhttp.download_stream(url, part_path)
+        else:
+            shutil.copyfile(get_local_object_path(bucket_url, name), part_path)
+        os.replace(part_path, file_path)
+        return True
+    except Exception as e:
+        pblog.exception(str(e))
+        if os.path.exists(part_path):
+            pbtools.remove_file(part_path)
+        return False
@@ -0,0 +1,430 @@
+import os
+import re
+import json
+import time
+import shutil
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from pbpy import pblog
+from pbpy import pbtools
+from pbpy import pbbucket
+from pbpy import pbstore
+from pbpy import pbunreal
+
+# Incremental engine sync. Every engine archive <bundle>-<version>.7z has a manifest <bundle>-<version>.manifest.json
+# beside it, which maps each relative file path to its MD5 and size. File contents are stored once in the bucket,
+# under objects/<first two characters of the MD5>/<MD5>, and shared by every bundle and version.
+manifest_suffix = ".manifest.json"
+objects_prefix = "objects"
+# written into an install once it is complete, so later syncs know what it contains
+local_manifest_name = ".pbsync_manifest.json"
+# touched whenever an install is used, to evict the least recently used installs first
+last_used_name = ".pbsync_last_used"
+# kept free on top of the planned size, for logs, caches and the file system itself
+required_space_margin = 1000 * 1000 * 1000
+sync_max_workers = 16
+# files which are too small to be worth a hardlink, and files an install may change locally, are never deduplicated
+dedup_min_size = 64 * 1024
+dedup_excluded_dirs = {"Saved", "Intermediate", "DerivedDataCache"}
+dedup_excluded_extensions = {".ini"}
+
+
+def get_manifest_name(bundle, version):
+    return f"{bundle}-{version}{manifest_suffix}"
+
+
+def get_object_name(file_hash):
+    return f"{objects_prefix}/{file_hash[:2]}/{file_hash}"
+
+
+def is_safe_path(relative_path):
+    parts = relative_path.split("/")
+    return not relative_path.startswith("/") and ":" not in relative_path and ".." not in parts and "" not in parts
+
+
+def get_manifest(bucket_url, bundle, version):
+    manifest = pbbucket.read_json(bucket_url, get_manifest_name(bundle, version))
+    if manifest is None:
+        return None
+    files = manifest.get("files", {})
+    unsafe = [path for path in files if not is_safe_path(path)]
+    if unsafe:
+        pblog.error(f"Engine manifest of {bundle}-{version} contains invalid paths, like {unsafe[0]}")
+        return None
+    return files
+
+
+def read_local_manifest(install_dir):
+    try:
+        with open(os.path.join(install_dir, local_manifest_name)) as manifest_file:
+            return json.load(manifest_file).get("files", {})
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        pblog.warning(f"Discarding engine manifest of {install_dir}: {e}")
+        return None
+
+
+def write_local_manifest(install_dir, files, removed=()):
+    manifest_path = os.path.join(install_dir, local_manifest_name)
+    # other bundles may already be installed in the same directory
+    installed = read_local_manifest(install_dir) or {}
+    for relative_path in removed:
+        installed.pop(relative_path, None)
+    for relative_path, entry in files.items():
+        # the modification time tells later syncs whether the file is still the one which was installed
+        try:
+            mtime = os.stat(os.path.join(install_dir, *relative_path.split("/"))).st_mtime_ns
+        except OSError:
+            continue
+        installed[relative_path] = {"md5": entry["md5"], "size": entry["size"], "mtime": mtime}
+        if "bundle" in entry:
+            installed[relative_path]["bundle"] = entry["bundle"]
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, "w") as manifest_file:
+        json.dump({"files": installed}, manifest_file, separators=(",", ":"))
+    os.replace(temp_path, manifest_path)
+
+
+def find_installs(root, exclude=None):
+    # Engine installs under root, newest first
+    pattern = re.compile(pbunreal.engine_installation_folder_regex)
+    try:
+        folders = os.listdir(root)
+    except OSError:
+        return []
+    installs = [folder for folder in folders if folder != exclude and pattern.match(folder) and os.path.isdir(os.path.join(root, folder))]
+    return [os.path.join(root, folder) for folder in sorted(installs, reverse=True)]
+
+
+def is_installed(file_path, installed_entry):
+    # Whether the file is unchanged since it was recorded in a local manifest, without reading it
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return False
+    return file_stat.st_size == installed_entry["size"] and file_stat.st_mtime_ns == installed_entry.get("mtime")
+
+
+def has_file(file_path, entry, installed_entry=None):
+    if installed_entry is not None and installed_entry["md5"].upper() == entry["md5"].upper() and is_installed(file_path, installed_entry):
+        return True
+    try:
+        if os.path.getsize(file_path) != entry["size"]:
+            return False
+    except OSError:
+        return False
+    file_hash = pbtools.get_md5_hash(file_path)
+    return file_hash is not None and file_hash.upper() == entry["md5"].upper()
+
+
+def get_install_index(installs):
+    # MD5 -> (file path, installed entry) list of the files recorded in the local manifests of the installs, and the
+    # installs without a local manifest, which can only be searched by path
+    index = defaultdict(list)
+    unindexed = []
+    for install in installs:
+        installed = read_local_manifest(install)
+        if installed is None:
+            unindexed.append(install)
+            continue
+        for relative_path, installed_entry in installed.items():
+            index[installed_entry["md5"].upper()].append((os.path.join(install, *relative_path.split("/")), installed_entry))
+    return index, unindexed
+
+
+def find_local_copy(relative_path, entry, install_index):
+    # A file of the installs with the same content, found by diffing the manifests first, e.g. even after a move
+    index, unindexed = install_index
+    candidates = index.get(entry["md5"].upper(), [])
+    for file_path, installed_entry in candidates:
+        if is_installed(file_path, installed_entry):
+            return file_path
+    # recorded files which were touched since, e.g. by deduplication, are checked against their content
+    for file_path, installed_entry in candidates:
+        if has_file(file_path, entry):
+            return file_path
+    for install in unindexed:
+        file_path = os.path.join(install, *relative_path.split("/"))
+        if has_file(file_path, entry):
+            return file_path
+    return None
+
+
+def get_manifest_files(bucket_url, bundles, version):
+    files = {}
+    for bundle in bundles:
+        manifest = get_manifest(bucket_url, bundle, version)
+        if manifest is None:
+            pblog.info(f"No engine manifest found for {bundle}-{version}")
+            return None
+        # the bundle is recorded in the local manifest, so files a bundle dropped can be removed by its next sync
+        files.update({relative_path: {**entry, "bundle": bundle} for relative_path, entry in manifest.items()})
+    return files
+
+
+def sync_engine(bucket_url, root, version, bundles):
+    # Bring root/version up to date with the manifests of the given bundles, e.g. the editor and its symbols.
+    # Returns None if the bucket has no manifest for them, so the archives have to be used instead.
+    if not pbbucket.is_supported(bucket_url):
+        return None
+    files = get_manifest_files(bucket_url, bundles, version)
+    if files is None:
+        return None
+
+    pbtools.add_hash_cache_root(root)
+    install_dir = os.path.join(root, version)
+    previous_installs = find_installs(root, version)
+    if previous_installs:
+        pblog.info(f"Reusing unchanged files of {', '.join(os.path.basename(install) for install in previous_installs)}")
+    total_size = sum(entry["size"] for entry in files.values())
+    pblog.info(f"Synchronizing {len(files)} engine files ({total_size / (1000 * 1000 * 1000):.1f}GB) into {install_dir}...")
+
+    start = time.perf_counter()
+    counts = {"kept": 0, "linked": 0, "copied": 0, "downloaded": 0, "failed": 0}
+    downloaded_bytes = 0
+    # files recorded by an earlier sync of this install are only hashed if they changed since
+    installed = read_local_manifest(install_dir) or {}
+    previous_index = get_install_index(previous_installs)
+
+    def sync_file(relative_path):
+        entry = files[relative_path]
+        file_path = os.path.join(install_dir, *relative_path.split("/"))
+        if has_file(file_path, entry, installed.get(relative_path)):
+            return "kept"
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        previous_path = find_local_copy(relative_path, entry, previous_index)
+        if previous_path is not None:
+            if is_link_excluded(relative_path):
+                pbstore.copy_file(previous_path, file_path)
+                return "copied"
+            return "linked" if pbstore.link_file(previous_path, file_path) else "copied"
+        if not pbbucket.download(bucket_url, get_object_name(entry["md5"]), file_path, entry["size"]):
+            return "failed"
+        if not has_file(file_path, entry):
+            pblog.error(f"Downloaded engine file {relative_path} is corrupted")
+            pbtools.remove_file(file_path)
+            return "failed"
+        return "downloaded"
+
+    with ThreadPoolExecutor(max_workers=sync_max_workers) as executor:
+        for relative_path, result in zip(files, executor.map(sync_file, files)):
+            counts[result] += 1
+            if result == "downloaded":
+                downloaded_bytes += files[relative_path]["size"]
+    pbtools.save_hash_cache()
+
+    elapsed = time.perf_counter() - start
+    pblog.info(f"Engine sync finished in {elapsed:.1f}s: {counts['kept']} files up to date, {counts['linked']} linked, {counts['copied']} copied, "
+               f"{counts['downloaded']} downloaded ({downloaded_bytes / (1000 * 1000):.1f}MB), {counts['failed']} failed")
+    if counts["failed"]:
+        return False
+
+    # files an earlier sync of the same bundles installed, which are not in their manifests anymore
+    stale = [relative_path for relative_path, installed_entry in installed.items() if relative_path not in files and installed_entry.get("bundle") in bundles]
+    for relative_path in stale:
+        file_path = os.path.join(install_dir, *relative_path.split("/"))
+        if os.path.lexists(file_path):
+            pbtools.remove_file(file_path)
+    if stale:
+        pblog.info(f"Removed {len(stale)} engine files which are not part of {version} anymore")
+    write_local_manifest(install_dir, files, stale)
+    return True
+
+
+def is_link_excluded(relative_path):
+    # files an install may change locally are never shared with other installs
+    parts = relative_path.replace("\\", "/").split("/")
+    return os.path.splitext(parts[-1])[1].lower() in dedup_excluded_extensions or any(part in dedup_excluded_dirs for part in parts[:-1])
+
+
+def is_dedup_candidate(relative_path, file_stat):
+    return file_stat.st_size >= dedup_min_size and not is_link_excluded(relative_path)
+
+
+def get_dedup_candidates(installs):
+    # Regular files of every install, grouped by size. Sizes which only occur once can't have duplicates.
+    by_size = defaultdict(list)
+    for install in installs:
+        for directory, dirs, file_names in os.walk(install):
+            dirs[:] = [name for name in dirs if name not in dedup_excluded_dirs]
+            for file_name in file_names:
+                file_path = os.path.join(directory, file_name)
+                try:
+                    file_stat = os.lstat(file_path)
+                except OSError:
+                    continue
+                if os.path.isfile(file_path) and not os.path.islink(file_path) and is_dedup_candidate(os.path.relpath(file_path, install), file_stat):
+                    by_size[file_stat.st_size].append((file_path, file_stat))
+    # files which are already linked to each other only count once
+    return [files for files in by_size.values() if len({(st.st_dev, st.st_ino) for _, st in files}) > 1]
+
+
+def dedup_installs(root):
+    # Replace identical files of different engine installs with hardlinks to a single copy
+    installs = find_installs(root)
+    if len(installs) < 2:
+        return 0
+    start = time.perf_counter()
+    pblog.info(f"Deduplicating {len(installs)} engine installs in {root}...")
+    pbtools.add_hash_cache_root(root)
+    groups = get_dedup_candidates(installs)
+
+    def hash_group(files):
+        by_hash = defaultdict(list)
+        hashes = {}
+        for file_path, file_stat in files:
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            if inode not in hashes:
+                hashes[inode] = pbtools.get_md5_hash(file_path)
+            if hashes[inode] is not None:
+                by_hash[hashes[inode]].append((file_path, file_stat))
+        return list(by_hash.values())
+
+    saved = 0
+    linked = 0
+    with ThreadPoolExecutor(max_workers=pbtools.hash_max_workers) as executor:
+        for duplicates_by_hash in executor.map(hash_group, groups):
+            for duplicates in duplicates_by_hash:
+                source_path, source_stat = duplicates[0]
+                for file_path, file_stat in duplicates[1:]:
+                    if (file_stat.st_dev, file_stat.st_ino) == (source_stat.st_dev, source_stat.st_ino) or file_stat.st_dev != source_stat.st_dev:
+                        continue
+                    try:
+                        # a copy would free nothing, so files which can't be linked are left as they are
+                        pbstore.link_file(source_path, file_path, copy_fallback=False)
+                    except Exception as e:
+                        pblog.warning(f"Could not deduplicate {file_path}: {e}")
+                        continue
+                    linked += 1
+                    # the space is only freed with the last link of the old file
+                    if file_stat.st_nlink == 1:
+                        saved += file_stat.st_size
+    pbtools.save_hash_cache()
+    pblog.info(f"Linked {linked} duplicate engine files in {time.perf_counter() - start:.1f}s, freeing {saved / (1000 * 1000 * 1000):.2f}GB")
+    return saved
+
+
+def mark_used(install_dir):
+    try:
+        Path(install_dir, last_used_name).touch()
+    except OSError as e:
+        pblog.warning(f"Could not mark {install_dir} as used: {e}")
+
+
+def get_last_used(install_dir):
+    # Only the stamp of mark_used counts, access times of files are shared by their hardlinks in other installs.
+    # Installs from before the stamp count with the modification time of their folder.
+    for path in (os.path.join(install_dir, last_used_name), install_dir):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            continue
+    return 0
+
+
+def get_install_inodes(install):
+    # (device, inode) -> [size, link count, links within the install] of the files of an install
+    inodes = {}
+    for directory, _, file_names in os.walk(install):
+        for file_name in file_names:
+            try:
+                file_stat = os.lstat(os.path.join(directory, file_name))
+            except OSError:
+                continue
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            if inode in inodes:
+                inodes[inode][2] += 1
+            else:
+                inodes[inode] = [file_stat.st_size, file_stat.st_nlink, 1]
+    return inodes
+
+
+def get_file_sources(files, installs):
+    # Relative path -> installs which can provide the content of the manifest file
+    sources = defaultdict(set)
+    with ThreadPoolExecutor(max_workers=pbtools.hash_max_workers) as executor:
+        for install in installs:
+            install_index = get_install_index([install])
+
+            def is_provided(relative_path):
+                return find_local_copy(relative_path, files[relative_path], install_index) is not None
+
+            for relative_path, provided in zip(files, executor.map(is_provided, files)):
+                if provided:
+                    sources[relative_path].add(install)
+    pbtools.save_hash_cache()
+    return sources
+
+
+def plan_evictions(root, version, free, files=None, required_size=0):
+    # Pick the least recently used installs to remove, until the download fits. required_size is downloaded in any
+    # case, files of a sync only when no kept install has them. Returns required bytes, evicted installs and freed
+    # bytes. The plan doesn't fit if required bytes are still above free plus freed bytes.
+    # Every install is scanned once, and the totals are updated as installs are evicted.
+    pbtools.add_hash_cache_root(root)
+    candidates = sorted(find_installs(root, version), key=get_last_used)
+    required = required_size
+    # relative path -> number of kept installs which have the file, and install -> the relative paths it has
+    source_counts = {}
+    provided_files = defaultdict(list)
+    if files is not None:
+        install_dir = os.path.join(root, version)
+        sources = get_file_sources(files, [install_dir] + candidates)
+        for relative_path, entry in files.items():
+            file_sources = sources.get(relative_path, set())
+            if not file_sources:
+                required += entry["size"]
+            elif install_dir not in file_sources:
+                source_counts[relative_path] = len(file_sources)
+                for install in file_sources:
+                    provided_files[install].append(relative_path)
+
+    kept = list(candidates)
+    evicted = []
+    freed = 0
+    # links of the evicted installs per inode, a file is only freed once all of its links are removed
+    evicted_links = defaultdict(int)
+    while required + required_space_margin > free + freed and kept:
+        install = kept.pop(0)
+        evicted.append(install)
+        for relative_path in provided_files.get(install, []):
+            source_counts[relative_path] -= 1
+            if source_counts[relative_path] == 0:
+                required += files[relative_path]["size"]
+        for inode, (size, link_count, links) in get_install_inodes(install).items():
+            was_freed = evicted_links[inode] >= link_count
+            evicted_links[inode] += links
+            if not was_freed and evicted_links[inode] >= link_count:
+                freed += size
+    return required, evicted, freed
+
+
+def create_manifest(install_dir):
+    # Hash every file of an install, for publishing it
+    paths = [path for path in Path(install_dir).rglob("*") if path.is_file() and path.name not in (local_manifest_name, last_used_name)]
+
+    def get_entry(path):
+        return path.relative_to(install_dir).as_posix(), {"md5": pbtools.get_md5_hash(str(path), use_cache=False), "size": path.stat().st_size}
+
+    with ThreadPoolExecutor(max_workers=pbtools.hash_max_workers) as executor:
+        return dict(executor.map(get_entry, paths))
+
+
+def publish(install_dir, bucket_dir, bundle, version):
+    # Store an install in a local bucket directory, which can be uploaded as is (e.g. with gsutil rsync)
+    files = create_manifest(install_dir)
+    for relative_path, entry in files.items():
+        object_path = pbbucket.get_local_object_path(bucket_dir, get_object_name(entry["md5"]))
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            # copy, objects must not change along with the install
+            shutil.copyfile(os.path.join(install_dir, *relative_path.split("/")), object_path)
+    manifest_path = pbbucket.get_local_object_path(bucket_dir, get_manifest_name(bundle, version))
+    with open(manifest_path, "w") as manifest_file:
+        json.dump({"files": files}, manifest_file, separators=(",", ":"))
+    pblog.info(f"Published {len(files)} files of {bundle}-{version} to {bucket_dir}")
+    return True
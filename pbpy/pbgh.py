@@ -1,55 +1,97 @@
 import os.path
 import os
+import json
 import shutil
 import subprocess
+import time
+import zlib
+import http.client
 
+from hashlib import md5
+from urllib.parse import urlparse
 from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
 
 from pbpy import pblog
 from pbpy import pbtools
 from pbpy import pbconfig
 from pbpy import pbgit
 from pbpy import pbunreal
+from pbpy import pbstore
+from pbpy import pbhttp
+from pbpy import pbperf
 
 gh_executable_path = ".github\\gh\\gh.exe"
+github_api_url = "https://api.github.com"
 binary_package_name = "Binaries.zip"
+binaries_staging_dir = ".pbsync_binaries_staging"
+# inside the git directory, the files of the last installed package
+installed_binaries_name = "pbsync_binaries.json"
 
 
 def get_token_env():
     _, token = pbgit.get_credentials()
+    if token is None:
+        return None
 
     return {
         "GITHUB_TOKEN": token
     }
 
 
-def is_pull_binaries_required():
-    if not os.path.isfile(gh_executable_path):
-        return True
-    checksum_json_path = pbconfig.get("checksum_file")
-    if not os.path.exists(checksum_json_path):
-        return True
-    return not pbtools.compare_md5_all(checksum_json_path)
+def get_downloader():
+    return pbconfig.get_user("binaries", "downloader", "native")
 
 
-def pull_binaries(version_number: str, pass_checksum=False):
-    if not os.path.isfile(gh_executable_path):
-        pblog.error(f"GH CLI executable not found at {gh_executable_path}")
-        return 1
+def get_api_url():
+    # can be pointed at a local stand-in server, see pbstandin
+    return pbconfig.get_user("binaries", "api_url", github_api_url).rstrip("/")
 
-    # Backward compatibility with old PBGet junctions. If it still exists, remove the junction
-    if pbtools.is_junction("Binaries") and not pbtools.remove_junction("Binaries"):
-        pblog.error("Something went wrong while removing junction for 'Binaries' folder. You should remove that folder manually to solve the problem")
-        return -1
 
-    # Remove binary package if it exists, hub is not able to overwrite existing files
-    if os.path.exists(binary_package_name):
-        try:
-            os.remove(binary_package_name)
-        except Exception as e:
-            pblog.exception(str(e))
-            pblog.error(f"Exception thrown while removing {binary_package_name}. Please remove it manually.")
+def get_repo_slug():
+    path = urlparse(pbconfig.get("git_url")).path.strip("/")
+    if path.endswith(".git"):
+        path = path[:-len(".git")]
+    return path
+
+
+def resolve_release_asset(version_number, headers):
+    # Returns the asset, None if the release or asset does not exist
+    status, release = pbhttp.get_json(f"{get_api_url()}/repos/{get_repo_slug()}/releases/tags/{version_number}", headers)
+    if status == 404:
+        return None
+    if release is None:
+        raise http.client.HTTPException(f"Unexpected HTTP status {status} while resolving release {version_number}")
+    for asset in release.get("assets", []):
+        if asset.get("name") == binary_package_name:
+            return asset
+    return None
+
+
+def download_binaries_native(version_number):
+    try:
+        _, token = pbgit.get_credentials()
+        headers = {"Authorization": f"token {token}"} if token else {}
+        asset = resolve_release_asset(version_number, headers)
+        if asset is None:
+            pblog.error(f"Release {version_number} not found. Please wait and try again later.")
             return -1
+        headers["Accept"] = "application/octet-stream"
+        connections = pbconfig.get_user_config().getint("binaries", "connections", fallback=pbhttp.default_connections)
+        resume_key = f"{version_number}/{asset.get('id')}/{asset.get('size')}"
+        if not pbhttp.download_file(asset["url"], binary_package_name, headers=headers, resume_key=resume_key, connections=connections):
+            return 1
+    except Exception as e:
+        pblog.exception(str(e))
+        pblog.error(f"Exception thrown while downloading binaries for {version_number}")
+        return 1
+    return 0
+
+
+def download_binaries_gh(version_number):
+    if not os.path.isfile(gh_executable_path):
+        pblog.error(f"GH CLI executable not found at {gh_executable_path}")
+        return 1
 
     creds = get_token_env()
 
@@ -73,17 +115,246 @@ def pull_binaries(version_number: str, pass_checksum=False):
         pblog.error(
             f"Exception thrown while pulling binaries for {version_number}")
         return 1
+    return 0
+
+
+def get_checksum_key(file_path):
+    # checksum json keys are relative Windows paths, e.g. .\Binaries\Win64\file.dll
+    return ".\\" + file_path.replace("/", "\\")
+
+
+def get_member_path(member):
+    member_path = os.path.normpath(member.filename)
+    if os.path.isabs(member_path) or member_path.startswith(".."):
+        raise ValueError(f"Refusing to extract {member.filename} outside of the project")
+    return member_path
+
+
+def get_crc32(file_path):
+    crc = 0
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(pbtools.hash_chunk_size), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def is_member_up_to_date(member, hash_dict):
+    member_path = get_member_path(member)
+    if not os.path.isfile(member_path):
+        return False
+    if hash_dict is not None:
+        expected_md5 = hash_dict.get(get_checksum_key(member.filename))
+        if expected_md5 is not None:
+            # this is served from the hash cache for files which did not change since the last run
+            return pbtools.get_md5_hash(member_path) == expected_md5
+    return os.path.getsize(member_path) == member.file_size and get_crc32(member_path) == member.CRC
+
+
+def extract_member(zip_file, member, target_path):
+    # Extract a single member, hashing it while it is being written, so it never needs to be read back
+    target_dir = os.path.dirname(target_path)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    md5_reader = md5()
+    with zip_file.open(member) as source, open(target_path, "wb") as target:
+        for chunk in iter(lambda: source.read(pbtools.hash_chunk_size), b""):
+            md5_reader.update(chunk)
+            target.write(chunk)
+    pbperf.add("bytes_hashed", member.file_size)
+    return str(md5_reader.hexdigest()).upper()
+
+
+def get_installed_binaries_path():
+    return os.path.join(pbgit.get_git_dir(), installed_binaries_name)
+
+
+def read_installed_binaries():
+    # Files of the last installed package, as recorded by write_installed_binaries
+    try:
+        with open(get_installed_binaries_path()) as installed_file:
+            return json.load(installed_file)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        pblog.warning(f"Discarding list of installed binaries: {e}")
+    return []
 
-    pbunreal.ensure_ue4_closed()
 
-    # Temp fix for Binaries folder with unnecessary content
-    if os.path.isdir("Binaries"):
+def write_installed_binaries(file_paths):
+    installed_path = get_installed_binaries_path()
+    temp_path = f"{installed_path}.tmp"
+    try:
+        with open(temp_path, "w") as installed_file:
+            json.dump(sorted(file_paths), installed_file)
+        os.replace(temp_path, installed_path)
+    except Exception as e:
+        pblog.exception(str(e))
+
+
+def get_stale_files(file_paths):
+    # Files of the previously installed package which are not part of the new one. Only files which were installed
+    # from a package are ever removed, never other files of the same folders, like sources or local work.
+    member_paths = {os.path.normcase(os.path.normpath(file_path)) for file_path in file_paths}
+    return [file_path for file_path in read_installed_binaries() if os.path.normcase(os.path.normpath(file_path)) not in member_paths and os.path.isfile(file_path)]
+
+
+def remove_stale_files(stale_files):
+    for stale_file in stale_files:
+        if not pbtools.remove_file(stale_file):
+            pblog.warning(f"Could not remove stale file {stale_file}")
+    pbtools.invalidate_hash_cache(stale_files)
+
+
+def get_checksum_files(checksum_json_path):
+    # file path -> MD5 mapping of the checksum json, without the package itself
+    hash_dict = pbtools.get_dict_from_json(checksum_json_path)
+    if hash_dict is None:
+        return None
+    return {os.path.normpath(key.replace("\\", os.sep)): value for key, value in hash_dict.items() if not key.endswith(".zip")}
+
+
+def restore_binaries_from_store(checksum_json_path):
+    files = get_checksum_files(checksum_json_path)
+    if not files:
+        return False
+    missing = pbstore.checkout(files)
+    if missing:
+        pblog.info(f"{len(missing)} of {len(files)} files are missing from the binaries cache")
+        return False
+    remove_stale_files(get_stale_files(files.keys()))
+    write_installed_binaries(files.keys())
+    pbtools.save_hash_cache()
+    return True
+
+
+def extract_binaries(package_path, checksum_json_path=None):
+    hash_dict = None
+    if checksum_json_path is not None:
+        hash_dict = pbtools.get_dict_from_json(checksum_json_path)
+        if hash_dict is None or len(hash_dict) == 0:
+            return False
+
+    # Clean up leftovers of an interrupted update
+    shutil.rmtree(binaries_staging_dir, ignore_errors=True)
+
+    start = time.perf_counter()
+    is_success = True
+    with ZipFile(package_path) as zip_file:
+        members = [member for member in zip_file.infolist() if not member.is_dir()]
+        with ThreadPoolExecutor(max_workers=pbtools.hash_max_workers) as executor:
+            up_to_date = list(executor.map(lambda member: is_member_up_to_date(member, hash_dict), members))
+            changed_members = [member for member, is_current in zip(members, up_to_date) if not is_current]
+            stale_files = get_stale_files(get_member_path(member) for member in members)
+
+            changed_bytes = sum(member.file_size for member in changed_members)
+            pblog.info(f"Updating {len(changed_members)} of {len(members)} files ({changed_bytes / (1000 * 1000):.1f}MB), removing {len(stale_files)} stale files")
+
+            # Stage changed files first, so an interrupted update leaves the current files intact
+            def stage_member(member):
+                return extract_member(zip_file, member, os.path.join(binaries_staging_dir, get_member_path(member)))
+
+            # zip reads are serialized internally, but decompression, hashing and writing run in parallel
+            results = list(executor.map(stage_member, changed_members))
+            for member, current_md5 in zip(changed_members, results):
+                if hash_dict is None:
+                    continue
+                expected_md5 = hash_dict.get(get_checksum_key(member.filename))
+                if expected_md5 is None:
+                    pblog.warning(f"{member.filename} is not listed in {checksum_json_path}")
+                elif expected_md5 != current_md5:
+                    pblog.error(f"MD5 checksum failed for {get_checksum_key(member.filename)}")
+                    pblog.error(f"Expected MD5: {expected_md5}")
+                    pblog.error(f"Current MD5: {current_md5}")
+                    is_success = False
+
+    if not is_success:
+        shutil.rmtree(binaries_staging_dir, ignore_errors=True)
+        return False
+
+    # Swap staged files into place. Every rename is atomic, so an interruption leaves each file either old or new
+    for member, current_md5 in zip(changed_members, results):
+        member_path = get_member_path(member)
+        member_dir = os.path.dirname(member_path)
+        if member_dir:
+            os.makedirs(member_dir, exist_ok=True)
+        os.replace(os.path.join(binaries_staging_dir, member_path), member_path)
+        if pbtools.is_hash_cache_enabled():
+            pbtools.set_cached_md5_hash(member_path, os.stat(member_path), current_md5, trusted=True)
+    shutil.rmtree(binaries_staging_dir, ignore_errors=True)
+
+    remove_stale_files(stale_files)
+    write_installed_binaries(get_member_path(member) for member in members)
+
+    elapsed = time.perf_counter() - start
+    throughput = changed_bytes / elapsed / (1000 * 1000) if elapsed > 0 else 0
+    pblog.info(f"Updated binaries in {elapsed:.2f}s ({throughput:.1f}MB/s)")
+
+    if hash_dict is not None:
+        # files which were not part of the package still have to match the checksum file
+        member_keys = {get_checksum_key(member.filename) for member in members}
+        for key, expected_md5 in hash_dict.items():
+            if key in member_keys or key.endswith(".zip"):
+                continue
+            if not os.path.isfile(key) or pbtools.get_md5_hash(key) != expected_md5:
+                pblog.error(f"MD5 checksum failed for {key}")
+                is_success = False
+    pbtools.save_hash_cache()
+
+    return is_success
+
+
+def is_pull_binaries_required():
+    # the native downloader doesn't need the GH CLI
+    if get_downloader() != "native" and not os.path.isfile(gh_executable_path):
+        return True
+    checksum_json_path = pbconfig.get("checksum_file")
+    if not os.path.exists(checksum_json_path):
+        return True
+    return not pbtools.compare_md5_all(checksum_json_path)
+
+
+def pull_binaries(version_number: str, pass_checksum=False):
+    # Backward compatibility with old PBGet junctions. If it still exists, remove the junction
+    if pbtools.is_junction("Binaries") and not pbtools.remove_junction("Binaries"):
+        pblog.error("Something went wrong while removing junction for 'Binaries' folder. You should remove that folder manually to solve the problem")
+        return -1
+
+    use_store = not pass_checksum and pbstore.is_enabled()
+    if use_store:
+        checksum_json_path = pbconfig.get("checksum_file")
+        if os.path.exists(checksum_json_path):
+            pbunreal.ensure_ue4_closed()
+            if restore_binaries_from_store(checksum_json_path):
+                pblog.info(f"Binaries for {version_number} were restored from the binaries cache")
+                return 0
+
+    # Remove binary package if it exists, hub is not able to overwrite existing files
+    if os.path.exists(binary_package_name):
         try:
-            shutil.rmtree("Binaries")
+            os.remove(binary_package_name)
         except Exception as e:
             pblog.exception(str(e))
-            pblog.error("Exception thrown while cleaning Binaries folder")
-            return 1
+            pblog.error(f"Exception thrown while removing {binary_package_name}. Please remove it manually.")
+            return -1
+
+    if get_downloader() == "native":
+        ret = download_binaries_native(version_number)
+        if ret > 0 and pbhttp.has_partial_download(binary_package_name):
+            # GH CLI would start from zero, while another native attempt continues the interrupted download
+            pblog.warning("Native download was interrupted, resuming it")
+            ret = download_binaries_native(version_number)
+        if ret > 0 and os.path.isfile(gh_executable_path):
+            pblog.warning("Native download failed, falling back to GH CLI")
+            ret = download_binaries_gh(version_number)
+            if ret == 0:
+                pbhttp.discard_partial_download(binary_package_name)
+    else:
+        ret = download_binaries_gh(version_number)
+    if ret != 0:
+        return ret
+
+    pbunreal.ensure_ue4_closed()
+
     try:
         if pass_checksum:
             checksum_json_path = None
@@ -94,14 +365,15 @@ def pull_binaries(version_number: str, pass_checksum=False):
                 return 1
 
             if not pbtools.compare_md5_single(binary_package_name, checksum_json_path):
+                # never resume from a corrupted package
+                pbhttp.discard_download(binary_package_name)
                 return 1
 
-        with ZipFile(binary_package_name) as zip_file:
-            zip_file.extractall()
-            if pass_checksum:
-                return 0
-            elif not pbtools.compare_md5_all(checksum_json_path, True):
-                return 1
+        if not extract_binaries(binary_package_name, checksum_json_path):
+            return 1
+
+        if use_store:
+            pbstore.add(get_checksum_files(checksum_json_path))
 
     except Exception as e:
         pblog.exception(str(e))
@@ -1,20 +1,187 @@
 import os
+import re
+import time
 import shutil
-import subprocess
+import threading
 
-from urllib.parse import urlparse
 from functools import lru_cache
+from urllib.parse import urlparse
 
 from pbpy import pblog
 from pbpy import pbconfig
 from pbpy import pbtools
+from pbpy import pbperf
 
 missing_version = "not installed"
+# keep command lines well below the Windows limit of 32767 characters
+max_include_length = 8000
+include_special_pattern = re.compile(r"([\[*?])")
+
+# LFS transfer settings which can be tuned in the <lfs> section of PBSync.xml and overridden in [lfs] of the user config
+lfs_tuning_keys = {
+    "concurrenttransfers": "lfs.concurrenttransfers",
+    "maxretries": "lfs.transfer.maxretries",
+    "batchsize": "lfs.transfer.batchSize",
+    "fetchinclude": "lfs.fetchinclude",
+    "fetchexclude": "lfs.fetchexclude"
+}
+# Keys set by setup_config from PBSync.xml, the user config and the workspace profile. They are recorded in the
+# repository config, so they can be unset again once their setting is removed.
+managed_keys_key = "pbsync.managedkeys"
+
+# Results of batched git queries, valid until a command changes repository state. See invalidate_cache.
+git_config = None
+config_lock = threading.Lock()
+repo_info = None
+status_cache = {}
+sparse_directories = False
+# branch -> oid on the remote, from the ls-remote of check_remote_connection. Remote state, so local changes keep it valid.
+remote_heads = None
+
+fetch_received_pattern = re.compile(r"Receiving objects: [^\n\r]*?, ([\d.]+) (bytes|KiB|MiB|GiB)")
+fetch_size_units = {"bytes": 1, "KiB": 1024, "MiB": 1024 * 1024, "GiB": 1024 * 1024 * 1024}
+
+
+def invalidate_cache():
+    global git_config, repo_info, sparse_directories
+    with config_lock:
+        git_config = None
+    repo_info = None
+    status_cache.clear()
+    sparse_directories = False
+
+
+def get_config():
+    # Every config value, read with a single git process. Keys are mapped to a list of values.
+    # The cache is only published once it is complete, since the preflight checks read it concurrently.
+    global git_config
+    with config_lock:
+        if git_config is None:
+            config = {}
+            proc = pbtools.run_with_output([get_git_executable(), "config", "--list", "-z"])
+            if proc.returncode == 0:
+                for entry in proc.stdout.split("\0"):
+                    if not entry:
+                        continue
+                    key, _, value = entry.partition("\n")
+                    config.setdefault(key, []).append(value)
+            git_config = config
+        return git_config
+
+
+def get_config_key(key):
+    # section and variable names are case insensitive, subsections are not
+    section, _, rest = key.partition(".")
+    subsection, _, variable = rest.rpartition(".")
+    if subsection:
+        return f"{section.lower()}.{subsection}.{variable.lower()}"
+    return f"{section.lower()}.{variable.lower()}"
+
+
+def get_config_value(key, default=None):
+    values = get_config().get(get_config_key(key))
+    if not values:
+        return default
+    return values[-1]
+
+
+def set_config_value(key, value, *args):
+    # Set a config value, skipping the write if it is already set. A value of None unsets the key.
+    if not args and get_config_value(key) == value:
+        return 0
+    if value is None:
+        proc = pbtools.run_with_combined_output([get_git_executable(), "config", *args, "--unset-all", key])
+    else:
+        proc = pbtools.run_with_combined_output([get_git_executable(), "config", *args, key, value])
+    invalidate_cache()
+    return proc.returncode
+
+
+def get_repo_info():
+    # Repository level facts, read with a single git process
+    global repo_info
+    if repo_info is None:
+        proc = pbtools.run_with_output([get_git_executable(), "rev-parse", "--is-shallow-repository", "--git-dir", "--show-toplevel"])
+        lines = proc.stdout.splitlines()
+        if proc.returncode != 0 or len(lines) < 3:
+            return {"is_shallow": False, "git_dir": os.path.join(os.getcwd(), ".git"), "toplevel": os.getcwd()}
+        repo_info = {
+            "is_shallow": lines[0] == "true",
+            "git_dir": os.path.abspath(lines[1]),
+            "toplevel": lines[2]
+        }
+    return repo_info
+
+
+def get_git_dir():
+    return get_repo_info()["git_dir"]
+
+
+def get_status(untracked=False):
+    # Branch, upstream, ahead/behind counts and changed entries, from git status --porcelain=v2
+    status = status_cache.get(untracked)
+    if status is not None:
+        return status
+    cmd = [get_git_executable(), "status", "--porcelain=v2", "--branch", "-z"]
+    if not untracked:
+        cmd.append("-uno")
+    start = time.perf_counter()
+    proc = pbtools.run_with_output(cmd)
+    pblog.info(f"git status took {time.perf_counter() - start:.2f}s")
+    status = {"returncode": proc.returncode, "oid": None, "head": None, "upstream": None, "ahead": 0, "behind": 0, "changes": [], "unmerged": []}
+    entries = iter(proc.stdout.split("\0"))
+    for entry in entries:
+        if not entry:
+            continue
+        if entry.startswith("# "):
+            header, _, value = entry[2:].partition(" ")
+            if header == "branch.oid":
+                status["oid"] = None if value == "(initial)" else value
+            elif header == "branch.head":
+                status["head"] = None if value == "(detached)" else value
+            elif header == "branch.upstream":
+                status["upstream"] = value
+            elif header == "branch.ab":
+                ahead, behind = value.split(" ")
+                status["ahead"] = int(ahead)
+                status["behind"] = -int(behind)
+            continue
+        kind = entry[0]
+        if kind == "2":
+            # renames and copies are followed by the original path
+            next(entries, None)
+        if kind == "u":
+            status["unmerged"].append(entry.split(" ", 10)[-1])
+        if kind != "!":
+            status["changes"].append(entry)
+    status_cache[untracked] = status
+    return status
+
+
+def get_oid(rev):
+    return pbtools.get_one_line_output([get_git_executable(), "rev-parse", "-q", "--verify", f"{rev}^{{commit}}"]) or None
+
+
+def is_rebase_in_progress():
+    git_dir = get_git_dir()
+    return os.path.isdir(os.path.join(git_dir, "rebase-merge")) or os.path.isdir(os.path.join(git_dir, "rebase-apply"))
+
+
+def is_merge_in_progress():
+    return os.path.isfile(os.path.join(get_git_dir(), "MERGE_HEAD"))
 
 
-@lru_cache()
 def get_current_branch_name():
-    return pbtools.get_one_line_output([get_git_executable(), "branch", "--show-current"])
+    # Read HEAD directly instead of spawning git, like git branch --show-current this is empty on a detached HEAD
+    try:
+        with open(os.path.join(get_git_dir(), "HEAD")) as head_file:
+            head = head_file.read().strip()
+    except OSError:
+        return pbtools.get_one_line_output([get_git_executable(), "branch", "--show-current"])
+    prefix = "ref: refs/heads/"
+    if head.startswith(prefix):
+        return head[len(prefix):]
+    return ""
 
 
 def get_git_version():
@@ -46,7 +213,7 @@ def get_lfs_executable():
 
 
 def get_gcm_executable():
-    gcm_exec = pbtools.get_one_line_output([get_git_executable(), "config", "--get", "credential.helper"]).replace("\\", "")
+    gcm_exec = get_config_value("credential.helper", "").replace("\\", "")
     # no helper installed
     if not gcm_exec:
         return None
@@ -97,81 +264,427 @@ def get_gcm_version():
 def set_tracking_information(upstream_branch_name: str):
     output = pbtools.get_combined_output([get_git_executable(), "branch", f"--set-upstream-to=origin/{upstream_branch_name}",
                                       upstream_branch_name])
+    invalidate_cache()
     pblog.info(output)
 
 
+def get_stash_oid():
+    return get_oid("refs/stash")
+
+
+def stash():
+    # Returns whether a new stash entry was created, git stash succeeds without one when there is nothing to save
+    old_stash = get_stash_oid()
+    proc = pbtools.run_with_combined_output([get_git_executable(), "stash"])
+    invalidate_cache()
+    pblog.info(proc.stdout)
+    return proc.returncode == 0 and get_stash_oid() not in (None, old_stash)
+
+
 def stash_pop():
     pblog.info("Popping stash...")
 
-    output = pbtools.get_combined_output([get_git_executable(), "stash", "pop"])
-    pblog.info(output)
-    lower_case_output = output.lower()
+    proc = pbtools.run_with_combined_output([get_git_executable(), "stash", "pop"])
+    invalidate_cache()
+    pblog.info(proc.stdout)
 
-    if pbtools.it_has_all(lower_case_output, "auto-merging", "conflict", "should have been pointers"):
+    if proc.returncode == 0:
+        return
+    elif get_status()["unmerged"]:
         pbtools.error_state("""git stash pop failed. Some of your stashed local changes would be overwritten by incoming changes.
         Request help in #tech-support to resolve conflicts, and please do not run UpdateProject until the issue is resolved.""", True)
-    elif "dropped refs" in lower_case_output:
-        return
-    elif "no stash entries found" in lower_case_output:
-        return
     else:
         pbtools.error_state("""git stash pop failed due to an unknown error. Request help in #tech-support to resolve possible conflicts, 
         and please do not run UpdateProject until the issue is resolved.""", True)
 
 
 def check_remote_connection():
-    current_url = pbtools.get_one_line_output([get_git_executable(), "remote", "get-url", "origin"])
+    current_url = get_config_value("remote.origin.url", "")
     recent_url = pbconfig.get("git_url")
 
     if current_url != recent_url:
         output = pbtools.get_combined_output([get_git_executable(), "remote", "set-url", "origin", recent_url])
+        invalidate_cache()
         current_url = recent_url
         pblog.info(output)
 
-    out = pbtools.run_with_output([get_git_executable(), "ls-remote", "--exit-code", "-h"]).returncode
-    return out == 0, current_url
+    return get_remote_heads(refresh=True) is not None, current_url
+
+
+def get_remote_heads(refresh=False):
+    global remote_heads
+    if remote_heads is None or refresh:
+        remote_heads = None
+        proc = pbtools.run_with_output([get_git_executable(), "ls-remote", "--exit-code", "-h", "origin"])
+        if proc.returncode != 0:
+            return None
+        remote_heads = {}
+        for line in proc.stdout.splitlines():
+            oid, _, ref = line.partition("\t")
+            if ref.startswith("refs/heads/"):
+                remote_heads[ref[len("refs/heads/"):]] = oid
+    return remote_heads
+
+
+def get_remote_tracking_oids():
+    proc = pbtools.run_with_output([get_git_executable(), "for-each-ref", "--format=%(objectname) %(refname)", "refs/remotes/origin/"])
+    oids = {}
+    for line in proc.stdout.splitlines():
+        oid, _, ref = line.partition(" ")
+        oids[ref[len("refs/remotes/origin/"):]] = oid
+    return oids
+
+
+def get_fetched_bytes(output):
+    matches = fetch_received_pattern.findall(output)
+    if not matches:
+        return 0
+    size, unit = matches[-1]
+    return int(float(size) * fetch_size_units[unit])
+
+
+def fetch(branches, refresh=False):
+    # Fetch the given branches from origin into their remote tracking refs, skipping the ones which are already up to date
+    heads = get_remote_heads(refresh)
+    if heads is None:
+        pblog.error("Could not list the branches of the remote repository")
+        return False
+    tracking = get_remote_tracking_oids()
+    refspecs = []
+    negotiation_tips = ["HEAD"]
+    for branch in sorted(set(branch for branch in branches if branch)):
+        if branch not in heads:
+            pblog.info(f"Skipping fetch of {branch}, it does not exist on the remote")
+            continue
+        if branch in tracking:
+            # only advertise what we have of the fetched branches, instead of every local ref
+            negotiation_tips.append(f"refs/remotes/origin/{branch}")
+            if tracking[branch] == heads[branch]:
+                continue
+        refspecs.append(f"+refs/heads/{branch}:refs/remotes/origin/{branch}")
+    if not refspecs:
+        pblog.info("Remote branches are already up to date")
+        return True
+
+    cmd = [get_git_executable(), "-c", "fetch.writeCommitGraph=true", "fetch", "--progress"]
+    cmd.extend(f"--negotiation-tip={tip}" for tip in negotiation_tips)
+    cmd.append("origin")
+    cmd.extend(refspecs)
+    # progress is parsed for the received size, so keep it in English
+    proc = pbtools.run_with_combined_output(cmd, env={"LC_ALL": "C"})
+    invalidate_cache()
+    received = get_fetched_bytes(proc.stdout)
+    pbperf.add("bytes_fetched", received)
+    if proc.returncode != 0:
+        pblog.error(proc.stdout)
+        return False
+    pblog.info(f"Fetched {len(refspecs)} branches, received {received / (1000 * 1000):.1f}MB")
+    return True
 
 
 def check_credentials():
-    output = pbtools.get_one_line_output([get_git_executable(), "config", "user.name"])
+    output = get_config_value("user.name")
     if output == "" or output is None:
         user_name = input("Please enter your GitHub username: ")
-        pbtools.run_with_output([get_git_executable(), "config", "user.name", user_name])
+        set_config_value("user.name", user_name)
 
-    output = pbtools.get_one_line_output([get_git_executable(), "config", "user.email"])
+    output = get_config_value("user.email")
     if output == "" or output is None:
         user_mail = input("Please enter your GitHub email: ")
-        pbtools.run_with_output([get_git_executable(), "config", "user.email", user_mail])
+        set_config_value("user.email", user_mail)
 
 
 def sync_file(file_path, sync_target=None):
     if sync_target is None:
         sync_target = f"origin/{get_current_branch_name()}"
     proc = pbtools.run([get_git_executable(), "restore", "-qWSs", sync_target, "--", file_path])
+    invalidate_cache()
     return proc.returncode
 
 
+def get_changed_paths(old_ref, new_ref, since_merge_base=False):
+    # Paths changed between old_ref and new_ref, or by new_ref since it diverged from old_ref
+    revisions = [f"{old_ref}...{new_ref}"] if since_merge_base else [old_ref, new_ref]
+    proc = pbtools.run_with_output([get_git_executable(), "diff", "--name-only", "--no-renames", "-z", *revisions])
+    if proc.returncode != 0:
+        return None
+    return [path for path in proc.stdout.split("\0") if path]
+
+
+def escape_include_path(path):
+    # --include takes wildmatch patterns, so [, * and ? have to match literally. Bracket expressions are used instead
+    # of backslashes, which could be taken as path separators on Windows.
+    return include_special_pattern.sub(r"[\1]", path)
+
+
+def chunk_include_paths(paths, max_length=max_include_length):
+    # Split paths into comma separated --include lists which fit on a command line.
+    # Commas separate LFS patterns, so those paths can't be included individually.
+    chunk = []
+    length = 0
+    for path in paths:
+        if "," in path:
+            continue
+        path = escape_include_path(path)
+        if chunk and length + len(path) + 1 > max_length:
+            yield ",".join(chunk)
+            chunk = []
+            length = 0
+        chunk.append(path)
+        length += len(path) + 1
+    if chunk:
+        yield ",".join(chunk)
+
+
+def lfs_fetch_paths(ref, paths):
+    for include in chunk_include_paths(paths):
+        proc = pbtools.run_with_combined_output([get_lfs_executable(), "fetch", "origin", ref, "--include", include])
+        if proc.returncode != 0:
+            pblog.warning(f"Git LFS prefetch failed: {proc.stdout}")
+            return False
+    return True
+
+
+def get_lfs_tracked_paths(paths):
+    # Filter paths down to the ones .gitattributes assigns to the LFS filter
+    if not paths:
+        return []
+    proc = pbtools.run_process([get_git_executable(), "check-attr", "-z", "--stdin", "filter"], output="separate", input="\0".join(paths) + "\0")
+    if proc.returncode != 0:
+        return None
+    fields = proc.stdout.split("\0")
+    # output is a sequence of path, attribute, value triples
+    return [fields[i] for i in range(0, len(fields) - 2, 3) if fields[i + 2] == "lfs"]
+
+
+def lfs_pull_paths(paths):
+    # Check out the given LFS files only, instead of scanning the whole working tree
+    if any("," in path for path in paths):
+        return pbtools.run([get_lfs_executable(), "pull"]).returncode == 0
+    for include in chunk_include_paths(paths):
+        if pbtools.run([get_lfs_executable(), "pull", "--include", include]).returncode != 0:
+            return False
+    return True
+
+
+def is_lfs_prefetch_enabled():
+    return pbconfig.get_user_config().getboolean("lfs", "prefetch", fallback=True)
+
+
+def start_lfs_prefetch(branch_name):
+    # Fetch LFS objects of incoming changes in the background, while the stash and rebase are running.
+    # Anything missed here is still downloaded by the LFS pull after the rebase.
+    if not is_lfs_prefetch_enabled():
+        return None
+    upstream = f"origin/{branch_name}"
+    paths = get_changed_paths("HEAD", upstream, since_merge_base=True)
+    if paths:
+        paths = filter_sparse_paths(paths)
+    if not paths:
+        return None
+    pblog.info(f"Prefetching Git LFS objects for {len(paths)} incoming files...")
+    thread = threading.Thread(target=lfs_fetch_paths, args=(upstream, paths), daemon=True)
+    thread.start()
+    return thread
+
+
+def prefetch(branch_name):
+    # Download new commits and their LFS objects ahead of the next sync, without touching the working tree
+    if not fetch([branch_name], refresh=True):
+        return False
+    proc = pbtools.run_with_combined_output([get_lfs_executable(), "fetch", "--recent", "origin", f"origin/{branch_name}"])
+    if proc.returncode != 0:
+        pblog.error(proc.stdout)
+        return False
+    return True
+
+
 def abort_all():
     # Abort everything
     pbtools.run_with_output([get_git_executable(), "merge", "--abort"])
     pbtools.run_with_output([get_git_executable(), "rebase", "--abort"])
     pbtools.run_with_output([get_git_executable(), "am", "--abort"])
     # Just in case
-    shutil.rmtree(os.path.join(os.getcwd(), ".git", "rebase-apply"), ignore_errors=True)
-    shutil.rmtree(os.path.join(os.getcwd(), ".git", "rebase-merge"), ignore_errors=True)
+    shutil.rmtree(os.path.join(get_git_dir(), "rebase-apply"), ignore_errors=True)
+    shutil.rmtree(os.path.join(get_git_dir(), "rebase-merge"), ignore_errors=True)
+    invalidate_cache()
 
 
 def abort_rebase():
     # Abort rebase
     pbtools.run_with_output([get_git_executable(), "rebase", "--abort"])
+    invalidate_cache()
+
+
+def get_profile():
+    # Workspace profile selected in the user config, from the <profiles> section of PBSync.xml
+    name = pbconfig.get_user("project", "profile")
+    if not name:
+        return None
+    profile = pbconfig.get("profiles").get(name)
+    if profile is None:
+        pblog.warning(f"Workspace profile {name} is not defined, using the full workspace")
+    return profile
+
+
+def get_sparse_directories():
+    # Directories of the cone mode sparse checkout, or None if the whole tree is checked out
+    global sparse_directories
+    if sparse_directories is False:
+        sparse_directories = None
+        if get_config_value("core.sparsecheckout") == "true":
+            proc = pbtools.run_with_output([get_git_executable(), "sparse-checkout", "list"])
+            if proc.returncode == 0:
+                sparse_directories = proc.stdout.splitlines()
+    return sparse_directories
+
+
+def is_sparse_checkout_outdated():
+    profile = get_profile()
+    wanted = profile["sparse"] if profile is not None and profile["sparse"] else None
+    current = get_sparse_directories()
+    if wanted is None or current is None:
+        return wanted != current
+    return set(wanted) != set(current)
+
+
+def update_sparse_checkout():
+    profile = get_profile()
+    if profile is not None and profile["sparse"]:
+        pblog.info(f"Limiting the workspace to {', '.join(profile['sparse'])}...")
+        proc = pbtools.run_with_combined_output([get_git_executable(), "sparse-checkout", "set", "--cone", *profile["sparse"]])
+    else:
+        pblog.info("Restoring the full workspace...")
+        proc = pbtools.run_with_combined_output([get_git_executable(), "sparse-checkout", "disable"])
+    invalidate_cache()
+    pblog.info(proc.stdout)
+    return proc.returncode == 0
+
+
+def is_in_sparse_cone(path, directories):
+    # Cone mode checks out the given directories recursively, and the files directly inside their parents
+    parent = path.rpartition("/")[0]
+    if not parent:
+        return True
+    for directory in directories:
+        if path.startswith(f"{directory}/") or directory == parent or directory.startswith(f"{parent}/"):
+            return True
+    return False
+
+
+def filter_sparse_paths(paths):
+    directories = get_sparse_directories()
+    if directories is None:
+        return paths
+    return [path for path in paths if is_in_sparse_cone(path, directories)]
+
+
+def get_lfs_tuning():
+    project_settings = pbconfig.get("lfs_settings")
+    settings = {}
+    for name, key in lfs_tuning_keys.items():
+        value = pbconfig.get_user("lfs", name, project_settings.get(name))
+        if value is not None:
+            settings[key] = value.strip()
+    # profiles only fetch the LFS objects they check out, unless the user asked for something else
+    profile = get_profile()
+    if profile is not None and pbconfig.get_user("lfs", "fetchinclude") is None:
+        includes = profile["sparse"] + profile["lfsinclude"]
+        if includes:
+            settings["lfs.fetchinclude"] = ",".join(includes)
+    return settings
+
+
+@lru_cache()
+def is_fsmonitor_supported():
+    # the built-in file system monitor daemon is not available on every platform, e.g. Linux
+    return "fsmonitor--daemon" in pbtools.get_combined_output([get_git_executable(), "version", "--build-options"])
+
+
+def is_fsmonitor_enabled_by_user():
+    return pbconfig.get_user_config().getboolean("git", "fsmonitor", fallback=True)
+
+
+def is_fsmonitor_wanted():
+    return is_fsmonitor_enabled_by_user() and is_fsmonitor_supported()
+
+
+def check_fsmonitor():
+    # Make sure the file system monitor is watching the workspace, otherwise every git command would try to start it
+    if get_config_value("core.fsmonitor") != "true":
+        return True
+    if pbtools.run_with_output([get_git_executable(), "fsmonitor--daemon", "status"]).returncode == 0:
+        return True
+    proc = pbtools.run_with_combined_output([get_git_executable(), "fsmonitor--daemon", "start"])
+    if proc.returncode == 0:
+        pblog.info("Started the file system monitor")
+        return True
+    pblog.warning(f"File system monitor is not healthy, disabling it for this workspace. git status will scan the whole workspace.\n{proc.stdout}")
+    set_config_value("core.fsmonitor", "false")
+    return False
 
 
 def setup_config():
-    pbtools.run_with_output([get_git_executable(), "config", "include.path", "../.gitconfig"])
+    set_config_value("include.path", "../.gitconfig")
+    # a status call otherwise walks the whole workspace, let git remember untracked directories and get changes from the OS
+    set_config_value("core.untrackedcache", "true")
+    fsmonitor = get_config_value("core.fsmonitor")
+    # Only decide once, an explicit false was set by the user or by a failed health check, and hook based monitors
+    # are left alone. An enabled monitor is checked by check_fsmonitor, so git isn't asked for its build options every sync.
+    if fsmonitor is None:
+        set_config_value("core.fsmonitor", "true" if is_fsmonitor_wanted() else "false")
+    elif fsmonitor == "true" and not is_fsmonitor_enabled_by_user():
+        set_config_value("core.fsmonitor", "false")
+    settings = get_lfs_tuning()
+    profile = get_profile()
+    if profile is not None and profile["partialclone"]:
+        # later fetches only download commits and trees, blobs are downloaded when they are checked out
+        settings["remote.origin.promisor"] = "true"
+        settings["remote.origin.partialclonefilter"] = "blob:none"
+    apply_managed_config(settings)
+
+
+def has_promisor_packs():
+    pack_dir = os.path.join(get_git_dir(), "objects", "pack")
+    try:
+        return any(name.endswith(".promisor") for name in os.listdir(pack_dir))
+    except OSError:
+        return False
+
+
+def get_local_config_value(key):
+    # Only the repository config, unlike get_config_value which merges the global and included configs
+    proc = pbtools.run_with_output([get_git_executable(), "config", "--local", "--get", key])
+    if proc.returncode != 0:
+        return None
+    return proc.stdout.rstrip("\n")
+
+
+def apply_managed_config(settings):
+    # Set the given values, and unset the ones which an earlier run set but which are not wanted anymore, e.g. the
+    # LFS fetch includes of a profile which was changed or removed. Only keys recorded in the repository config by
+    # PBSync are unset, the record is written even if it is empty.
+    previous = get_local_config_value(managed_keys_key)
+    previous_keys = [key for key in (previous or "").split(",") if key]
+    kept_keys = []
+    for key in previous_keys:
+        if key in settings or get_local_config_value(key) is None:
+            continue
+        if key == "remote.origin.promisor" and has_promisor_packs():
+            # objects of the partial clone may still be missing, and only a promisor remote can provide them
+            kept_keys.append(key)
+            continue
+        pblog.info(f"Unsetting {key}, it is not configured anymore")
+        set_config_value(key, None, "--local")
+    for key, value in settings.items():
+        set_config_value(key, value)
+    managed_keys = ",".join(sorted(set(settings) | set(kept_keys)))
+    if previous != managed_keys:
+        set_config_value(managed_keys_key, managed_keys, "--local")
 
 
 def get_credentials():
-    repo_str = pbtools.get_one_line_output([get_git_executable(), "remote", "get-url", "origin"])
+    repo_str = get_config_value("remote.origin.url", "")
     repo_url = urlparse(repo_str)
 
     creds = f"protocol={repo_url.scheme}\n"
@@ -180,10 +693,11 @@ def get_credentials():
         creds += f"username={repo_url.username}\n"
     creds += "\n"
 
-    proc = subprocess.run([get_gcm_executable(), "get"], input=creds, capture_output=True, text=True, shell=True)
+    proc = pbtools.run_process([get_gcm_executable(), "get"], output="separate", input=creds)
 
     if proc.returncode != 0:
-        return 1
+        # callers unpack the result, so fail with empty credentials
+        return None, None
 
     creds = proc.stdout
 
@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import base64
+import threading
+import http.client
+import urllib.request
+
+from functools import lru_cache
+from urllib.parse import urlparse, urljoin, unquote
+from concurrent.futures import ThreadPoolExecutor
+
+from pbpy import pblog
+from pbpy import pbtools
+from pbpy import pbperf
+
+user_agent = "PBSync"
+default_chunk_size = 16 * 1024 * 1024
+default_connections = 8
+max_chunk_retries = 3
+max_redirects = 5
+read_size = 1024 * 1024
+request_timeout = 60
+
+# Every thread keeps its own persistent connection per host, so range requests reuse TCP and TLS sessions
+connection_pool = threading.local()
+
+bytes_downloaded = 0
+bytes_downloaded_lock = threading.Lock()
+
+
+@lru_cache()
+def get_proxies():
+    # HTTPS_PROXY, HTTP_PROXY and NO_PROXY, or the system settings on Windows
+    return urllib.request.getproxies()
+
+
+def get_proxy(parsed):
+    proxy = get_proxies().get(parsed.scheme)
+    if not proxy or urllib.request.proxy_bypass(parsed.hostname or ""):
+        return None
+    return urlparse(proxy if "://" in proxy else f"http://{proxy}")
+
+
+def get_proxy_headers(proxy):
+    if proxy.username is None:
+        return {}
+    credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+    return {"Proxy-Authorization": f"Basic {base64.b64encode(credentials.encode()).decode()}"}
+
+
+def get_connection(url):
+    parsed = urlparse(url)
+    pool = getattr(connection_pool, "connections", None)
+    if pool is None:
+        pool = {}
+        connection_pool.connections = pool
+    key = (parsed.scheme, parsed.netloc)
+    connection = pool.get(key)
+    if connection is None:
+        proxy = get_proxy(parsed)
+        if proxy is not None and parsed.scheme == "https":
+            # TLS goes through a CONNECT tunnel of the proxy
+            connection = http.client.HTTPSConnection(proxy.hostname, proxy.port or 8080, timeout=request_timeout)
+            connection.set_tunnel(parsed.hostname, parsed.port or 443, headers=get_proxy_headers(proxy))
+        elif proxy is not None:
+            connection = http.client.HTTPConnection(proxy.hostname, proxy.port or 8080, timeout=request_timeout)
+        elif parsed.scheme == "https":
+            connection = http.client.HTTPSConnection(parsed.netloc, timeout=request_timeout)
+        else:
+            connection = http.client.HTTPConnection(parsed.netloc, timeout=request_timeout)
+        pool[key] = connection
+    return connection
+
+
+def drop_connection(url):
+    parsed = urlparse(url)
+    pool = getattr(connection_pool, "connections", {})
+    connection = pool.pop((parsed.scheme, parsed.netloc), None)
+    if connection is not None:
+        connection.close()
+
+
+def request(method, url, headers=None):
+    parsed = urlparse(url)
+    path = parsed.path or "/"
+    if parsed.query:
+        path += f"?{parsed.query}"
+    request_headers = {"User-Agent": user_agent}
+    if headers:
+        request_headers.update(headers)
+    if parsed.scheme == "http":
+        proxy = get_proxy(parsed)
+        if proxy is not None:
+            # plain HTTP proxies take the absolute URL
+            path = url
+            request_headers.update(get_proxy_headers(proxy))
+    # a pooled connection may have been closed by the server in the meantime, so retry once on a fresh one
+    for attempt in range(2):
+        connection = get_connection(url)
+        try:
+            connection.request(method, path, headers=request_headers)
+            return connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            drop_connection(url)
+            if attempt > 0:
+                raise
+
+
+def request_following_redirects(method, url, headers=None, strip_auth_on_redirect=True):
+    # Returns the response and the final URL. Credentials are not forwarded to other hosts, like signed storage URLs.
+    for _ in range(max_redirects + 1):
+        response = request(method, url, headers)
+        if response.status not in (301, 302, 303, 307, 308):
+            return response, url
+        location = response.getheader("Location")
+        response.read()
+        new_url = urljoin(url, location)
+        if strip_auth_on_redirect and headers and urlparse(new_url).netloc != urlparse(url).netloc:
+            headers = {key: value for key, value in headers.items() if key.lower() != "authorization"}
+        url = new_url
+    raise http.client.HTTPException(f"Too many redirects for {url}")
+
+
+def get_json(url, headers=None):
+    request_headers = {"Accept": "application/json"}
+    if headers:
+        request_headers.update(headers)
+    response, _ = request_following_redirects("GET", url, request_headers)
+    body = response.read()
+    if response.status != 200:
+        return response.status, None
+    return response.status, json.loads(body)
+
+
+def add_downloaded_bytes(count):
+    global bytes_downloaded
+    with bytes_downloaded_lock:
+        bytes_downloaded += count
+    pbperf.add("bytes_downloaded", count)
+
+
+def resolve_download(url, headers=None):
+    # Probe the final URL, the size and whether the server honors range requests, with a single request
+    request_headers = {"Range": "bytes=0-0"}
+    if headers:
+        request_headers.update(headers)
+    response, final_url = request_following_redirects("GET", url, request_headers)
+    if response.status == 206:
+        response.read()
+        content_range = response.getheader("Content-Range", "")
+        size = int(content_range.rsplit("/", 1)[1])
+        return final_url, size, True
+    if response.status == 200:
+        # the server ignored the range, don't download the whole file just to probe it
+        size = response.getheader("Content-Length")
+        response.close()
+        drop_connection(final_url)
+        return final_url, int(size) if size is not None else None, False
+    response.read()
+    raise http.client.HTTPException(f"Unexpected HTTP status {response.status} for {url}")
+
+
+def load_progress(progress_path, resume_key, size, chunk_size):
+    try:
+        with open(progress_path) as progress_file:
+            progress = json.load(progress_file)
+        if progress.get("key") == resume_key and progress.get("size") == size and progress.get("chunk_size") == chunk_size:
+            return set(progress.get("done", []))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        pblog.warning(f"Discarding download progress {progress_path}: {e}")
+    return set()
+
+
+def save_progress(progress_path, resume_key, size, chunk_size, done):
+    temp_path = f"{progress_path}.tmp"
+    with open(temp_path, "w") as progress_file:
+        json.dump({"key": resume_key, "size": size, "chunk_size": chunk_size, "done": sorted(done)}, progress_file)
+    os.replace(temp_path, progress_path)
+
+
+def download_range(url, part_path, start, end, headers=None):
+    request_headers = {"Range": f"bytes={start}-{end}"}
+    if headers:
+        request_headers.update(headers)
+    response = request("GET", url, request_headers)
+    if response.status != 206:
+        response.read()
+        raise http.client.HTTPException(f"Unexpected HTTP status {response.status} for range {start}-{end}")
+    received = 0
+    with open(part_path, "r+b") as part_file:
+        part_file.seek(start)
+        for block in iter(lambda: response.read(read_size), b""):
+            part_file.write(block)
+            received += len(block)
+            add_downloaded_bytes(len(block))
+    if received != end - start + 1:
+        raise http.client.IncompleteRead(b"", end - start + 1 - received)
+
+
+def download_stream(url, file_path, headers=None):
+    response, _ = request_following_redirects("GET", url, headers)
+    if response.status != 200:
+        response.read()
+        raise http.client.HTTPException(f"Unexpected HTTP status {response.status} for {url}")
+    with open(file_path, "wb") as target:
+        for block in iter(lambda: response.read(read_size), b""):
+            target.write(block)
+            add_downloaded_bytes(len(block))
+
+
+def download_file(url, file_path, headers=None, resume_key=None, connections=default_connections, chunk_size=default_chunk_size):
+    # Download url into file_path with parallel range requests. Progress is kept in a sidecar file, so an interrupted
+    # download resumes where it left off. resume_key identifies the remote file across runs, and defaults to the URL.
+    part_path = f"{file_path}.part"
+    progress_path = f"{file_path}.progress"
+    if resume_key is None:
+        resume_key = url
+
+    start_time = time.perf_counter()
+    start_bytes = bytes_downloaded
+    final_url, size, supports_ranges = resolve_download(url, headers)
+    # credentials are only meant for the original host, the redirect target is usually a signed URL
+    range_headers = headers
+    if urlparse(final_url).netloc != urlparse(url).netloc:
+        range_headers = None
+
+    if not supports_ranges or size is None:
+        pblog.info("Server does not support range requests, downloading in a single stream")
+        download_stream(final_url, part_path, range_headers)
+        os.replace(part_path, file_path)
+        if os.path.exists(progress_path):
+            pbtools.remove_file(progress_path)
+        return True
+
+    chunk_count = max(1, (size + chunk_size - 1) // chunk_size)
+    done = load_progress(progress_path, resume_key, size, chunk_size)
+    if not os.path.isfile(part_path) or os.path.getsize(part_path) != size:
+        done = set()
+        with open(part_path, "wb") as part_file:
+            part_file.truncate(size)
+    if done:
+        pblog.info(f"Resuming download, {len(done)} of {chunk_count} chunks are already complete")
+
+    progress_lock = threading.Lock()
+    resolve_lock = threading.Lock()
+    # the final URL is usually signed, and may expire during a long download
+    source = {"url": final_url, "headers": range_headers}
+
+    def resolve_again(failed_url):
+        with resolve_lock:
+            if source["url"] != failed_url:
+                # another chunk already resolved it again
+                return
+            new_url, new_size, new_supports_ranges = resolve_download(url, headers)
+            if new_size != size or not new_supports_ranges:
+                raise http.client.HTTPException(f"{url} changed during the download")
+            source["url"] = new_url
+            source["headers"] = headers if urlparse(new_url).netloc == urlparse(url).netloc else None
+
+    def download_chunk(index):
+        start = index * chunk_size
+        end = min(size, start + chunk_size) - 1
+        for attempt in range(max_chunk_retries):
+            chunk_url = source["url"]
+            try:
+                download_range(chunk_url, part_path, start, end, source["headers"])
+                break
+            except (http.client.HTTPException, OSError) as e:
+                drop_connection(chunk_url)
+                if attempt + 1 == max_chunk_retries:
+                    raise
+                pblog.warning(f"Retrying chunk {index} after error: {e}")
+                time.sleep(0.5 * (attempt + 1))
+                try:
+                    resolve_again(chunk_url)
+                except (http.client.HTTPException, OSError) as resolve_error:
+                    pblog.warning(f"Could not resolve {url} again: {resolve_error}")
+        with progress_lock:
+            done.add(index)
+            save_progress(progress_path, resume_key, size, chunk_size, done)
+
+    pending = [index for index in range(chunk_count) if index not in done]
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            for _ in executor.map(download_chunk, pending):
+                pass
+    except Exception as e:
+        pblog.exception(str(e))
+        pblog.error(f"Download of {file_path} was interrupted, it will be resumed on the next run")
+        return False
+
+    os.replace(part_path, file_path)
+    pbtools.remove_file(progress_path)
+
+    elapsed = time.perf_counter() - start_time
+    received = bytes_downloaded - start_bytes
+    throughput = received / elapsed / (1000 * 1000) if elapsed > 0 else 0
+    pblog.info(f"Downloaded {received / (1000 * 1000):.1f}MB of {size / (1000 * 1000):.1f}MB in {elapsed:.2f}s ({throughput:.1f}MB/s)")
+    return True
+
+
+def has_partial_download(file_path):
+    # Whether an interrupted download_file can be resumed
+    return os.path.isfile(f"{file_path}.part") and os.path.isfile(f"{file_path}.progress")
+
+
+def discard_partial_download(file_path):
+    for path in (f"{file_path}.part", f"{file_path}.progress"):
+        if os.path.exists(path):
+            pbtools.remove_file(path)
+
+
+def discard_download(file_path):
+    # Remove partial download state, e.g. after the downloaded file failed verification
+    if os.path.exists(file_path):
+        pbtools.remove_file(file_path)
+    discard_partial_download(file_path)
@@ -12,7 +12,7 @@ max_log_size = 5 * 1000 * 1000
 root_log = None
 
 
-def setup_logger(log_file_path):
+def setup_logger(log_file_path, verbose=False):
     # If log file is big enough, remove it
     if os.path.isfile(log_file_path) and os.path.getsize(log_file_path) >= max_log_size:
         pbtools.remove_file(log_file_path)
@@ -33,8 +33,8 @@ def setup_logger(log_file_path):
     file_handler.setFormatter(log_formatter)
     root_log.addHandler(file_handler)
 
-    # Log level
-    log_level = logging.INFO
+    # Log level, debug messages carry detailed timings
+    log_level = logging.DEBUG if verbose else logging.INFO
     root_log.setLevel(log_level)
 
     # Colored logs
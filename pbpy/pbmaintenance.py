@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import datetime
+
+from pbpy import pbconfig
+from pbpy import pblog
+from pbpy import pbtools
+from pbpy import pbgit
+
+# Repository maintenance runs in a background PBSync process, and only the tasks which are due.
+# The last successful run of every task is recorded in the state file inside the git directory.
+maintenance_state_name = "pbsync_maintenance.json"
+maintenance_lock_file = ".pbsync_maintenance_lock"
+day_seconds = 24 * 60 * 60
+
+# Thresholds, each one can be overridden in the [maintenance] section of the user config
+default_thresholds = {
+    "loose_objects": 1000,
+    "packs": 20,
+    "gc_days": 14,
+    "commit_graph_days": 1,
+    "lfs_prune_days": 7,
+    "lfs_dedup_days": 30
+}
+
+maintenance_tasks = ["unshallow", "gc", "commit-graph", "lfs-prune", "lfs-dedup"]
+
+
+def get_threshold(name):
+    return pbconfig.get_user_config().getfloat("maintenance", name, fallback=default_thresholds[name])
+
+
+def get_state_path():
+    return os.path.join(pbgit.get_git_dir(), maintenance_state_name)
+
+
+def get_state():
+    try:
+        with open(get_state_path()) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        pblog.warning(f"Discarding maintenance state: {e}")
+    return {}
+
+
+def save_state(state):
+    state_path = get_state_path()
+    temp_path = f"{state_path}.tmp"
+    try:
+        with open(temp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, state_path)
+    except Exception as e:
+        pblog.exception(str(e))
+
+
+def mark_due(task):
+    # Forget the last run of a task, so it runs with the next maintenance
+    state = get_state()
+    if state.pop(task, None) is not None:
+        save_state(state)
+
+
+def get_object_counts():
+    # git count-objects -v reports "key: value" lines, like count (loose objects) and packs
+    proc = pbtools.run_with_output([pbgit.get_git_executable(), "count-objects", "-v"])
+    counts = {}
+    if proc.returncode != 0:
+        return counts
+    for line in proc.stdout.splitlines():
+        key, _, value = line.partition(":")
+        try:
+            counts[key.strip()] = int(value)
+        except ValueError:
+            continue
+    return counts
+
+
+def get_days_since(state, task):
+    last_run = state.get(task)
+    if last_run is None:
+        return None
+    return (time.time() - last_run) / day_seconds
+
+
+def describe_last_run(days):
+    return "never ran" if days is None else f"last ran {days:.1f} days ago"
+
+
+def is_interval_due(days, interval):
+    return days is None or days >= interval
+
+
+def get_due_tasks():
+    # Decide which tasks are due, and log the reasoning for every task
+    state = get_state()
+    counts = get_object_counts()
+    due = []
+
+    def decide(task, is_due, reason):
+        pblog.info(f"Maintenance task {task}: {'due' if is_due else 'skipped'} ({reason})")
+        if is_due:
+            due.append(task)
+
+    if pbgit.get_repo_info()["is_shallow"]:
+        decide("unshallow", True, "shallow clone")
+
+    loose_objects = counts.get("count", 0)
+    packs = counts.get("packs", 0)
+    days = get_days_since(state, "gc")
+    gc_due = loose_objects >= get_threshold("loose_objects") or packs >= get_threshold("packs") or is_interval_due(days, get_threshold("gc_days"))
+    decide("gc", gc_due, f"{loose_objects} loose objects, {packs} packs, {describe_last_run(days)}")
+
+    days = get_days_since(state, "commit-graph")
+    # a repack rewrites the commit graph too, so update it along with gc
+    decide("commit-graph", gc_due or is_interval_due(days, get_threshold("commit_graph_days")), describe_last_run(days))
+
+    for task, threshold in (("lfs-prune", "lfs_prune_days"), ("lfs-dedup", "lfs_dedup_days")):
+        days = get_days_since(state, task)
+        decide(task, is_interval_due(days, get_threshold(threshold)), describe_last_run(days))
+
+    return due
+
+
+def get_task_commands(task):
+    git = pbgit.get_git_executable()
+    lfs = pbgit.get_lfs_executable()
+    if task == "unshallow":
+        command = [git, "fetch", "--unshallow"]
+        # keep a partial clone partial, instead of downloading every blob of the history
+        partial_clone_filter = pbgit.get_config_value("remote.origin.partialclonefilter")
+        if partial_clone_filter:
+            command.append(f"--filter={partial_clone_filter}")
+        return [command]
+    if task == "gc":
+        command = [git, "maintenance", "run", "--task", "gc", "--task", "loose-objects"]
+        # if we use multi-pack index, take advantage of it
+        if pbgit.get_config_value("core.multipackIndex") == "true":
+            command.extend(["--task", "incremental-repack"])
+        return [command]
+    if task == "commit-graph":
+        # try to remove a leftover commit graph lock before writing the commit graph
+        commit_graph_lock = os.path.join(pbgit.get_git_dir(), "objects", "info", "commit-graphs", "commit-graph-chain.lock")
+        try:
+            if os.path.exists(commit_graph_lock):
+                os.remove(commit_graph_lock)
+        except Exception as e:
+            pblog.exception(str(e))
+            return None
+        expire_date = (datetime.datetime.now() - datetime.timedelta(days=7)).strftime("%x")
+        return [[git, "commit-graph", "write", "--split", "--size-multiple=4", "--reachable", "--changed-paths", f"--expire-time={expire_date}"]]
+    if task == "lfs-prune":
+        return [[lfs, "prune", "-c"]]
+    if task == "lfs-dedup":
+        return [[lfs, "dedup"]]
+    return None
+
+
+def start(config_path):
+    # Launch a background PBSync process for the due tasks
+    tasks = get_due_tasks()
+    if not tasks:
+        pblog.info("No repository maintenance is due")
+        return
+    pblog.info("Starting repo maintenance...")
+    pbtools.run_non_blocking(pbtools.get_self_command("--config", config_path, "--maintenance", ",".join(tasks)))
+
+
+def run_tasks(tasks):
+    if not pbtools.acquire_lock("maintenance", path=maintenance_lock_file):
+        pblog.info("Repository maintenance is already running, skipping")
+        return False
+    try:
+        pbtools.lower_process_priority()
+        # run in the usual order, so everything else can clean up after the unshallow fetch
+        for task in sorted(tasks, key=maintenance_tasks.index):
+            commands = get_task_commands(task)
+            if commands is None:
+                pblog.warning(f"Skipping maintenance task {task}")
+                continue
+            start_time = time.perf_counter()
+            if all(pbtools.run(command).returncode == 0 for command in commands):
+                state = get_state()
+                state[task] = time.time()
+                save_state(state)
+                pblog.info(f"Maintenance task {task} finished in {time.perf_counter() - start_time:.1f}s")
+            else:
+                pblog.error(f"Maintenance task {task} failed")
+    finally:
+        pbtools.release_lock(maintenance_lock_file)
+    return True
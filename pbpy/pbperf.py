@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import platform
+import threading
+import contextlib
+import cProfile
+
+from pbpy import pblog
+
+# Run-wide counters, each phase reports how much they grew while it was running
+counter_names = ["processes", "bytes_downloaded", "bytes_fetched", "bytes_hashed"]
+counters = dict.fromkeys(counter_names, 0)
+counters_lock = threading.Lock()
+
+phases = []
+run_start = time.perf_counter()
+profiler = None
+
+
+def add(counter, value=1):
+    with counters_lock:
+        counters[counter] = counters.get(counter, 0) + value
+
+
+@contextlib.contextmanager
+def phase(name):
+    with counters_lock:
+        start_counters = dict(counters)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with counters_lock:
+            deltas = {counter: counters[counter] - start_counters.get(counter, 0) for counter in counters}
+        phases.append({"name": name, "wall_time": round(elapsed, 3), **deltas})
+        pblog.debug(f"Phase {name} took {elapsed:.2f}s")
+
+
+def get_summary(command=None):
+    with counters_lock:
+        totals = dict(counters)
+    return {
+        "command": command,
+        "total_time": round(time.perf_counter() - run_start, 3),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count()
+        },
+        "phases": phases,
+        "totals": totals
+    }
+
+
+def write_summary(command=None):
+    # Written as a single JSON line at the end of the log, so runs can be compared across machines
+    pblog.info(f"Run summary: {json.dumps(get_summary(command))}")
+
+
+def start_profiling():
+    global profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+
+def stop_profiling(profile_path):
+    if profiler is None:
+        return
+    profiler.disable()
+    try:
+        profiler.dump_stats(profile_path)
+        pblog.info(f"Profiling data is saved in {profile_path}")
+    except Exception as e:
+        pblog.exception(str(e))
@@ -0,0 +1,218 @@
+import os
+import sys
+import hmac
+import json
+import time
+import hashlib
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlparse, parse_qs, quote
+
+# Local stand-in for the remote services PBSync talks to, so transfers can be tested and benchmarked offline.
+#
+# Releases are served from a directory laid out as <root>/<tag>/<asset name>, through the same routes as the
+# GitHub API: /repos/<owner>/<repo>/releases/tags/<tag> and /repos/<owner>/<repo>/releases/assets/<tag>/<name>.
+# Any other file under <root> is served from /files/<path>. All file downloads support range requests.
+# Like GitHub, asset downloads are redirected to a signed URL, which expires after server.signed_url_lifetime seconds.
+# Every GET is recorded in server.requests as a (path, Range header) pair.
+#
+# Git LFS objects are served from <root>/lfs/objects/<oid>, through the batch API of any repository URL:
+# <remote>/info/lfs/objects/batch. A slower link can be emulated with server.latency (seconds added to every
+# request) and server.connection_rate (bytes per second for a single connection). The object count of every batch
+# request is recorded in server.batch_sizes.
+
+copy_buffer_size = 1024 * 1024
+lfs_content_type = "application/vnd.git-lfs+json"
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, content_type="application/json"):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def get_local_path(self, relative_path):
+        root = os.path.abspath(self.server.root)
+        path = os.path.abspath(os.path.join(root, relative_path))
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            return None
+        return path
+
+    def send_file(self, path):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            range_start, range_end = range_header[len("bytes="):].split(",")[0].split("-")
+            if range_start:
+                start = int(range_start)
+                end = min(int(range_end), size - 1) if range_end else size - 1
+            else:
+                start = max(0, size - int(range_end))
+            if start > end:
+                self.send_empty(416, {"Content-Range": f"bytes */{size}"})
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        rate = self.server.connection_rate
+        block_size = max(1, min(copy_buffer_size, rate // 10)) if rate else copy_buffer_size
+        with open(path, "rb") as source:
+            source.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = source.read(min(block_size, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+                if rate:
+                    time.sleep(len(block) / rate)
+
+    def delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_POST(self):
+        self.delay()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlparse(self.path).path.endswith("/info/lfs/objects/batch"):
+            self.send_lfs_batch(json.loads(body))
+        else:
+            self.send_empty(404)
+
+    def send_lfs_batch(self, batch):
+        if batch.get("operation") != "download":
+            self.send_json({"message": "Only downloads are supported"}, 422, lfs_content_type)
+            return
+        objects = []
+        with self.server.batch_lock:
+            self.server.batch_sizes.append(len(batch.get("objects", [])))
+        for lfs_object in batch.get("objects", []):
+            oid = lfs_object.get("oid", "")
+            entry = {"oid": oid, "size": lfs_object.get("size")}
+            if not oid.isalnum() or self.get_local_path(os.path.join("lfs", "objects", oid)) is None:
+                entry["error"] = {"code": 404, "message": "Object does not exist"}
+            else:
+                entry["authenticated"] = True
+                entry["actions"] = {"download": {"href": f"{self.server.url}/files/lfs/objects/{oid}", "expires_in": 3600}}
+            objects.append(entry)
+        self.send_json({"transfer": "basic", "objects": objects}, content_type=lfs_content_type)
+
+    def do_GET(self):
+        self.delay()
+        with self.server.requests_lock:
+            self.server.requests.append((self.path, self.headers.get("Range")))
+        parsed = urlparse(self.path)
+        parts = [unquote(part) for part in parsed.path.split("/") if part]
+        if len(parts) > 1 and parts[0] == "files":
+            path = self.get_local_path(os.path.join(*parts[1:]))
+            if path is None:
+                self.send_empty(404)
+            elif not is_valid_signature(self.server, parsed.path, parse_qs(parsed.query)):
+                self.send_empty(403)
+            else:
+                self.send_file(path)
+        elif len(parts) == 6 and parts[0] == "repos" and parts[3:5] == ["releases", "tags"]:
+            self.send_release(parts[1], parts[2], parts[5])
+        elif len(parts) == 7 and parts[0] == "repos" and parts[3:5] == ["releases", "assets"]:
+            # like GitHub, redirect asset downloads to another location
+            self.send_empty(302, {"Location": get_signed_path(self.server, f"/files/{quote(parts[5])}/{quote(parts[6])}")})
+        else:
+            self.send_empty(404)
+
+    def send_release(self, owner, repo, tag):
+        release_dir = os.path.join(self.server.root, tag)
+        if "/" in tag or "\\" in tag or tag.startswith(".") or not os.path.isdir(release_dir):
+            self.send_json({"message": "Not Found"}, 404)
+            return
+        assets = []
+        for i, name in enumerate(sorted(os.listdir(release_dir))):
+            path = os.path.join(release_dir, name)
+            if not os.path.isfile(path):
+                continue
+            assets.append({
+                "id": i,
+                "name": name,
+                "size": os.path.getsize(path),
+                "url": f"{self.server.url}/repos/{owner}/{repo}/releases/assets/{tag}/{name}"
+            })
+        self.send_json({"tag_name": tag, "assets": assets})
+
+
+def get_signature(server, path, expires):
+    return hmac.new(server.signing_key, f"{path}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def get_signed_path(server, path):
+    expires = time.time() + server.signed_url_lifetime
+    return f"{path}?expires={expires}&signature={get_signature(server, path, expires)}"
+
+
+def is_valid_signature(server, path, query):
+    # files can be downloaded without a signature, but a signed URL has to be valid
+    if "signature" not in query:
+        return True
+    expires = query.get("expires", [""])[0]
+    if not hmac.compare_digest(query["signature"][0], get_signature(server, path, expires)):
+        return False
+    try:
+        return time.time() < float(expires)
+    except ValueError:
+        return False
+
+
+def start_server(root, port=0, latency=0, connection_rate=None, signed_url_lifetime=3600):
+    # Serve root in a background thread. The server URL is available as server.url.
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInRequestHandler)
+    server.daemon_threads = True
+    server.root = root
+    server.latency = latency
+    server.connection_rate = connection_rate
+    server.batch_sizes = []
+    server.signed_url_lifetime = signed_url_lifetime
+    server.signing_key = os.urandom(16)
+    server.requests = []
+    server.requests_lock = threading.Lock()
+    server.batch_lock = threading.Lock()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    root = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    server = start_server(root, port)
+    print(f"Serving {root} at {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stop_server(server)
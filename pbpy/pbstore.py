@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import shutil
+
+from pathlib import Path
+
+from pbpy import pbconfig
+from pbpy import pblog
+from pbpy import pbtools
+
+# Content addressed store for binaries, shared between project versions and keyed by MD5
+store_index_name = "index.json"
+default_store_size_gb = 20
+
+store_index = None
+
+
+def is_enabled():
+    return pbconfig.get_user_config().getboolean("binaries", "cache", fallback=True)
+
+
+def get_store_root():
+    root = pbconfig.get_user("binaries", "cache_dir")
+    if root is None:
+        base = os.getenv("LOCALAPPDATA") or str(Path.home() / ".cache")
+        root = str(Path(base) / "PBSync" / "binaries")
+    return root
+
+
+def get_store_max_size():
+    size_gb = pbconfig.get_user_config().getfloat("binaries", "cache_size_gb", fallback=default_store_size_gb)
+    return int(size_gb * 1000 * 1000 * 1000)
+
+
+def get_object_path(object_hash):
+    return os.path.join(get_store_root(), object_hash[:2], object_hash)
+
+
+def get_index():
+    # MD5 -> last time the object was used, for LRU eviction
+    global store_index
+    if store_index is None:
+        store_index = {}
+        try:
+            with open(os.path.join(get_store_root(), store_index_name)) as index_file:
+                store_index = json.load(index_file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            pblog.warning(f"Discarding binaries cache index: {e}")
+    return store_index
+
+
+def save_index():
+    if store_index is None:
+        return
+    index_path = os.path.join(get_store_root(), store_index_name)
+    temp_path = f"{index_path}.tmp"
+    try:
+        os.makedirs(get_store_root(), exist_ok=True)
+        with open(temp_path, "w") as index_file:
+            json.dump(store_index, index_file, separators=(",", ":"))
+        os.replace(temp_path, index_path)
+    except Exception as e:
+        pblog.exception(str(e))
+
+
+def get_temp_path(target):
+    target_dir = os.path.dirname(target)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    temp_path = f"{target}.pbsync_tmp"
+    if os.path.lexists(temp_path):
+        pbtools.remove_file(temp_path)
+    return temp_path
+
+
+def link_file(source, target, copy_fallback=True):
+    # Hardlink if possible, copy otherwise (e.g. different volumes). The final rename is atomic.
+    # Returns whether a link was made. Without copy_fallback, a failed link raises and the target is left alone.
+    temp_path = get_temp_path(target)
+    try:
+        os.link(source, temp_path)
+        linked = True
+    except OSError:
+        if not copy_fallback:
+            raise
+        shutil.copy2(source, temp_path)
+        linked = False
+    os.replace(temp_path, target)
+    return linked
+
+
+def copy_file(source, target):
+    # An independent copy, for files which may be changed in place. The final rename is atomic.
+    temp_path = get_temp_path(target)
+    shutil.copy2(source, temp_path)
+    os.replace(temp_path, target)
+
+
+def remove_object(object_hash):
+    pbtools.remove_file(get_object_path(object_hash))
+    pbtools.invalidate_hash_cache([get_object_path(object_hash)])
+    get_index().pop(object_hash, None)
+
+
+def has_object(object_hash):
+    object_path = get_object_path(object_hash)
+    if not os.path.isfile(object_path):
+        get_index().pop(object_hash, None)
+        return False
+    # objects are hardlinked into workspaces, so make sure nothing wrote through a link since we stored it
+    if pbtools.get_md5_hash(object_path) != object_hash:
+        pblog.warning(f"Binaries cache object {object_hash} is corrupted, removing it")
+        remove_object(object_hash)
+        return False
+    return True
+
+
+def checkout(files):
+    # Populate files from the store. files is a path -> MD5 mapping. Returns the paths the store could not provide.
+    missing = []
+    now = time.time()
+    index = get_index()
+    for file_path, object_hash in files.items():
+        if os.path.isfile(file_path) and pbtools.get_md5_hash(file_path) == object_hash:
+            if object_hash in index:
+                index[object_hash] = now
+            continue
+        if not has_object(object_hash):
+            missing.append(file_path)
+            continue
+        try:
+            link_file(get_object_path(object_hash), file_path)
+            index[object_hash] = now
+        except Exception as e:
+            pblog.exception(str(e))
+            missing.append(file_path)
+    save_index()
+    pbtools.save_hash_cache()
+    return missing
+
+
+def add(files):
+    # Store verified files. files is a path -> MD5 mapping.
+    now = time.time()
+    index = get_index()
+    for file_path, object_hash in files.items():
+        index[object_hash] = now
+        if os.path.isfile(get_object_path(object_hash)):
+            continue
+        try:
+            link_file(file_path, get_object_path(object_hash))
+        except Exception as e:
+            pblog.exception(str(e))
+            index.pop(object_hash, None)
+    evict()
+    save_index()
+
+
+def evict():
+    index = get_index()
+    sizes = {}
+    for object_hash in list(index):
+        try:
+            sizes[object_hash] = os.path.getsize(get_object_path(object_hash))
+        except OSError:
+            index.pop(object_hash)
+    total_size = sum(sizes.values())
+    max_size = get_store_max_size()
+    if total_size <= max_size:
+        return
+    evicted = 0
+    # least recently used objects go first
+    for object_hash in sorted(sizes, key=lambda object_hash: index[object_hash]):
+        if total_size <= max_size:
+            break
+        remove_object(object_hash)
+        total_size -= sizes[object_hash]
+        evicted += 1
+    pblog.info(f"Evicted {evicted} objects from the binaries cache, {total_size / (1000 * 1000):.1f}MB remaining")
+
+
+def clean():
+    global store_index
+    root = get_store_root()
+    store_index = None
+    if not os.path.isdir(root):
+        return True
+    pblog.info(f"Removing binaries cache at {root}...")
+    try:
+        shutil.rmtree(root)
+    except Exception as e:
+        pblog.exception(str(e))
+        return False
+    return True
@@ -6,10 +6,11 @@ import subprocess
 import shutil
 import stat
 import json
-import datetime
+import threading
+import shlex
 
 from hashlib import md5
-from subprocess import CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # PBSync Imports
@@ -17,32 +18,266 @@ from pbpy import pbconfig
 from pbpy import pblog
 from pbpy import pbgit
 from pbpy import pbunreal
+from pbpy import pbperf
+from pbpy import pbmaintenance
 
 error_file = ".pbsync_err"
+# held by any PBSync process working on the repository, so background prefetches never collide with a sync
+lock_file = ".pbsync_lock"
+lock_write_grace_seconds = 10
+hash_chunk_size = 1024 * 1024
+hash_max_workers = min(32, (os.cpu_count() or 1) + 4)
+# hash cache is stored next to the error file, and keyed by file path and stat information
+hash_cache_file = ".pbsync_hash_cache"
+hash_cache_version = 1
+# files modified this recently may still change within the same mtime tick, so they are never cached
+hash_cache_racy_seconds = 2
+
+# cache file -> entries. Files under a root added with add_hash_cache_root are cached in a file in that root.
+hash_caches = {}
+hash_cache_roots = []
+dirty_hash_caches = set()
+pruned_hash_caches = set()
+hash_cache_lock = threading.Lock()
+
+owned_locks = set()
+process_env = None
+resolved_executables = {}
+process_stats = []
+process_stats_lock = threading.Lock()
+
+
+def read_lock(path=lock_file):
+    try:
+        with open(path) as lock:
+            return json.load(lock)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # partially written, or not ours
+        return {}
 
 
-def run(cmd, env=None):
-    if env is None:
-        env = os.environ
+def take_over_lock(owner, holder, path=lock_file):
+    # Replace a stale lock in one step, so a process which takes it at the same time never loses its fresh lock
+    if read_lock(path) != holder:
+        return False
+    temp_path = f"{path}.{os.getpid()}"
+    try:
+        with open(temp_path, "w") as lock:
+            json.dump({"pid": os.getpid(), "owner": owner}, lock)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+    # another process taking over the same stale lock may have replaced it after us
+    holder = read_lock(path)
+    return holder is not None and holder.get("pid") == os.getpid()
+
+
+def acquire_lock(owner, timeout=0, path=lock_file):
+    # Take the repository lock, waiting up to timeout seconds for another PBSync process to release it.
+    # Locks of processes which are not running anymore are taken over.
+    if path in owned_locks:
+        return True
+    deadline = time.monotonic() + timeout
+    waiting = False
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            holder = read_lock(path)
+            if holder is None:
+                # released in the meantime
+                continue
+            pid = holder.get("pid")
+            if isinstance(pid, int):
+                stale = not psutil.pid_exists(pid)
+            else:
+                # give a process which is still writing the lock a moment
+                try:
+                    stale = time.time() - os.path.getmtime(path) > lock_write_grace_seconds
+                except OSError:
+                    continue
+            if stale:
+                pblog.info(f"Taking over stale lock of {holder.get('owner', 'an unknown process')}")
+                if take_over_lock(owner, holder, path):
+                    owned_locks.add(path)
+                    return True
+                # taken by another process, which is waited for like any other holder
+                holder = read_lock(path) or {}
+                pid = holder.get("pid")
+            if time.monotonic() >= deadline:
+                return False
+            if not waiting:
+                pblog.info(f"Waiting for {holder.get('owner')} (process {pid}) to finish...")
+                waiting = True
+            time.sleep(1)
+            continue
+        with os.fdopen(fd, "w") as lock:
+            json.dump({"pid": os.getpid(), "owner": owner}, lock)
+        owned_locks.add(path)
+        return True
+
+
+def release_lock(path=lock_file):
+    if path not in owned_locks:
+        return
+    owned_locks.discard(path)
+    holder = read_lock(path)
+    if holder is not None and holder.get("pid") == os.getpid():
+        remove_file(path)
+
+
+def lower_process_priority():
+    # Child processes inherit the priority, so background work stays out of the way of the editor and the user
+    try:
+        process = psutil.Process()
+        if os.name == "nt":
+            process.nice(psutil.IDLE_PRIORITY_CLASS)
+            process.ionice(psutil.IOPRIO_VERYLOW)
+        else:
+            process.nice(19)
+            process.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (psutil.Error, AttributeError, OSError) as e:
+        pblog.warning(f"Could not lower process priority: {e}")
+
+
+def get_self_command(*args):
+    # Command line which launches this PBSync again with the given arguments, for run_non_blocking
+    if getattr(sys, "frozen", False):
+        cmd = [sys.executable, *args]
     else:
-        env = os.environ | env
-    return subprocess.run(cmd, shell=True, env=env)
+        cmd = [sys.executable, os.path.abspath(sys.argv[0]), *args]
+    if os.name == "nt":
+        return subprocess.list2cmdline(cmd)
+    return shlex.join(cmd)
 
 
-def run_with_output(cmd, env=None):
+def get_env(env=None):
+    # The base environment is prepared once, and only merged when a command needs extra variables
+    global process_env
+    if process_env is None:
+        process_env = dict(os.environ)
     if env is None:
-        env = os.environ
-    else:
-        env = os.environ | env
-    return subprocess.run(cmd, capture_output=True, text=True, shell=True, env=env)
+        return process_env
+    return process_env | env
+
+
+def resolve_executable(executable):
+    # Resolve the program once, so scripts like .cmd files on Windows can be started without a shell
+    resolved = resolved_executables.get(executable)
+    if resolved is None:
+        resolved = shutil.which(executable) or executable
+        resolved_executables[executable] = resolved
+    return resolved
+
+
+def record_process(cmd, elapsed, returncode):
+    pbperf.add("processes")
+    with process_stats_lock:
+        process_stats.append((os.path.basename(cmd[0]), elapsed, returncode))
+    pblog.debug(f"{' '.join(cmd)} exited with {returncode} in {elapsed:.3f}s")
+
+
+def log_process_stats():
+    if not process_stats:
+        return
+    total_time = sum(elapsed for _, elapsed, _ in process_stats)
+    pblog.info(f"Ran {len(process_stats)} child processes in {total_time:.2f}s")
+    per_program = {}
+    for program, elapsed, _ in process_stats:
+        count, program_time = per_program.get(program, (0, 0))
+        per_program[program] = (count + 1, program_time + elapsed)
+    for program, (count, program_time) in sorted(per_program.items(), key=lambda item: -item[1][1]):
+        pblog.debug(f"{program}: {count} processes, {program_time:.2f}s")
+
+
+def run_process(cmd, env=None, output=None, input=None, stream=False, on_output=None):
+    # Single execution path for every child process. Arguments are passed directly to the program, without a shell.
+    # output: None to inherit the console, "separate" to capture stdout and stderr, "combined" to merge them.
+    # stream: log output lines through pblog while the command is running, and capture them combined.
+    # on_output: called with every chunk of output as soon as it arrives, e.g. for progress without line breaks.
+    # The output is captured combined.
+    cmd = [str(arg) for arg in cmd]
+    cmd[0] = resolve_executable(cmd[0])
+    start = time.perf_counter()
+    try:
+        if stream:
+            lines = []
+            with subprocess.Popen(cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE if input is not None else None, env=get_env(env)) as proc:
+                if input is not None:
+                    proc.stdin.write(input)
+                    proc.stdin.close()
+                for line in proc.stdout:
+                    lines.append(line)
+                    pblog.info(line.rstrip())
+            result = subprocess.CompletedProcess(cmd, proc.returncode, "".join(lines), None)
+        elif on_output is not None:
+            chunks = []
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=get_env(env)) as proc:
+                for data in iter(lambda: os.read(proc.stdout.fileno(), 4096), b""):
+                    chunk = data.decode(errors="replace")
+                    chunks.append(chunk)
+                    on_output(chunk)
+            result = subprocess.CompletedProcess(cmd, proc.returncode, "".join(chunks), None)
+        elif output == "separate":
+            result = subprocess.run(cmd, text=True, capture_output=True, input=input, env=get_env(env))
+        elif output == "combined":
+            result = subprocess.run(cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, input=input, env=get_env(env))
+        else:
+            result = subprocess.run(cmd, text=True, input=input, env=get_env(env))
+    except OSError as e:
+        # report a missing program like a shell would, instead of raising
+        message = f"{cmd[0]}: {e}"
+        if output == "separate":
+            result = subprocess.CompletedProcess(cmd, 1, "", message)
+        elif output == "combined" or stream or on_output is not None:
+            result = subprocess.CompletedProcess(cmd, 1, message, None)
+        else:
+            pblog.error(message)
+            result = subprocess.CompletedProcess(cmd, 1)
+    record_process(cmd, time.perf_counter() - start, result.returncode)
+    return result
+
+
+def run(cmd, env=None):
+    return run_process(cmd, env=env)
+
+
+def run_with_output(cmd, env=None):
+    return run_process(cmd, env=env, output="separate")
 
 
 def run_with_combined_output(cmd, env=None):
-    if env is None:
-        env = os.environ
-    else:
-        env = os.environ | env
-    return subprocess.run(cmd, text=True, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    return run_process(cmd, env=env, output="combined")
+
+
+def run_concurrently(tasks):
+    # Run independent callables on a thread pool. tasks is a name -> callable mapping.
+    # Returns name -> result and name -> wall time mappings. Exceptions are raised from the first failing task.
+    def timed(task):
+        start = time.perf_counter()
+        result = task()
+        return result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {name: executor.submit(timed, task) for name, task in tasks.items()}
+        results = {}
+        timings = {}
+        for name, future in futures.items():
+            results[name], timings[name] = future.result()
+    elapsed = time.perf_counter() - start
+    if timings:
+        slowest = max(timings, key=timings.get)
+        pblog.info(f"Ran {len(tasks)} checks in {elapsed:.2f}s, slowest was {slowest} ({timings[slowest]:.2f}s)")
+        for name, task_time in timings.items():
+            pblog.debug(f"{name}: {task_time:.2f}s")
+    return results, timings
 
 
 def run_non_blocking(*commands):
@@ -78,10 +313,9 @@ def whereis(app):
     if os.name != "nt":
         command = 'which'
 
-    try:
-        result = subprocess.run(f"{command} {app}", text=True, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
-    except CalledProcessError:
-        pass
+    proc = run_process([command, app], output="separate")
+    if proc.returncode == 0:
+        result = proc.stdout
 
     if result is None:
         return []
@@ -90,20 +324,177 @@ def whereis(app):
     return [Path(line) for line in result if len(line)]
 
 
-def get_md5_hash(file_path):
+def is_hash_cache_enabled():
+    return pbconfig.get("use_hash_cache")
+
+
+def add_hash_cache_root(root):
+    # Keep the hashes of the files under root, e.g. of the engine installs, in root instead of the repository
+    root = get_hash_cache_key(root)
+    with hash_cache_lock:
+        if root not in hash_cache_roots:
+            hash_cache_roots.append(root)
+
+
+def get_hash_cache_file(cache_key):
+    for root in hash_cache_roots:
+        if cache_key.startswith(os.path.join(root, "")):
+            return os.path.join(root, hash_cache_file)
+    return hash_cache_file
+
+
+def get_hash_cache(cache_file=hash_cache_file):
+    # loaded once, under the lock, since the hashing threads all start with an empty cache
+    with hash_cache_lock:
+        cache = hash_caches.get(cache_file)
+        if cache is None:
+            cache = {}
+            try:
+                with open(cache_file) as cache_file_handle:
+                    data = json.load(cache_file_handle)
+                if data.get("version") == hash_cache_version:
+                    cache = data.get("entries", {})
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                # a corrupted cache is simply rebuilt
+                pblog.warning(f"Discarding hash cache {cache_file}: {e}")
+            hash_caches[cache_file] = cache
+        return cache
+
+
+def is_hash_cache_entry_valid(cache_key, entry):
+    try:
+        return entry[:3] == get_file_stat_key(os.stat(cache_key))
+    except OSError:
+        return False
+
+
+def prune_hash_cache(cache_file):
+    # Drop the entries of files which were deleted or changed since they were hashed, they can't be hit anymore.
+    # Done once per run for every cache, it stats every cached file.
+    with hash_cache_lock:
+        entries = list(hash_caches[cache_file].items())
+        pruned_hash_caches.add(cache_file)
+    invalid = [(cache_key, entry) for cache_key, entry in entries if not is_hash_cache_entry_valid(cache_key, entry)]
+    if not invalid:
+        return
+    with hash_cache_lock:
+        cache = hash_caches[cache_file]
+        for cache_key, entry in invalid:
+            if cache.get(cache_key) is entry:
+                del cache[cache_key]
+        dirty_hash_caches.add(cache_file)
+    pblog.debug(f"Pruned {len(invalid)} entries of hash cache {cache_file}")
+
+
+def save_hash_cache():
+    with hash_cache_lock:
+        unpruned = [cache_file for cache_file in hash_caches if cache_file not in pruned_hash_caches]
+    for cache_file in unpruned:
+        prune_hash_cache(cache_file)
+    with hash_cache_lock:
+        cache_files = list(dirty_hash_caches)
+    for cache_file in cache_files:
+        with hash_cache_lock:
+            dirty_hash_caches.discard(cache_file)
+            data = {"version": hash_cache_version, "entries": dict(hash_caches[cache_file])}
+        temp_path = f"{cache_file}.tmp"
+        try:
+            with open(temp_path, "w") as cache_file_handle:
+                json.dump(data, cache_file_handle, separators=(",", ":"))
+            os.replace(temp_path, cache_file)
+        except Exception as e:
+            pblog.exception(str(e))
+            remove_file(temp_path)
+
+
+def invalidate_hash_cache(file_paths=None):
+    # Invalidate the given files, or every cache if no files are given
+    if file_paths is None:
+        get_hash_cache()
+        with hash_cache_lock:
+            for cache_file, cache in hash_caches.items():
+                cache.clear()
+                dirty_hash_caches.add(cache_file)
+        return
+    for file_path in file_paths:
+        cache_key = get_hash_cache_key(file_path)
+        cache_file = get_hash_cache_file(cache_key)
+        cache = get_hash_cache(cache_file)
+        with hash_cache_lock:
+            cache.pop(cache_key, None)
+            dirty_hash_caches.add(cache_file)
+
+
+def get_hash_cache_key(file_path):
+    return os.path.normcase(os.path.abspath(file_path))
+
+
+def get_file_stat_key(file_stat):
+    # st_ino is the file index on Windows, so this works for both NTFS and POSIX file systems
+    return [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+
+
+def get_cached_md5_hash(file_path):
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    cache_key = get_hash_cache_key(file_path)
+    entry = get_hash_cache(get_hash_cache_file(cache_key)).get(cache_key)
+    if entry is not None and entry[:3] == get_file_stat_key(file_stat):
+        return entry[3]
+    return None
+
+
+def set_cached_md5_hash(file_path, file_stat, file_hash, trusted=False):
+    # trusted: the hash was computed from the data which was written into the file, e.g. while extracting it,
+    # so the file can't have changed after hashing within the same mtime tick
+    if not trusted and time.time_ns() - file_stat.st_mtime_ns < hash_cache_racy_seconds * 1000 * 1000 * 1000:
+        return
+    cache_key = get_hash_cache_key(file_path)
+    cache_file = get_hash_cache_file(cache_key)
+    cache = get_hash_cache(cache_file)
+    with hash_cache_lock:
+        cache[cache_key] = get_file_stat_key(file_stat) + [file_hash]
+        dirty_hash_caches.add(cache_file)
+
+
+def get_md5_hash(file_path, use_cache=True):
+    use_cache = use_cache and is_hash_cache_enabled()
+    if use_cache:
+        cached_hash = get_cached_md5_hash(file_path)
+        if cached_hash is not None:
+            return cached_hash
+
     md5_reader = md5()
     try:
         with open(file_path, "rb") as f:
-            data = f.read()
-            md5_reader.update(data)
-            return str(md5_reader.hexdigest()).upper()
+            file_stat = os.fstat(f.fileno())
+            # read in fixed size chunks, so large binaries are never fully loaded in memory
+            for chunk in iter(lambda: f.read(hash_chunk_size), b""):
+                md5_reader.update(chunk)
+            file_hash = str(md5_reader.hexdigest()).upper()
+        pbperf.add("bytes_hashed", file_stat.st_size)
+        # only trust the hash if the file did not change while we were reading it
+        if use_cache and get_file_stat_key(os.stat(file_path)) == get_file_stat_key(file_stat):
+            set_cached_md5_hash(file_path, file_stat, file_hash)
+        return file_hash
     except Exception as e:
         pblog.exception(str(e))
         return None
 
 
+def get_md5_hash_timed(file_path):
+    start = time.perf_counter()
+    current_hash = get_md5_hash(file_path)
+    return current_hash, time.perf_counter() - start
+
+
 def compare_md5_single(compared_file_path, md5_json_file_path):
-    current_hash = get_md5_hash(compared_file_path)
+    # single files are freshly downloaded packages, never worth caching
+    current_hash = get_md5_hash(compared_file_path, use_cache=False)
     if current_hash is None:
         return False
 
@@ -129,7 +520,7 @@ def compare_md5_all(md5_json_file_path, print_log=False, ignored_extension=".zip
     if hash_dict is None or len(hash_dict) == 0:
         return False
 
-    is_success = True
+    file_paths = []
     for file_path in hash_dict:
         if not os.path.isfile(file_path):
             # If file doesn't exist, that means we fail the checksum
@@ -140,16 +531,33 @@ def compare_md5_all(md5_json_file_path, print_log=False, ignored_extension=".zip
 
         if ignored_extension in file_path:
             continue
-        current_md5 = get_md5_hash(file_path)
-        if hash_dict[file_path] == current_md5:
-            if print_log:
-                pblog.info(f"MD5 checksum successful for {file_path}")
-        else:
-            if print_log:
-                pblog.error(f"MD5 checksum failed for {file_path}")
-                pblog.error(f"Expected MD5: {hash_dict[file_path]}")
-                pblog.error(f"Current MD5: {str(current_md5)}")
-            is_success = False
+        file_paths.append(file_path)
+
+    is_success = True
+    total_bytes = 0
+    start = time.perf_counter()
+    # hashlib releases the GIL while hashing, so threads are enough to keep all cores and the disk busy
+    with ThreadPoolExecutor(max_workers=hash_max_workers) as executor:
+        results = executor.map(get_md5_hash_timed, file_paths)
+        for file_path, (current_md5, elapsed) in zip(file_paths, results):
+            file_size = os.path.getsize(file_path)
+            total_bytes += file_size
+            pblog.debug(f"Hashed {file_path} ({file_size} bytes) in {elapsed:.3f}s")
+            if hash_dict[file_path] == current_md5:
+                if print_log:
+                    pblog.info(f"MD5 checksum successful for {file_path}")
+            else:
+                if print_log:
+                    pblog.error(f"MD5 checksum failed for {file_path}")
+                    pblog.error(f"Expected MD5: {hash_dict[file_path]}")
+                    pblog.error(f"Current MD5: {str(current_md5)}")
+                is_success = False
+
+    save_hash_cache()
+
+    elapsed = time.perf_counter() - start
+    throughput = total_bytes / elapsed / (1000 * 1000) if elapsed > 0 else 0
+    pblog.info(f"Verified {len(file_paths)} files ({total_bytes / (1000 * 1000):.1f}MB) in {elapsed:.2f}s ({throughput:.1f}MB/s)")
     return is_success
 
 
@@ -219,7 +627,9 @@ def error_state(msg=None, fatal_error=False, hush=False, term=False):
         pblog.error(msg)
     if fatal_error:
         # Log status for more information during tech support
+        start = time.perf_counter()
         pblog.info(run_with_combined_output([pbgit.get_git_executable(), "status"]).stdout)
+        pblog.info(f"git status took {time.perf_counter() - start:.2f}s")
         # This is a fatal error, so do not let user run PBSync until issue is fixed
         with open(error_file, 'w') as error_state_file:
             error_state_file.write("1")
@@ -251,89 +661,84 @@ def wipe_workspace():
         return False
 
     pbgit.abort_all()
-    output = get_combined_output([pbgit.get_git_executable(), "fetch", "origin", current_branch])
-    pblog.info(output)
+    pbgit.fetch([current_branch], refresh=True)
     proc = run_with_combined_output([pbgit.get_git_executable(), "reset", "--hard", f"origin/{current_branch}"])
+    pbgit.invalidate_cache()
     result = proc.returncode
     pblog.info(proc.stdout)
     output = get_combined_output([pbgit.get_git_executable(), "clean", "-fd"])
     pblog.info(output)
-    output = get_combined_output([pbgit.get_git_executable(), "pull"])
-    pblog.info(output)
     return result == 0
 
 
 def maintain_repo():
-    pblog.info("Starting repo maintenance...")
-
-    expire_date = (datetime.datetime.now() - datetime.timedelta(days=7)).strftime("%x")
-
-    # try to remove commit graph lock before running commit graph
-    do_commit_graph = True
-    try:
-        commit_graph_lock = os.path.join(os.getcwd(), ".git", "objects", "info", "commit-graphs", "commit-graph-chain.lock")
-        if (os.path.exists(commit_graph_lock)):
-            os.remove(commit_graph_lock)
-    except Exception as e:
-        pblog.exception(str(e))
-        do_commit_graph = False
-
-    commands = [
-        f"{pbgit.get_git_executable()} maintenance --task gc --task loose-objects",
-        f"{pbgit.get_lfs_executable()} prune -c",
-        f"{pbgit.get_lfs_executable()} dedup"
-    ]
-
-    if do_commit_graph:
-        commands.insert(1, f"{pbgit.get_git_executable()} commit-graph write --split --size-multiple=4 --reachable --changed-paths --expire-time={expire_date}")
-
-    # if we use multi-pack index, take advantage of it
-    if get_one_line_output([pbgit.get_git_executable(), "config", "core.multipackIndex"]) == "true":
-        commands[0] += " --task incremental-repack"
-
-    # fill in the git repo optionally
-    is_shallow = get_one_line_output([pbgit.get_git_executable(), "rev-parse", "--is-shallow-repository"])
-
-    # add in the front, so everything else can clean up after the fetch
-    if is_shallow == "true":
-        pblog.info("Shallow clone detected. PBSync will fill in history in the background.")
-        commands.insert(0, f"{pbgit.get_git_executable()} fetch --unshallow")
-
-    run_non_blocking(*commands)
-
-
-def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
-    def should_attempt_auto_resolve():
-        return retry_count <= max_retries
+    # Decide which maintenance tasks are due here, and run them in the background
+    pbmaintenance.start(pbconfig.get("config_path"))
 
-    if retry_count:
-        # wait a little bit if retrying (exponential)
-        time.sleep(0.25 * (1 << retry_count))
 
-    out = get_combined_output([pbgit.get_git_executable(), "status", "--ahead-behind", "-uno"])
-    pblog.info(out)
+def resolve_conflicts_and_pull():
+    # switch the workspace to the sparse checkout of the selected profile before updating it
+    if pbgit.is_sparse_checkout_outdated():
+        pbunreal.ensure_ue4_closed()
+        if not pbgit.update_sparse_checkout():
+            error_state("Failed to apply your workspace profile. Please check the profile setting in your user config, and request help in #tech-support if the issue persists.")
+        # objects of the paths left behind can be pruned now
+        pbmaintenance.mark_due("lfs-prune")
+
+    status = pbgit.get_status()
+    if status["upstream"] is not None:
+        pblog.info(f"{status['head']} is {status['ahead']} commits ahead and {status['behind']} commits behind {status['upstream']}, with {len(status['changes'])} local changes")
+    else:
+        pblog.info(f"{status['head']} has no upstream branch, with {len(status['changes'])} local changes")
 
-    if "ahead" not in out:
+    # with local commits that are not pushed yet, there is nothing to pull unless the branches diverged
+    if status["ahead"] == 0 or status["behind"] > 0:
         pbunreal.ensure_ue4_closed()
         pblog.info("Please wait while getting the latest changes from the repository. It may take a while...")
         # Make sure upstream is tracked correctly
         branch_name = pbgit.get_current_branch_name()
         pbgit.set_tracking_information(branch_name)
-        pblog.info("Stashing local work...")
-        proc = run_with_combined_output([pbgit.get_git_executable(), "stash"])
-        out = proc.stdout
-        stashed = proc.returncode == 0 and "Saved working directory and index state" in out
-        pblog.info(out)
+        old_head = status["oid"]
+        lfs_prefetch = pbgit.start_lfs_prefetch(branch_name)
+        stashed = False
+        if status["changes"]:
+            pblog.info("Stashing local work...")
+            with pbperf.phase("stash"):
+                stashed = pbgit.stash()
+        else:
+            pblog.info("No local changes, skipping stash")
         pblog.info("Rebasing workspace with the latest changes from the repository...")
         # Get the latest files, but skip smudge so we can super charge a LFS pull as one batch
-        result = run_with_combined_output([pbgit.get_git_executable(), "-c", "filter.lfs.smudge=", "-c", "filter.lfs.process=", "-c", "filter.lfs.required=false", "rebase", f"origin/{branch_name}", "--no-autostash"])
+        with pbperf.phase("rebase"):
+            result = run_with_combined_output([pbgit.get_git_executable(), "-c", "filter.lfs.smudge=", "-c", "filter.lfs.process=", "-c", "filter.lfs.required=false", "rebase", f"origin/{branch_name}", "--no-autostash"])
+            pbgit.invalidate_cache()
+        if lfs_prefetch is not None:
+            with pbperf.phase("lfs prefetch"):
+                lfs_prefetch.join()
         # Pull LFS in one go since we skipped smudge (faster)
-        run([pbgit.get_lfs_executable(), "pull"])
-        code = result.returncode
-        out = result.stdout
-        pblog.info(out)
-        out = out.lower()
-        error = code != 0
+        with pbperf.phase("lfs pull"):
+            lfs_paths = None
+            if result.returncode == 0 and old_head is not None:
+                # only LFS files changed by the rebase need to be checked out
+                changed_paths = pbgit.get_changed_paths(old_head, "HEAD")
+                if changed_paths is not None and status["ahead"] > 0:
+                    # local commits were rewritten without smudge too, so their LFS files are pointers now
+                    local_paths = pbgit.get_changed_paths(f"origin/{branch_name}", old_head, since_merge_base=True)
+                    changed_paths = None if local_paths is None else sorted(set(changed_paths) | set(local_paths))
+                if changed_paths is not None:
+                    lfs_paths = pbgit.get_lfs_tracked_paths(pbgit.filter_sparse_paths(changed_paths))
+            if lfs_paths is None:
+                run([pbgit.get_lfs_executable(), "pull"])
+            elif lfs_paths:
+                pblog.info(f"Pulling {len(lfs_paths)} changed Git LFS files...")
+                if not pbgit.lfs_pull_paths(lfs_paths):
+                    # a full pull also repairs pointers left behind by earlier failed pulls
+                    pblog.warning("Git LFS pull of the changed files failed, pulling all Git LFS files")
+                    run([pbgit.get_lfs_executable(), "pull"])
+            else:
+                pblog.info("No Git LFS files changed, skipping Git LFS pull")
+        pblog.info(result.stdout)
+        error = result.returncode != 0
     else:
         stashed = False
         error = False
@@ -351,46 +756,24 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
         pop_if_stashed()
         error_state(msg, fatal_error=True)
 
+    # the outcome is read from the repository state, since git output may be localized
     if not error:
         handle_success()
-    elif "fast-forwarded" in out:
-        handle_success()
-    elif "up to date" in out:
-        handle_success()
-    elif "rewinding head" in out and not it_has_any(out, "error", "conflict"):
-        handle_success()
-    elif "successfully rebased and updated" in out:
-        handle_success()
-    elif it_has_any(out, "failed to merge in the changes", "could not apply"):
+    elif pbgit.is_rebase_in_progress():
         handle_error("Aborting the rebase. Changes on one of your commits will be overridden by incoming changes. Please request help in #tech-support to resolve conflicts, and please do not run UpdateProject until the issue is resolved.")
-    elif it_has_any(out, "unmerged files", "merge_head exists"):
+    elif pbgit.is_merge_in_progress():
         # we can't abort anything, but don't let stash linger to restore the original repo state
         pop_if_stashed()
         error_state("You are in the middle of a merge. Please request help in #tech-support to resolve it, and please do not run UpdateProject until the issue is resolved.", fatal_error=True)
-    elif "unborn" in out:
-        if should_attempt_auto_resolve():
-            pblog.error("Unborn branch detected. Retrying...")
-            retry_count += 1
-            resolve_conflicts_and_pull(retry_count)
-            return
-        else:
-            handle_error("You are on an unborn branch. Please request help in #tech-support to resolve it, and please do not run UpdateProject until the issue is resolved.")
-    elif it_has_any(out, "no remote", "no such remote", "refspecs without repo"):
-        if should_attempt_auto_resolve():
-            pblog.error("Remote repository not found. Retrying...")
-            retry_count += 1
-            resolve_conflicts_and_pull(retry_count, 2)
-            return
-        else:
-            handle_error("The remote repository could not be found. Please request help in #tech-support to resolve it, and please do not run UpdateProject until the issue is resolved.")
-    elif "cannot open" in out:
-        if should_attempt_auto_resolve():
-            pblog.error("Git file info could not be read. Retrying...")
-            retry_count += 1
-            resolve_conflicts_and_pull(retry_count, 3)
-            return
-        else:
-            handle_error("Git file info could not be read. Please request help in #tech-support to resolve it, and please do not run UpdateProject until the issue is resolved.")
+    elif old_head is None:
+        handle_error("You are on an unborn branch. Please request help in #tech-support to resolve it, and please do not run UpdateProject until the issue is resolved.")
+    elif pbgit.get_oid(f"origin/{branch_name}") is None:
+        # the rebase did not start, so the workspace is still intact
+        pop_if_stashed()
+        error_state(f"The remote branch origin/{branch_name} could not be found. Please verify your remote connection and run UpdateProject again.")
+    elif pbgit.get_oid("HEAD") == old_head:
+        pop_if_stashed()
+        error_state("Git refused to rebase your workspace, so it was left unchanged. Please check the output above, and request help in #tech-support if the issue persists.")
     else:
         # We have no idea what the state of the repo is. Do nothing except bail.
         error_state("Aborting the repo update because of an unknown error. Request help in #tech-support to resolve it, and please do not run UpdateProject until the issue is resolved.", fatal_error=True)
@@ -1,6 +1,7 @@
 import itertools
 import re
 import os
+import time
 import json
 import glob
 import configparser
@@ -14,7 +15,6 @@ from urllib.parse import urlparse
 from pathlib import Path
 from gslib.command_runner import CommandRunner
 from gslib.commands.cp import CpCommand
-# from gslib.commands.rsync import RsyncCommand
 
 import gslib
 
@@ -23,6 +23,11 @@ from pbpy import pbtools
 from pbpy import pblog
 from pbpy import pbgit
 from pbpy import pbuac
+from pbpy import pbbucket
+from pbpy import pbhttp
+from pbpy import pbengine
+from pbpy import pbarchive
+from pbpy import pbversions
 
 # Those variable values are not likely to be changed in the future, it's safe to keep them hardcoded
 ue4v_prefix = "ue4v:"
@@ -36,6 +41,9 @@ ue4_editor_relative_path = "Engine/Binaries/Win64/UE4Editor.exe"
 # TODO: make these config variables
 engine_installation_folder_regex = r"[0-9].[0-9]{2}.*-PB-[0-9]{8}"
 engine_version_prefix = "PB"
+# extracted sizes of engine bundles, for buckets without manifests
+default_bundle_size_gb = 7
+default_symbols_size_gb = 23
 p4merge_path = ".github/p4merge/p4merge.exe"
 
 
@@ -252,30 +260,19 @@ def get_engine_install_root():
     return root
 
 
-def get_latest_available_engine_version(bucket_url):
-    output = pbtools.get_combined_output(["gsutil", "ls", bucket_url])
+def get_latest_available_engine_version(bucket_url, refresh=False):
     build_type = pbconfig.get("ue4v_default_bundle")
     if pbconfig.get("is_ci"):
         # We should get latest version of ciengine instead
         build_type = pbconfig.get("ue4v_ci_bundle")
 
-    # e.g, "engine-4.24-PB"
-    regex_prefix = f"{build_type}-{pbconfig.get('engine_base_version')}-{engine_version_prefix}"
-    versions = re.findall(regex_prefix + "-[0-9]{8}", output)
-    if len(versions) == 0:
-        return None
-    # Find the latest version by sorting
-    versions.sort()
-
-    # Strip the build type prefix back
-    result = str(versions[len(versions) - 1])
-    result = result.replace(f"{build_type}-", '')
-    return result.rstrip()
+    return pbversions.get_latest(bucket_url, build_type, refresh)
 
 
 def check_ue4_file_association():
     if os.name == 'nt':
-        file_assoc_result = pbtools.get_combined_output(["assoc", uproject_ext])
+        # assoc is a cmd builtin
+        file_assoc_result = pbtools.get_combined_output(["cmd", "/c", "assoc", uproject_ext])
         return "Unreal.ProjectFile" in file_assoc_result
     else:
         return True
@@ -318,7 +315,8 @@ def clean_old_engine_installations(keep=1):
     if current_version is not None:
         engine_install_root = get_engine_install_root()
         if engine_install_root is not None and os.path.isdir(engine_install_root):
-            folders = os.listdir(engine_install_root)
+            # least recently used first
+            folders = sorted(os.listdir(engine_install_root), key=lambda folder: pbengine.get_last_used(os.path.join(engine_install_root, folder)))
             for i in range(0, len(folders) - keep):
                 folder = folders[i]
                 # Do not remove folders if they do not match with installation folder name pattern
@@ -340,9 +338,7 @@ def clean_old_engine_installations(keep=1):
 @lru_cache()
 def get_versionator_gsuri(fallback=None):
     try:
-        ue4v_config = configparser.ConfigParser()
-        ue4v_config.read(".ue4versionator")
-        baseurl = ue4v_config.get("ue4versionator", "baseurl", fallback=fallback)
+        baseurl = pbbucket.get_versionator_baseurl(fallback)
         if baseurl:
             domain = urlparse(baseurl).hostname
             return f"gs://{domain}/"
@@ -374,83 +370,203 @@ def get_bundle_verification_file(bundle_name):
         return "Engine/Binaries/Win64/UE4Editor."
 
 
-def download_engine(bundle_name=None, download_symbols=False):
-    required_free_gb = 7
-    
-    if download_symbols:
-        required_free_gb += 23
+def format_gb(size):
+    return f"{size / (1000 * 1000 * 1000):.1f}GB"
+
+
+def get_archive_bundles(bundle_name, needs_exe, needs_symbols):
+    bundles = []
+    if needs_exe:
+        bundles.append(bundle_name)
+    if needs_symbols:
+        bundles.append(f"{bundle_name}-symbols")
+    return bundles
+
+
+def get_archive_sizes(root, bucket_url, bundle, version):
+    # Download and extracted size of an engine archive, from the bucket and the manifest beside the archive.
+    # Unknown sizes are estimated, the third value tells whether any of them was.
+    estimated = False
+    extracted = None
+    if pbbucket.is_supported(bucket_url):
+        files = pbengine.get_manifest(bucket_url, bundle, version)
+        if files is not None:
+            extracted = sum(entry["size"] for entry in files.values())
+    if extracted is None:
+        estimated = True
+        extracted = (default_symbols_size_gb if bundle.endswith("-symbols") else default_bundle_size_gb) * 1000 * 1000 * 1000
+    name = f"{bundle}-{version}.7z"
+    if os.path.isfile(os.path.join(root, name)):
+        compressed = 0
+    else:
+        compressed = pbbucket.get_size(bucket_url, name) if pbbucket.is_supported(bucket_url) else None
+        if compressed is None:
+            # an archive is never larger than its contents, by much
+            estimated = True
+            compressed = extracted
+    return compressed, extracted, estimated
+
+
+def make_space_for_engine(root, version, bundle_name, download_symbols, needs_exe, needs_symbols, legacy_archives):
+    # Print what the engine download needs, and remove the least recently used installs if it doesn't fit
+    bucket_url = pbbucket.get_bucket_url()
+    files = None
+    if not legacy_archives and pbbucket.is_supported(bucket_url):
+        bundles = [bundle_name]
+        if download_symbols:
+            bundles.append(f"{bundle_name}-symbols")
+        files = pbengine.get_manifest_files(bucket_url, bundles, version)
+        if files is not None:
+            total_size = sum(entry["size"] for entry in files.values())
+            pblog.info(f"Engine download plan: sync of {len(files)} files, {format_gb(total_size)} installed")
+
+    archives_size = 0
+    if files is None:
+        for bundle in get_archive_bundles(bundle_name, needs_exe, needs_symbols):
+            compressed, extracted, estimated = get_archive_sizes(root, bucket_url, bundle, version)
+            pblog.info(f"Engine download plan: {bundle}-{version}.7z, {format_gb(compressed)} download, {format_gb(extracted)} extracted{' (estimated)' if estimated else ''}")
+            # the archive and its contents are on disk at the same time
+            archives_size += compressed + extracted
+
+    total, used, free = disk_usage(root)
+    # files of kept installs are linked instead of downloaded
+    required, evicted, freed = pbengine.plan_evictions(root, version, free, files=files, required_size=archives_size)
+    pblog.info(f"Required space: {format_gb(required)}, available space: {format_gb(free)}")
+    if required + pbengine.required_space_margin > free + freed:
+        pblog.error(f"You do not have enough available space to install the engine. Please free up space on {Path(root).anchor}")
+        pblog.error(f"Missing space: {format_gb(required + pbengine.required_space_margin - free - freed)}, even after removing all old engine installations")
+        return False
+    for install in evicted:
+        last_used = time.strftime("%Y-%m-%d", time.localtime(pbengine.get_last_used(install)))
+        pblog.info(f"Removing least recently used engine installation {os.path.basename(install)}, last used on {last_used}")
+    if evicted:
+        pblog.info(f"Removing {len(evicted)} engine installations frees {format_gb(freed)}")
+    for install in evicted:
+        rmtree(install, ignore_errors=True)
+    return True
+
+
+def dedup_engine_installations():
+    if not pbconfig.get_user_config().getboolean("ue4v-user", "dedup", fallback=True):
+        return True
+    engine_install_root = get_engine_install_root()
+    if engine_install_root is None or not os.path.isdir(engine_install_root):
+        return False
+    try:
+        pbengine.dedup_installs(engine_install_root)
+    except Exception as e:
+        pblog.exception(str(e))
+        return False
+    return True
+
+
+@lru_cache()
+def get_gsutil_command_runner():
+    # Use gsutil to download the files efficiently
+    if (gslib.utils.parallelism_framework_util.CheckMultiprocessingAvailableAndInit().is_available):
+        # These setup methods must be called, and, on Windows, they can only be
+        # called from within an "if __name__ == '__main__':" block.
+        gslib.command.InitializeMultiprocessingVariables()
+        gslib.boto_translation.InitializeMultiprocessingVariables()
+    else:
+        gslib.command.InitializeThreadingVariables()
+    return CommandRunner(command_map={
+        "cp": CpCommand
+    })
+
+
+def get_archive_download(root, name):
+    def download():
+        bucket_url = pbbucket.get_bucket_url()
+        file_path = os.path.join(root, name)
+        if pbbucket.is_supported(bucket_url):
+            if pbbucket.download(bucket_url, name, file_path):
+                return True
+            if pbhttp.has_partial_download(file_path):
+                # gsutil would start from zero, while another attempt continues the interrupted download
+                pblog.warning(f"Download of {name} was interrupted, resuming it")
+                if pbbucket.download(bucket_url, name, file_path):
+                    return True
+            if not pbbucket.is_remote(bucket_url):
+                return False
+            # unauthenticated downloads can be refused, gsutil uses the credentials of the user
+            pblog.warning(f"Download of {name} from {bucket_url} failed, falling back to gsutil")
+        gcs_bucket = get_versionator_gsuri()
+        if gcs_bucket is None:
+            return False
+        if get_gsutil_command_runner().RunNamedCommand('cp', args=["-n", f"{gcs_bucket}{name}", f"file://{root}"], collect_analytics=False, skip_update_check=True) != 0:
+            return False
+        pbhttp.discard_partial_download(file_path)
+        return True
+    return download
 
-    required_free_space = required_free_gb * 1000 * 1000 * 1000
 
+def download_engine(bundle_name=None, download_symbols=False):
     is_ci = pbconfig.get("is_ci")
 
     root = get_engine_install_root()
     if root is not None:
-        if not pbconfig.get("is_ci") and os.path.isdir(root):
-            total, used, free = disk_usage(root)
-
-            if free < required_free_space:
-                pblog.warning("Not enough free space. Cleaning old engine installations before download.")
-                clean_old_engine_installations()
-                total, used, free = disk_usage(root)
-                if free < required_free_space:
-                    pblog.error(f"You do not have enough available space to install the engine. Please free up space on f{Path(root).anchor}")
-                    available_gb = int(free / (1000 * 1000 * 1000))
-                    pblog.error(f"Available space: {available_gb}GB")
-                    pblog.error(f"Total install size: {required_free_gb}GB")
-                    pblog.error(f"Required space: {int((free - required_free_space) / (1000 * 1000 * 1000))}")
-                    pbtools.error_state()
-
-        # create install dir if doesn't exist
-        os.makedirs(root, exist_ok=True)
+        version = get_engine_version_with_prefix()
+        try:
+            legacy_archives = pbconfig.get_user_config().getboolean("ue4v-user", "legacy", fallback=False) or int(get_engine_version()) <= 20201224
+        except:
+            legacy_archives = True
 
         verification_file = get_bundle_verification_file(bundle_name)
-        version = get_engine_version_with_prefix()
         base_path = Path(root) / Path(version)
         symbols_path = base_path / Path(verification_file + "pdb")
         needs_symbols = download_symbols and not symbols_path.exists()
         exe_path = base_path / Path(verification_file + "exe")
         needs_exe = not exe_path.exists()
-        try:
-            legacy_archives = pbconfig.get_user_config().getboolean("ue4v-user", "legacy", fallback=False) or int(get_engine_version()) <= 20201224
-        except:
-            legacy_archives = True
 
-        legacy_archives = True
+        # don't remove installs for a version which was never published, where the bucket can be listed
+        bucket_url = pbbucket.get_bucket_url()
+        if (needs_exe or needs_symbols) and bundle_name is not None and pbbucket.is_supported(bucket_url):
+            if pbversions.exists(bucket_url, bundle_name, version) is False:
+                pblog.error(f"Engine version {version} of {bundle_name} was not found in {bucket_url}")
+                previous = pbversions.get_previous(bucket_url, bundle_name, version, count=3)
+                if previous:
+                    pblog.error(f"Latest versions before it: {', '.join(previous)}")
+                return False
 
-        if not legacy_archives:
-            pblog.success("Using new remote sync method for engine update.")
+        if not is_ci and (needs_exe or needs_symbols) and os.path.isdir(root):
+            if not make_space_for_engine(root, version, bundle_name, download_symbols, needs_exe, needs_symbols, legacy_archives):
+                pbtools.error_state()
 
-        if needs_exe or needs_symbols:
-            # Use gsutil to download the files efficiently
-            if (gslib.utils.parallelism_framework_util.CheckMultiprocessingAvailableAndInit().is_available):
-                # These setup methods must be called, and, on Windows, they can only be
-                # called from within an "if __name__ == '__main__':" block.
-                gslib.command.InitializeMultiprocessingVariables()
-                gslib.boto_translation.InitializeMultiprocessingVariables()
+        # create install dir if doesn't exist
+        os.makedirs(root, exist_ok=True)
+
+        # needs_exe stays as it is for the setup steps of a new install
+        downloaded = False
+        if not legacy_archives and (needs_exe or needs_symbols):
+            bundles = [bundle_name]
+            if download_symbols:
+                bundles.append(f"{bundle_name}-symbols")
+            synced = pbengine.sync_engine(pbbucket.get_bucket_url(), root, version, bundles)
+            if synced is None:
+                pblog.info("Falling back to engine archives")
+                legacy_archives = True
+            elif synced:
+                pblog.success("Engine files were synchronized with the new remote sync method")
+                downloaded = True
             else:
-                gslib.command.InitializeThreadingVariables()
-            command_runner = CommandRunner(command_map={
-                "cp": CpCommand,
-                # "rs": RsyncCommand
-            })
-            patterns = []
-            if needs_exe and needs_symbols:
-                if legacy_archives:
-                    patterns.append(f"{bundle_name}*")
-                else:
-                    patterns.append(f"{bundle_name}")
-                    patterns.append(f"{bundle_name}-symbols")
-            elif needs_symbols:
-                patterns.append(f"{bundle_name}-symbols")
+                pblog.error("Engine sync failed")
+                return False
+
+        if not downloaded and (needs_exe or needs_symbols):
+            archive_names = [f"{bundle}-{version}.7z" for bundle in get_archive_bundles(bundle_name, needs_exe, needs_symbols)]
+            if pbarchive.get_7z_executable() is not None:
+                # extract here, with progress, and leave only the registration to ue4versionator
+                archives = [(os.path.join(root, name), get_archive_download(root, name)) for name in archive_names]
+                if not pbarchive.download_and_extract(archives, str(base_path)):
+                    return False
             else:
-                patterns.append(f"{bundle_name}")
-            patterns = [f"{pattern}-{version}.7z" if legacy_archives else "/" for pattern in patterns]
-            gcs_bucket = get_versionator_gsuri()
-            for pattern in patterns:
-                gcs_uri = f"{gcs_bucket}{pattern}"
-                dst = f"file://{root}"
-                command_runner.RunNamedCommand('cp' if legacy_archives else 'rs', args=["-n", gcs_uri, dst], collect_analytics=False, skip_update_check=True, parallel_operations=needs_exe and needs_symbols)
+                command_runner = get_gsutil_command_runner()
+                gcs_bucket = get_versionator_gsuri()
+                for name in archive_names:
+                    gcs_uri = f"{gcs_bucket}{name}"
+                    dst = f"file://{root}"
+                    command_runner.RunNamedCommand('cp', args=["-n", gcs_uri, dst], collect_analytics=False, skip_update_check=True, parallel_operations=len(archive_names) > 1)
 
     # Extract and register with ue4versionator
     # TODO: handle registration
@@ -509,6 +625,9 @@ def download_engine(bundle_name=None, download_symbols=False):
             uproject = str(Path(pbconfig.get("uproject_name")).resolve())
             pbtools.run([selector_path, "/projectfiles", uproject])
 
+    if root is not None and base_path.is_dir():
+        pbengine.mark_used(base_path)
+
     return True
 
 
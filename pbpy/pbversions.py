@@ -0,0 +1,112 @@
+import os
+import re
+import json
+import time
+
+from pbpy import pbconfig
+from pbpy import pblog
+from pbpy import pbgit
+from pbpy import pbbucket
+from pbpy import pbunreal
+
+# Index of the engine versions in the bucket. Only the objects of a single bundle and engine base version are listed,
+# e.g. editor-4.27-PB-*, and the result is cached in the git directory. A cached listing is used until it is older
+# than [ue4v-user] version_cache_minutes, or until the listing token of the bucket changes, where it has one.
+# Callers which write the result into the project, like --sync engineversion, list the bucket again with refresh.
+version_cache_name = "pbsync_engine_versions.json"
+default_cache_minutes = 10
+version_digits = 8
+
+
+def parse_version(version):
+    # e.g. "4.27-PB-20230101" -> (4, 27, 20230101)
+    return tuple(int(part) for part in re.findall(r"[0-9]+", version))
+
+
+def get_prefix(bundle):
+    return f"{bundle}-{pbunreal.get_engine_prefix()}-"
+
+
+def get_cache_path():
+    return os.path.join(pbgit.get_git_dir(), version_cache_name)
+
+
+def read_cache():
+    try:
+        with open(get_cache_path()) as cache_file:
+            return json.load(cache_file)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        pblog.warning(f"Discarding engine version cache: {e}")
+    return {}
+
+
+def write_cache(cache):
+    cache_path = get_cache_path()
+    temp_path = f"{cache_path}.tmp"
+    try:
+        with open(temp_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        pblog.exception(str(e))
+
+
+def parse_versions(names, bundle):
+    # Every object of a version counts, like the archive, its manifest or its symbols, as long as the bundle matches
+    prefix = get_prefix(bundle)
+    pattern = re.compile(f"{re.escape(prefix)}[0-9]{{{version_digits}}}(?![0-9])")
+    versions = set()
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            versions.add(match.group(0)[len(bundle) + 1:])
+    return sorted(versions, key=parse_version)
+
+
+def get_versions(bucket_url, bundle, refresh=False):
+    # Versions of the bundle for the current engine base version, oldest first, or None if the bucket can't be listed
+    key = f"{bucket_url}|{get_prefix(bundle)}"
+    ttl = pbconfig.get_user_config().getfloat("ue4v-user", "version_cache_minutes", fallback=default_cache_minutes) * 60
+    token = pbbucket.get_listing_token(bucket_url)
+    cache = read_cache()
+    entry = cache.get(key)
+    if not refresh and entry is not None and entry.get("token") == token and time.time() - entry.get("listed", 0) < ttl:
+        return entry["versions"]
+
+    names = pbbucket.list_objects(bucket_url, get_prefix(bundle))
+    if names is None:
+        return None
+    versions = parse_versions(names, bundle)
+    cache[key] = {"versions": versions, "token": token, "listed": time.time()}
+    write_cache(cache)
+    pblog.debug(f"Listed {len(versions)} engine versions of {bundle} in {bucket_url}")
+    return versions
+
+
+def get_latest(bucket_url, bundle, refresh=False):
+    versions = get_versions(bucket_url, bundle, refresh)
+    return versions[-1] if versions else None
+
+
+def get_previous(bucket_url, bundle, version, count=1):
+    # Up to count versions before the given one, newest first
+    versions = get_versions(bucket_url, bundle)
+    if not versions:
+        return []
+    current = parse_version(version)
+    older = [candidate for candidate in versions if parse_version(candidate) < current]
+    return older[::-1][:count]
+
+
+def exists(bucket_url, bundle, version):
+    # None if the bucket can't be listed
+    versions = get_versions(bucket_url, bundle)
+    if versions is None:
+        return None
+    if version in versions:
+        return True
+    # a version published after the listing was cached
+    versions = get_versions(bucket_url, bundle, refresh=True)
+    return None if versions is None else version in versions
@@ -2,6 +2,7 @@ from pbpy.pbtools import error_state
 import os.path
 import os
 import sys
+import time
 import argparse
 import webbrowser
 
@@ -16,10 +17,37 @@ from pbpy import pbconfig
 from pbpy import pbpy_version
 from pbpy import pbdispatch
 from pbpy import pbuac
+from pbpy import pbstore
+from pbpy import pbperf
+from pbpy import pbbenchmark
+from pbpy import pbmaintenance
 
 import pbsync_version
 
 default_config_name = "PBSync.xml"
+# an interactive sync waits this long for a background prefetch to finish
+sync_lock_timeout = 600
+default_daemon_interval_minutes = 30
+
+
+def get_optional_settings(root, path):
+    # Optional config sections are read as a tag -> text mapping
+    node = root.find(path)
+    if node is None:
+        return {}
+    return {child.tag: child.text for child in node}
+
+
+def get_profiles(root):
+    # Workspace profiles, each one with its sparse checkout directories, extra LFS include patterns and partial clone setting
+    profiles = {}
+    for node in root.findall('profiles/profile'):
+        profiles[node.get('name')] = {
+            'sparse': [element.text.strip("/") for element in node.findall('sparse') if element.text],
+            'lfsinclude': [element.text for element in node.findall('lfsinclude') if element.text],
+            'partialclone': (node.findtext('partialclone') or "").strip().lower() == "true"
+        }
+    return profiles
 
 
 def config_handler(config_var, config_parser_func):
@@ -28,13 +56,36 @@ def config_handler(config_var, config_parser_func):
         error_state(f"{str(config_var)} config file is not valid or not found. Please check the integrity of the file", hush=True, term=True)
 
 
+def lock_repository(owner):
+    # Every command which changes the workspace, the engine installations or the caches holds the repository lock,
+    # it is released when PBSync exits
+    if not pbtools.acquire_lock(owner, timeout=sync_lock_timeout):
+        error_state("Another PBSync process is working on the repository. Please try again after it is finished.")
+
+
 def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None):
 
     sync_val = sync_val.lower()
 
+    if sync_val in ["all", "force", "partial", "engineversion", "ddc", "binaries", "engine"]:
+        lock_repository(f"{sync_val} sync")
+
     if sync_val == "all" or sync_val == "force" or sync_val == "partial":
+
+        # Preflight checks are independent of each other, so run them concurrently and only pay for the slowest one.
+        # Config is read upfront, since the remote and credential helper checks both depend on it.
+        with pbperf.phase("preflight"):
+            pbgit.get_config()
+            preflight, _ = pbtools.run_concurrently({
+                "remote connection": pbgit.check_remote_connection,
+                "git version": pbgit.get_git_version,
+                "git lfs version": pbgit.get_lfs_version,
+                "gcm version": pbgit.get_gcm_version,
+                "status": pbgit.get_status
+            })
+
         # Firstly, check our remote connection before doing anything
-        remote_state, remote_url = pbgit.check_remote_connection()
+        remote_state, remote_url = preflight["remote connection"]
         if not remote_state:
             error_state(
                 f"Remote connection was not successful. Please verify that you have a valid git remote URL and internet connection. Current git remote URL: {remote_url}")
@@ -49,7 +100,7 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
 
         pblog.info("------------------")
 
-        detected_git_version = pbgit.get_git_version()
+        detected_git_version = preflight["git version"]
         needs_git_update = False
         if detected_git_version == pbconfig.get('supported_git_version'):
             pblog.info(f"Current Git version: {detected_git_version}")
@@ -64,6 +115,7 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
             needs_git_update = True
 
 
+        removed_bundled_lfs = False
         if os.name == "nt" and pbgit.get_git_executable() == "git" and pbgit.get_lfs_executable() == "git-lfs":
             # find Git/cmd/git.exe
             git_paths = [path for path in pbtools.whereis("git") if "cmd" in path.parts]
@@ -85,6 +137,7 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
                             try:
                                 if is_admin:
                                     path.unlink()
+                                    removed_bundled_lfs = True
                                 else:
                                     delete_paths.append(str(path))
                             except FileNotFoundError:
@@ -99,6 +152,7 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
                     delete_cmdline = ["cmd.exe", "/c", "DEL", "/q", "/f"] + quoted_paths
                     try:
                         ret = pbuac.runAsAdmin(delete_cmdline)
+                        removed_bundled_lfs = True
                     except OSError:
                         pblog.error("User declined permission. Automatic delete failed.")
 
@@ -111,7 +165,10 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
                 if bundled_git_lfs:
                     error_state()
 
-        detected_lfs_version = pbgit.get_lfs_version()
+        detected_lfs_version = preflight["git lfs version"]
+        if removed_bundled_lfs:
+            # the version was detected before the bundled Git LFS was removed
+            detected_lfs_version = pbgit.get_lfs_version()
         supported_lfs_version = pbconfig.get('supported_lfs_version')
         if detected_lfs_version == supported_lfs_version:
             pblog.info(f"Current Git LFS version: {detected_lfs_version}")
@@ -124,7 +181,7 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
                 webbrowser.open(f"https://github.com/git-lfs/git-lfs/releases/download/v{supported_lfs_version}/git-lfs-windows-v{supported_lfs_version}.exe")
             needs_git_update = True
 
-        detected_gcm_version = pbgit.get_gcm_version()
+        detected_gcm_version = preflight["gcm version"]
         supported_gcm_version_raw = pbconfig.get('supported_gcm_version')
         supported_gcm_version = f"{supported_gcm_version_raw}{pbconfig.get('supported_gcm_version_suffix')}"
         if detected_gcm_version == supported_gcm_version:
@@ -137,6 +194,7 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
                 # remove the old credential helper (it may get stuck, and Core won't be able to install)
                 pbtools.run_with_combined_output([pbgit.get_git_executable(), "config", "--unset-all", "credential.helper"])
                 pbtools.run_with_combined_output([pbgit.get_git_executable(), "config", "--global", "--unset-all", "credential.helper"])
+                pbgit.invalidate_cache()
                 exe_location = detected_gcm_version.split(".", 1)[1]
                 # if they actually have a Windows program installed, inform them.
                 if exe_location.endswith(".exe"):
@@ -156,6 +214,7 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
 
         # Do some housekeeping for git configuration
         pbgit.setup_config()
+        pbgit.check_fsmonitor()
 
         # Check if we have correct credentials
         pbgit.check_credentials()
@@ -163,13 +222,13 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
         partial_sync = sync_val == "partial"
         is_ci = pbconfig.get("is_ci")
 
-        status_out = pbtools.run_with_combined_output([pbgit.get_git_executable(), "status", "-uno"]).stdout
         # continue a trivial rebase
-        if "rebase" in status_out:
-            if pbtools.it_has_any(status_out, "nothing to commit", "git rebase --continue", "all conflicts fixed"):
+        if pbgit.is_rebase_in_progress():
+            if not preflight["status"]["unmerged"]:
                 pbunreal.ensure_ue4_closed()
-                rebase_out = pbtools.run_with_combined_output([pbgit.get_git_executable(), "rebase", "--continue"]).stdout
-                if pbtools.it_has_any(rebase_out, "must edit all merge conflicts"):
+                rebase_proc = pbtools.run_with_combined_output([pbgit.get_git_executable(), "rebase", "--continue"])
+                pbgit.invalidate_cache()
+                if rebase_proc.returncode != 0:
                     # this is an improper state, since git told us otherwise before. abort all.
                     pbgit.abort_all()
             else:
@@ -182,15 +241,13 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
 
         # undo single branch clone
         if not is_ci:
-            pbtools.run([pbgit.get_git_executable(), "config", "remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*"])
+            pbgit.set_config_value("remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*")
 
         # repo was already fetched in UpdateProject for the expected branch, so do it here only for dev
         if not partial_sync and not is_on_expected_branch:
             pblog.info("Fetching recent changes on the repository...")
-            fetch_base = [pbgit.get_git_executable(), "fetch", "origin"]
-            branches = {expected_branch, "master", "trunk", current_branch}
-            fetch_base.extend(branches)
-            pbtools.get_combined_output(fetch_base)
+            with pbperf.phase("fetch"):
+                pbgit.fetch([expected_branch, "master", "trunk", current_branch])
 
             pblog.info("------------------")
 
@@ -221,9 +278,12 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
                 # force restore .md5 file
                 pbgit.sync_file(checksum_json_path, "HEAD")
 
-            if pbgh.is_pull_binaries_required():
+            with pbperf.phase("binaries check"):
+                pull_binaries_required = pbgh.is_pull_binaries_required()
+            if pull_binaries_required:
                 pblog.info("Binaries are not up to date, pulling new binaries...")
-                ret = pbgh.pull_binaries(project_version)
+                with pbperf.phase("binaries pull"):
+                    ret = pbgh.pull_binaries(project_version)
                 if ret == 0:
                     pblog.info("Binaries were pulled successfully")
                 elif ret < 0:
@@ -256,21 +316,29 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
         symbols_needed = pbunreal.is_versionator_symbols_enabled()
         bundle_name = pbconfig.get("ue4v_default_bundle")
 
-        if pbunreal.download_engine(bundle_name, symbols_needed):
+        with pbperf.phase("engine download"):
+            engine_downloaded = pbunreal.download_engine(bundle_name, symbols_needed)
+        if engine_downloaded:
             pblog.info(f"Engine build {bundle_name}-{engine_version} successfully registered")
         else:
             error_state(f"Something went wrong while registering engine build {bundle_name}-{engine_version}. Please request help in #tech-support.")
 
         # Clean old engine installations, do that only in expected branch
         if is_on_expected_branch:
-            if pbunreal.clean_old_engine_installations():
+            with pbperf.phase("clean"):
+                engine_cleaned = pbunreal.clean_old_engine_installations()
+            if engine_cleaned:
                 pblog.info("Old engine installations are successfully cleaned")
             else:
                 pblog.warning("Something went wrong while cleaning old engine installations. You may want to clean them manually.")
+            with pbperf.phase("engine dedup"):
+                if not pbunreal.dedup_engine_installations():
+                    pblog.warning("Something went wrong while deduplicating engine installations")
 
         pblog.info("------------------")
 
-        pbunreal.update_source_control()
+        with pbperf.phase("source control update"):
+            pbunreal.update_source_control()
 
         if pbunreal.check_ue4_file_association() and pbunreal.is_ue4_closed():
             path = str(Path(uproject_file).resolve())
@@ -278,7 +346,7 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
                 os.startfile(path)
             except NotImplementedError:
                 if sys.platform.startswith('linux'):
-                    pbtools.run_non_blocking([f"xdg-open {path}"])
+                    pbtools.run_non_blocking(f"xdg-open {path}")
                 else:
                     pblog.info(f"You may now launch {uproject_file} with Unreal Engine 4.")
         else:
@@ -288,7 +356,8 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
         repository_val = pbunreal.get_versionator_gsuri(repository_val)
         if repository_val is None:
                 error_state("--repository <URL> argument should be provided with --sync engine command")
-        engine_version = pbunreal.get_latest_available_engine_version(str(repository_val))
+        # the version is written to the project, so don't trust a cached listing
+        engine_version = pbunreal.get_latest_available_engine_version(str(repository_val), refresh=True)
         if engine_version is None:
             error_state("Error while fetching latest engine version")
         if not pbunreal.set_engine_version(engine_version):
@@ -298,6 +367,14 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
     elif sync_val == "ddc":
         pbunreal.generate_ddc_data()
 
+    elif sync_val == "lfs-benchmark":
+        if not pbbenchmark.lfs_benchmark():
+            error_state("Git LFS benchmark failed")
+
+    elif sync_val == "status-benchmark":
+        if not pbbenchmark.status_benchmark():
+            error_state("Git status benchmark failed")
+
     elif sync_val == "binaries":
         project_version = pbunreal.get_project_version()
         ret = pbgh.pull_binaries(project_version, True)
@@ -319,11 +396,42 @@ def sync_handler(sync_val: str, repository_val=None, requested_bundle_name=None)
                 keep = 3
                 pblog.info(f"Keeping the last {keep} engine versions and removing the rest.")
                 pbunreal.clean_old_engine_installations(keep=keep)
+                pbunreal.dedup_engine_installations()
         else:
             error_state(f"Something went wrong while registering engine build {requested_bundle_name}-{engine_version}")
 
 
+def daemon_handler(daemon_val, config_path):
+    if daemon_val == "start":
+        pbtools.run_non_blocking(pbtools.get_self_command("--config", os.path.abspath(config_path), "--daemon", "run"))
+        pblog.info("Started background prefetch")
+        return
+
+    branch_name = pbconfig.get("expected_branch_name")
+    pbtools.lower_process_priority()
+    while True:
+        # pick up changes in the user config between runs
+        pbconfig.init_user_config()
+        if pbtools.acquire_lock("background prefetch"):
+            try:
+                pbgit.setup_config()
+                pblog.info(f"Prefetching {branch_name}...")
+                if pbgit.prefetch(branch_name):
+                    pblog.info(f"Prefetched {branch_name}")
+            finally:
+                pbtools.release_lock()
+        else:
+            pblog.info("Skipping background prefetch, the repository is locked by another PBSync process")
+        if daemon_val == "once":
+            return
+        interval = pbconfig.get_user_config().getfloat("daemon", "interval_minutes", fallback=default_daemon_interval_minutes)
+        time.sleep(interval * 60)
+
+
 def clean_handler(clean_val):
+    if clean_val in ["workspace", "engine", "binaries-cache"]:
+        lock_repository(f"{clean_val} clean")
+
     if clean_val == "workspace":
         if pbtools.wipe_workspace():
             pblog.info("Workspace wipe successful")
@@ -335,6 +443,12 @@ def clean_handler(clean_val):
             error_state(
                 "Something went wrong while cleaning old engine installations. You may want to clean them manually.")
 
+    elif clean_val == "binaries-cache":
+        if pbstore.clean():
+            pblog.info("Binaries cache was removed successfully")
+        else:
+            error_state("Something went wrong while removing the binaries cache. You may want to remove it manually.")
+
 
 def printversion_handler(print_val, repository_val=None):
     if print_val == "latest-engine":
@@ -360,6 +474,7 @@ def printversion_handler(print_val, repository_val=None):
 
 
 def autoversion_handler(autoversion_val):
+    lock_repository("autoversion")
     if pbunreal.project_version_increase(autoversion_val):
         pblog.info("Successfully increased project version")
     else:
@@ -379,7 +494,7 @@ def main(argv):
     parser = argparse.ArgumentParser(description=f"Project Borealis Workspace Synchronization Tool | PBpy Library Version: {pbpy_version.ver} | PBSync Program Version: {pbsync_version.ver}")
 
     parser.add_argument("--sync", help="Main command for the PBSync, synchronizes the project with latest changes from the repo, and does some housekeeping",
-                        choices=["all", "partial", "binaries", "engineversion", "engine", "force", "ddc"])
+                        choices=["all", "partial", "binaries", "engineversion", "engine", "force", "ddc", "lfs-benchmark", "status-benchmark"])
     parser.add_argument("--printversion", help="Prints requested version information into console.",
                         choices=["current-engine", "latest-engine", "project"])
     parser.add_argument(
@@ -387,7 +502,13 @@ def main(argv):
     parser.add_argument("--autoversion", help="Automatic version update for project version",
                         choices=["hotfix", "stable", "public"])
     parser.add_argument("--clean", help="""Do cleanup according to specified argument. If engine is provided, old engine installations will be cleared
-    If workspace is provided, workspace will be reset with latest changes from current branch (not revertible)""", choices=["engine", "workspace"])
+    If workspace is provided, workspace will be reset with latest changes from current branch (not revertible)
+    If binaries-cache is provided, the local cache of binaries shared between project versions will be removed""", choices=["engine", "workspace", "binaries-cache"])
+    parser.add_argument("--daemon", help="""Prefetch the expected branch and its Git LFS objects in the background, so the next sync only has to update the workspace.
+    If start is provided, a background PBSync process is launched. If run is provided, prefetches run periodically in this process. If once is provided, a single prefetch runs, e.g. from a scheduled task""",
+                        choices=["start", "run", "once"])
+    # Used by the background process which runs repository maintenance after a sync
+    parser.add_argument("--maintenance", help=argparse.SUPPRESS)
     parser.add_argument("--config", help=f"Path of config XML file. If not provided, ./{default_config_name} is used as default", default=default_config_name)
     parser.add_argument("--publish", help="Publishes a playable build with provided build type",
                         choices=["internal", "playtester"])
@@ -399,6 +520,12 @@ def main(argv):
         "--debugpath", help="If provided, PBSync will run in provided path")
     parser.add_argument(
         "--debugbranch", help="If provided, PBSync will use provided branch as expected branch")
+    parser.add_argument(
+        "--profile", help="If provided, PBSync will save cProfile data of the run into the provided path", nargs="?", const="pbsync.prof")
+    parser.add_argument(
+        "--verbose", help="If provided, PBSync will also log debug messages, like timings of every hashed file, child process and check", action="store_true")
+    parser.add_argument(
+        "--no-hash-cache", help="If provided, PBSync will not use its cache of file hashes, and will hash every file again", action="store_true")
 
     if len(argv) > 0:
         args = parser.parse_args(argv)
@@ -432,12 +559,16 @@ def main(argv):
         'defaultgame_path': root.find('project/defaultgameinipath').text,
         'dispatch_config': root.find('dispatch/config').text,
         'dispatch_drm': root.find('dispatch/drm').text,
-        'dispatch_stagedir': root.find('dispatch/stagedir').text
+        'dispatch_stagedir': root.find('dispatch/stagedir').text,
+        'lfs_settings': get_optional_settings(root, 'lfs'),
+        'profiles': get_profiles(root),
+        'config_path': os.path.abspath(args.config),
+        'use_hash_cache': not args.no_hash_cache
     }
 
     # Preparation
     config_handler(args.config, pbsync_config_parser_func)
-    pblog.setup_logger(pbconfig.get('log_file_path'))
+    pblog.setup_logger(pbconfig.get('log_file_path'), args.verbose)
 
     # Do not process further if we're in an error state
     if pbtools.check_error_state():
@@ -445,24 +576,42 @@ def main(argv):
         before running PBSync.\nIf you have already fixed the problem, you may remove {pbtools.error_file} from your project folder and 
         run UpdateProject again.""", True)
 
-    # Parse args
-    if not (args.sync is None):
-        sync_handler(args.sync, args.repository, args.bundle)
-    elif not (args.printversion is None):
-        printversion_handler(args.printversion, args.repository)
-    elif not (args.autoversion is None):
-        autoversion_handler(args.autoversion)
-    elif not (args.clean is None):
-        clean_handler(args.clean)
-    elif not (args.publish is None):
-        publish_handler(args.publish, args.dispatch)
-    else:
-        pblog.error("At least one valid argument should be passed!")
-        pblog.error("Did you mean to launch UpdateProject?")
-        input("Press enter to continue...")
-        error_state(hush=True)
+    if args.profile:
+        pbperf.start_profiling()
 
-    pbconfig.shutdown()
+    # Parse args
+    try:
+        if not (args.sync is None):
+            sync_handler(args.sync, args.repository, args.bundle)
+        elif not (args.printversion is None):
+            printversion_handler(args.printversion, args.repository)
+        elif not (args.autoversion is None):
+            autoversion_handler(args.autoversion)
+        elif not (args.clean is None):
+            clean_handler(args.clean)
+        elif not (args.publish is None):
+            publish_handler(args.publish, args.dispatch)
+        elif not (args.daemon is None):
+            daemon_handler(args.daemon, args.config)
+        elif not (args.maintenance is None):
+            pbmaintenance.run_tasks(args.maintenance.split(","))
+        else:
+            pblog.error("At least one valid argument should be passed!")
+            pblog.error("Did you mean to launch UpdateProject?")
+            input("Press enter to continue...")
+            error_state(hush=True)
+    finally:
+        pbtools.release_lock()
+        # also report runs which ended in an error state. Other commands may have their output parsed, so keep it clean.
+        if args.sync is not None:
+            pbtools.log_process_stats()
+            pbperf.write_summary(argv)
+        if args.profile:
+            pbperf.stop_profiling(args.profile)
+
+    # a background process would overwrite changes the user made to their config in the meantime
+    if args.daemon is None and args.maintenance is None:
+        pbconfig.shutdown()
 
 if __name__ == '__main__':
     if "Scripts" in os.getcwd():
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# pbtools is imported first, like PBSync does, since the modules import each other
+from pbpy import pbtools
+from pbpy import pbarchive
+
+
+class RootFolderTest(unittest.TestCase):
+
+    def test_engine_at_root(self):
+        paths = ["Engine", "Engine/Binaries/Win64/UE4Editor.exe", "FeaturePacks/Blank.upack", "GenerateProjectFiles.bat"]
+        self.assertEqual(pbarchive.get_root_folder(paths), "")
+
+    def test_single_top_level_folder(self):
+        paths = ["UE_4.27", "UE_4.27/Engine", "UE_4.27/Engine/Binaries/Win64/UE4Editor.exe", "UE_4.27/Templates/Default.txt"]
+        self.assertEqual(pbarchive.get_root_folder(paths), "UE_4.27")
+
+    def test_unexpected_layout(self):
+        self.assertIsNone(pbarchive.get_root_folder(["Binaries/Win64/UE4Editor.exe", "Content/Shared.uasset"]))
+        # a single folder without Engine in it
+        self.assertIsNone(pbarchive.get_root_folder(["UE_4.27/Binaries/Win64/UE4Editor.exe"]))
+        self.assertIsNone(pbarchive.get_root_folder(["UE_4.27/Other/Engine/Binaries/UE4Editor.exe"]))
+        self.assertIsNone(pbarchive.get_root_folder([]))
+
+
+class DownloadAndExtractTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="pbsync_archive")
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.destination = os.path.join(self.temp_dir, "4.27-PB-20230101")
+        patch = mock.patch.object(pbarchive, "get_7z_executable", return_value="7z")
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def get_archive(self, name, exists=True):
+        archive_path = os.path.join(self.temp_dir, name)
+        if exists:
+            open(archive_path, "w").close()
+
+        def download():
+            open(archive_path, "w").close()
+            return True
+
+        return archive_path, download
+
+    def test_archives_are_removed_after_extraction(self):
+        archives = [self.get_archive("editor.7z"), self.get_archive("editor-symbols.7z", exists=False)]
+        with mock.patch.object(pbarchive, "extract", return_value=True) as extract:
+            self.assertTrue(pbarchive.download_and_extract(archives, self.destination))
+        self.assertEqual([call.args[0] for call in extract.call_args_list], [archive_path for archive_path, _ in archives])
+        for archive_path, _ in archives:
+            self.assertFalse(os.path.exists(archive_path))
+
+    def test_archive_is_kept_when_extraction_fails(self):
+        failed_path, download = self.get_archive("editor.7z")
+        extracted_path, _ = archive = self.get_archive("editor-symbols.7z")
+        with mock.patch.object(pbarchive, "extract", side_effect=lambda archive_path, *args: archive_path != failed_path):
+            self.assertFalse(pbarchive.download_and_extract([(failed_path, download), archive], self.destination))
+        self.assertTrue(os.path.isfile(failed_path))
+        self.assertFalse(os.path.exists(extracted_path))
+
+    def test_failed_download(self):
+        archive_path = os.path.join(self.temp_dir, "editor.7z")
+        with mock.patch.object(pbarchive, "extract", return_value=True) as extract:
+            self.assertFalse(pbarchive.download_and_extract([(archive_path, lambda: False)], self.destination))
+        extract.assert_not_called()
+
+    def test_keep_archives(self):
+        archive_path, download = self.get_archive("editor.7z")
+        with mock.patch.object(pbarchive, "extract", return_value=True):
+            self.assertTrue(pbarchive.download_and_extract([(archive_path, download)], self.destination, keep_archives=True))
+        self.assertTrue(os.path.isfile(archive_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
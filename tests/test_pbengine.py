@@ -0,0 +1,183 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+# pbtools is imported first, like PBSync does, since the modules import each other
+from pbpy import pbtools
+from pbpy import pbconfig
+from pbpy import pbbucket
+from pbpy import pbstore
+from pbpy import pbengine
+
+old_version = "4.27-PB-20230101"
+new_version = "4.27-PB-20230102"
+
+
+class EngineSyncTest(unittest.TestCase):
+    # Versions are published to a local directory, which is used as a file:// bucket
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="pbsync_engine")
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.bucket_dir = os.path.join(self.temp_dir, "bucket")
+        self.bucket_url = Path(self.bucket_dir).as_uri()
+        self.root = os.path.join(self.temp_dir, "engines")
+        os.makedirs(self.bucket_dir)
+
+        patch = mock.patch.object(pbconfig, "config", {"is_ci": False, "use_hash_cache": False})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.publish("editor", old_version, {
+            "Engine/Binaries/Win64/UE4Editor.exe": "editor 1",
+            "Engine/Binaries/Win64/Core.dll": "core",
+            "Engine/Content/Shared.uasset": "shared",
+            "Engine/Config/BaseEngine.ini": "config",
+            "Engine/Removed.txt": "removed"
+        })
+        self.publish("editor", new_version, {
+            "Engine/Binaries/Win64/UE4Editor.exe": "editor 2",
+            "Engine/Binaries/Win64/Core.dll": "core",
+            "Engine/Content/Shared.uasset": "shared",
+            "Engine/Config/BaseEngine.ini": "config",
+            "Engine/Added.txt": "added"
+        })
+
+    def publish(self, bundle, version, contents):
+        install_dir = os.path.join(self.temp_dir, "publish", f"{bundle}-{version}")
+        shutil.rmtree(install_dir, ignore_errors=True)
+        for relative_path, content in contents.items():
+            file_path = os.path.join(install_dir, *relative_path.split("/"))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w") as published_file:
+                published_file.write(content)
+        self.assertTrue(pbengine.publish(install_dir, self.bucket_dir, bundle, version))
+
+    def sync(self, version, bundles=("editor",)):
+        # Returns the sync result and the contents which were downloaded
+        with mock.patch.object(pbbucket, "download", wraps=pbbucket.download) as download:
+            result = pbengine.sync_engine(self.bucket_url, self.root, version, list(bundles))
+        downloaded = set()
+        for call in download.call_args_list:
+            with open(call.args[2]) as downloaded_file:
+                downloaded.add(downloaded_file.read())
+        return result, downloaded
+
+    def get_path(self, version, relative_path):
+        return os.path.join(self.root, version, *relative_path.split("/"))
+
+    def read(self, version, relative_path):
+        with open(self.get_path(version, relative_path)) as installed_file:
+            return installed_file.read()
+
+    def test_missing_manifest(self):
+        self.assertIsNone(pbengine.sync_engine(self.bucket_url, self.root, "4.27-PB-20230103", ["editor"]))
+
+    def test_first_sync(self):
+        result, downloaded = self.sync(old_version)
+        self.assertTrue(result)
+        self.assertEqual(downloaded, {"editor 1", "core", "shared", "config", "removed"})
+        self.assertEqual(self.read(old_version, "Engine/Binaries/Win64/UE4Editor.exe"), "editor 1")
+
+    def test_only_changed_files_are_downloaded(self):
+        self.sync(old_version)
+        result, downloaded = self.sync(new_version)
+        self.assertTrue(result)
+        self.assertEqual(downloaded, {"editor 2", "added"})
+        # unchanged files are linked from the previous version
+        for relative_path in ("Engine/Binaries/Win64/Core.dll", "Engine/Content/Shared.uasset"):
+            self.assertTrue(os.path.samefile(self.get_path(old_version, relative_path), self.get_path(new_version, relative_path)))
+        self.assertEqual(self.read(new_version, "Engine/Binaries/Win64/UE4Editor.exe"), "editor 2")
+        self.assertEqual(self.read(old_version, "Engine/Binaries/Win64/UE4Editor.exe"), "editor 1")
+        self.assertFalse(os.path.exists(self.get_path(new_version, "Engine/Removed.txt")))
+        # config files may be changed in place, so they are copied
+        config_path = "Engine/Config/BaseEngine.ini"
+        self.assertFalse(os.path.samefile(self.get_path(old_version, config_path), self.get_path(new_version, config_path)))
+        self.assertEqual(self.read(new_version, config_path), "config")
+
+    def test_up_to_date_install(self):
+        self.sync(new_version)
+        result, downloaded = self.sync(new_version)
+        self.assertTrue(result)
+        self.assertEqual(downloaded, set())
+
+    def test_changed_files_of_install_are_replaced(self):
+        self.sync(new_version)
+        with open(self.get_path(new_version, "Engine/Added.txt"), "w") as modified_file:
+            modified_file.write("modified")
+        result, downloaded = self.sync(new_version)
+        self.assertTrue(result)
+        self.assertEqual(downloaded, {"added"})
+        self.assertEqual(self.read(new_version, "Engine/Added.txt"), "added")
+
+    def test_stale_files_are_removed(self):
+        self.publish("editor-symbols", new_version, {"Engine/Binaries/Win64/UE4Editor.pdb": "symbols"})
+        self.sync(new_version, ["editor", "editor-symbols"])
+        # the version is published again without a file
+        self.publish("editor", new_version, {
+            "Engine/Binaries/Win64/UE4Editor.exe": "editor 2",
+            "Engine/Binaries/Win64/Core.dll": "core",
+            "Engine/Content/Shared.uasset": "shared",
+            "Engine/Config/BaseEngine.ini": "config"
+        })
+        result, downloaded = self.sync(new_version)
+        self.assertTrue(result)
+        self.assertEqual(downloaded, set())
+        self.assertFalse(os.path.exists(self.get_path(new_version, "Engine/Added.txt")))
+        self.assertNotIn("Engine/Added.txt", pbengine.read_local_manifest(os.path.join(self.root, new_version)))
+        # files of bundles which weren't synced stay
+        self.assertEqual(self.read(new_version, "Engine/Binaries/Win64/UE4Editor.pdb"), "symbols")
+
+
+class EngineInstallsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="pbsync_engines")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        patch = mock.patch.object(pbconfig, "config", {"is_ci": False, "use_hash_cache": False})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.content = os.urandom(pbengine.dedup_min_size)
+        for version in (old_version, new_version):
+            for relative_path in ("Engine/Content/Shared.uasset", "Engine/Config/BaseEngine.ini"):
+                file_path = self.get_path(version, relative_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "wb") as install_file:
+                    install_file.write(self.content)
+
+    def get_path(self, version, relative_path):
+        return os.path.join(self.root, version, *relative_path.split("/"))
+
+    def test_dedup(self):
+        self.assertEqual(pbengine.dedup_installs(self.root), len(self.content))
+        self.assertTrue(os.path.samefile(self.get_path(old_version, "Engine/Content/Shared.uasset"), self.get_path(new_version, "Engine/Content/Shared.uasset")))
+        self.assertFalse(os.path.samefile(self.get_path(old_version, "Engine/Config/BaseEngine.ini"), self.get_path(new_version, "Engine/Config/BaseEngine.ini")))
+        # already linked
+        self.assertEqual(pbengine.dedup_installs(self.root), 0)
+
+    def test_dedup_without_hardlinks(self):
+        with mock.patch.object(pbstore.os, "link", side_effect=OSError("Hardlinks are not supported")):
+            self.assertEqual(pbengine.dedup_installs(self.root), 0)
+        self.assertFalse(os.path.samefile(self.get_path(old_version, "Engine/Content/Shared.uasset"), self.get_path(new_version, "Engine/Content/Shared.uasset")))
+        with open(self.get_path(new_version, "Engine/Content/Shared.uasset"), "rb") as install_file:
+            self.assertEqual(install_file.read(), self.content)
+
+    def test_last_used(self):
+        old_install = os.path.join(self.root, old_version)
+        new_install = os.path.join(self.root, new_version)
+        pbengine.dedup_installs(self.root)
+        pbengine.mark_used(old_install)
+        os.utime(os.path.join(old_install, pbengine.last_used_name), (2000000000, 2000000000))
+        # access through the hardlinks of the newer install doesn't make the older one used
+        os.utime(self.get_path(new_version, "Engine/Content/Shared.uasset"), (2100000000, 2100000000))
+        self.assertEqual(pbengine.get_last_used(old_install), 2000000000)
+        self.assertLess(pbengine.get_last_used(new_install), 2000000000)
+        self.assertEqual(sorted([old_install, new_install], key=pbengine.get_last_used), [new_install, old_install])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+from urllib.parse import urlparse
+
+# pbtools is imported first, like PBSync does, since the modules import each other
+from pbpy import pbtools
+from pbpy import pbconfig
+from pbpy import pbgit
+from pbpy import pbgh
+from pbpy import pbhttp
+from pbpy import pbstandin
+
+version_number = "1.2.3"
+
+
+class NativeDownloadTest(unittest.TestCase):
+    # Releases are served by the stand-in server, which redirects asset downloads to signed URLs like GitHub does
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="pbsync_binaries")
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.releases_dir = os.path.join(self.temp_dir, "releases")
+        self.work_dir = os.path.join(self.temp_dir, "project")
+        os.makedirs(os.path.join(self.releases_dir, version_number))
+        os.makedirs(self.work_dir)
+        self.content = os.urandom(300 * 1000)
+        with open(os.path.join(self.releases_dir, version_number, pbgh.binary_package_name), "wb") as package_file:
+            package_file.write(self.content)
+
+        self.server = pbstandin.start_server(self.releases_dir)
+        self.addCleanup(pbstandin.stop_server, self.server)
+
+        user_config = pbconfig.CustomConfigParser()
+        user_config["binaries"]["api_url"] = self.server.url
+        user_config["binaries"]["connections"] = "4"
+        patches = [
+            mock.patch.object(pbconfig, "config", {"is_ci": False, "git_url": "https://github.com/owner/project.git"}),
+            mock.patch.object(pbconfig, "user_config", user_config),
+            mock.patch.object(pbgit, "get_credentials", return_value=("user", "token"))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # the package is downloaded into the working directory
+        cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        self.addCleanup(os.chdir, cwd)
+
+    def get_downloads(self):
+        # (path, signature, range) of the requests for the signed package URL
+        downloads = []
+        for path, range_header in self.server.requests:
+            parsed = urlparse(path)
+            if parsed.path.startswith("/files/"):
+                downloads.append((parsed.path, parsed.query, range_header))
+        return downloads
+
+    def test_resolve_release_asset(self):
+        asset = pbgh.resolve_release_asset(version_number, {})
+        self.assertEqual(asset["name"], pbgh.binary_package_name)
+        self.assertEqual(asset["size"], len(self.content))
+        self.assertIsNone(pbgh.resolve_release_asset("0.0.0", {}))
+
+    def test_download(self):
+        self.assertEqual(pbgh.download_binaries_native(version_number), 0)
+        with open(pbgh.binary_package_name, "rb") as package_file:
+            self.assertEqual(package_file.read(), self.content)
+        self.assertFalse(pbhttp.has_partial_download(pbgh.binary_package_name))
+        downloads = self.get_downloads()
+        self.assertTrue(downloads)
+        for path, query, range_header in downloads:
+            self.assertEqual(path, f"/files/{version_number}/{pbgh.binary_package_name}")
+            self.assertIn("signature=", query)
+            self.assertTrue(range_header.startswith("bytes="))
+
+    def test_missing_release(self):
+        self.assertEqual(pbgh.download_binaries_native("0.0.0"), -1)
+        self.assertFalse(os.path.exists(pbgh.binary_package_name))
+
+    def test_range_requests(self):
+        asset = pbgh.resolve_release_asset(version_number, {})
+        chunk_size = 64 * 1000
+        self.assertTrue(pbhttp.download_file(asset["url"], pbgh.binary_package_name, headers={"Accept": "application/octet-stream"}, connections=4, chunk_size=chunk_size))
+        with open(pbgh.binary_package_name, "rb") as package_file:
+            self.assertEqual(package_file.read(), self.content)
+        ranges = {range_header for _, _, range_header in self.get_downloads()}
+        chunk_ranges = {f"bytes={start}-{min(start + chunk_size, len(self.content)) - 1}" for start in range(0, len(self.content), chunk_size)}
+        # the size is probed with the first byte, then every chunk is requested once
+        self.assertEqual(ranges, {"bytes=0-0"} | chunk_ranges)
+
+    def test_expired_signed_url(self):
+        # a slow download outlives its signed URL, which is resolved again
+        self.server.signed_url_lifetime = 0.5
+        self.server.connection_rate = 200 * 1000
+        asset = pbgh.resolve_release_asset(version_number, {})
+        self.assertTrue(pbhttp.download_file(asset["url"], pbgh.binary_package_name, connections=1, chunk_size=50 * 1000))
+        with open(pbgh.binary_package_name, "rb") as package_file:
+            self.assertEqual(package_file.read(), self.content)
+        signatures = {query for _, query, _ in self.get_downloads()}
+        self.assertGreater(len(signatures), 1)
+
+    def test_gh_cli_is_only_needed_for_its_downloader(self):
+        checksum_path = os.path.join(self.work_dir, "checksum.json")
+        pbconfig.config["checksum_file"] = checksum_path
+        with open(checksum_path, "w") as checksum_file:
+            checksum_file.write("{}")
+        with mock.patch.object(pbtools, "compare_md5_all", return_value=True):
+            self.assertFalse(pbgh.is_pull_binaries_required())
+            pbconfig.user_config["binaries"]["downloader"] = "gh"
+            self.assertTrue(pbgh.is_pull_binaries_required())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from pbpy import pbtools
+from pbpy import pbconfig
+
+
+class HashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="pbsync_hash_cache")
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.engine_root = os.path.join(self.temp_dir, "engines")
+        os.makedirs(os.path.join(self.engine_root, "4.27-PB-20230101"))
+        patches = [
+            mock.patch.object(pbconfig, "config", {"is_ci": False, "use_hash_cache": True}),
+            mock.patch.object(pbtools, "hash_caches", {}),
+            mock.patch.object(pbtools, "hash_cache_roots", []),
+            mock.patch.object(pbtools, "dirty_hash_caches", set()),
+            mock.patch.object(pbtools, "pruned_hash_caches", set())
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # the repository cache is stored in the working directory
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        self.addCleanup(os.chdir, cwd)
+
+    def create_file(self, file_path, content):
+        with open(file_path, "w") as created_file:
+            created_file.write(content)
+        # older than the racy window, so the hash is cached
+        modified = time.time() - 60
+        os.utime(file_path, (modified, modified))
+        return file_path
+
+    def read_cache(self, cache_file):
+        with open(cache_file) as cache_file_handle:
+            return json.load(cache_file_handle)["entries"]
+
+    def test_hashes_are_cached(self):
+        file_path = self.create_file(os.path.join(self.temp_dir, "file.dll"), "content")
+        file_hash = pbtools.get_md5_hash(file_path)
+        pbtools.save_hash_cache()
+        self.assertEqual(list(self.read_cache(pbtools.hash_cache_file).values())[0][3], file_hash)
+        self.assertEqual(pbtools.get_cached_md5_hash(file_path), file_hash)
+
+    def test_deleted_and_changed_files_are_pruned(self):
+        kept = self.create_file(os.path.join(self.temp_dir, "kept.dll"), "kept")
+        deleted = self.create_file(os.path.join(self.temp_dir, "deleted.dll"), "deleted")
+        changed = self.create_file(os.path.join(self.temp_dir, "changed.dll"), "changed")
+        for file_path in (kept, deleted, changed):
+            pbtools.get_md5_hash(file_path)
+        pbtools.save_hash_cache()
+
+        # a later run
+        pbtools.hash_caches.clear()
+        pbtools.pruned_hash_caches.clear()
+        os.remove(deleted)
+        self.create_file(changed, "changed again")
+        pbtools.get_md5_hash(kept)
+        pbtools.save_hash_cache()
+        self.assertEqual(list(self.read_cache(pbtools.hash_cache_file)), [pbtools.get_hash_cache_key(kept)])
+
+    def test_engine_hashes_are_kept_out_of_the_repository(self):
+        pbtools.add_hash_cache_root(self.engine_root)
+        engine_file = self.create_file(os.path.join(self.engine_root, "4.27-PB-20230101", "UE4Editor.exe"), "editor")
+        project_file = self.create_file(os.path.join(self.temp_dir, "Project.dll"), "project")
+        pbtools.get_md5_hash(engine_file)
+        pbtools.get_md5_hash(project_file)
+        pbtools.save_hash_cache()
+        self.assertEqual(list(self.read_cache(pbtools.hash_cache_file)), [pbtools.get_hash_cache_key(project_file)])
+        self.assertEqual(list(self.read_cache(os.path.join(self.engine_root, pbtools.hash_cache_file))), [pbtools.get_hash_cache_key(engine_file)])
+
+
+
+class LockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="pbsync_lock")
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        self.lock_path = os.path.join(self.temp_dir, pbtools.lock_file)
+        # the pid of a process which isn't running anymore
+        self.stale_pid = os.getpid() + 1000000
+        patches = [
+            mock.patch.object(pbtools, "owned_locks", set()),
+            mock.patch.object(pbtools.psutil, "pid_exists", side_effect=lambda pid: pid != self.stale_pid, create=True)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write_lock(self, pid, owner):
+        with open(self.lock_path, "w") as lock:
+            json.dump({"pid": pid, "owner": owner}, lock)
+
+    def test_stale_lock_is_taken_over(self):
+        self.write_lock(self.stale_pid, "crashed sync")
+        self.assertTrue(pbtools.acquire_lock("sync", path=self.lock_path))
+        self.assertEqual(pbtools.read_lock(self.lock_path), {"pid": os.getpid(), "owner": "sync"})
+        self.assertFalse(os.path.exists(f"{self.lock_path}.{os.getpid()}"))
+
+    def test_fresh_lock_is_not_replaced(self):
+        # another process took the stale lock over after it was read
+        self.write_lock(os.getppid(), "daemon")
+        self.assertFalse(pbtools.take_over_lock("sync", {"pid": self.stale_pid, "owner": "crashed sync"}, self.lock_path))
+        self.assertEqual(pbtools.read_lock(self.lock_path)["owner"], "daemon")
+
+    def test_lost_take_over(self):
+        self.write_lock(self.stale_pid, "crashed sync")
+        replace = os.replace
+
+        def replace_and_lose(source, target):
+            # the daemon replaces the stale lock right after us
+            replace(source, target)
+            self.write_lock(os.getppid(), "daemon")
+
+        with mock.patch.object(pbtools.os, "replace", side_effect=replace_and_lose):
+            self.assertFalse(pbtools.acquire_lock("sync", path=self.lock_path))
+        self.assertNotIn(self.lock_path, pbtools.owned_locks)
+        self.assertEqual(pbtools.read_lock(self.lock_path)["owner"], "daemon")
+
+    def test_released_lock_is_acquired(self):
+        self.write_lock(os.getppid(), "daemon")
+        read_lock = pbtools.read_lock
+
+        def release_and_read(path):
+            # the holder finishes between the failed create and the read
+            os.remove(path)
+            return read_lock(path)
+
+        with mock.patch.object(pbtools, "read_lock", side_effect=release_and_read):
+            self.assertTrue(pbtools.acquire_lock("sync", path=self.lock_path))
+        self.assertEqual(pbtools.read_lock(self.lock_path)["pid"], os.getpid())
+
+
+if __name__ == "__main__":
+    unittest.main()
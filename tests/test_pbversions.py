@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+# pbtools is imported first, like PBSync does, since the modules import each other
+from pbpy import pbtools
+from pbpy import pbconfig
+from pbpy import pbgit
+from pbpy import pbbucket
+from pbpy import pbversions
+
+
+class VersionIndexTest(unittest.TestCase):
+    # The bucket is a local directory, like a mirror set with [ue4v-user] bucket
+
+    def setUp(self):
+        self.bucket_dir = tempfile.mkdtemp(prefix="pbsync_bucket")
+        self.git_dir = tempfile.mkdtemp(prefix="pbsync_git")
+        self.addCleanup(shutil.rmtree, self.bucket_dir, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, self.git_dir, ignore_errors=True)
+
+        self.config = {"is_ci": False, "engine_base_version": "4.27"}
+        self.user_config = pbconfig.CustomConfigParser()
+        patches = [
+            mock.patch.object(pbconfig, "config", self.config),
+            mock.patch.object(pbconfig, "user_config", self.user_config),
+            mock.patch.object(pbgit, "get_git_dir", return_value=self.git_dir)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.add_objects(
+            "editor-4.27-PB-20230101.7z",
+            "editor-4.27-PB-20230101.manifest.json",
+            "editor-4.27-PB-20221231.7z",
+            "editor-4.27-PB-20230115.7z",
+            "editor-symbols-4.27-PB-20230120.7z",
+            "editor-4.26-PB-20230125.7z",
+            "editor-4.27-PB-2023013.7z",
+            "ciengine-4.27-PB-20230130.7z"
+        )
+
+    def add_objects(self, *names):
+        for name in names:
+            open(os.path.join(self.bucket_dir, name), "w").close()
+
+    def test_parse_version(self):
+        self.assertEqual(pbversions.parse_version("4.27-PB-20230101"), (4, 27, 20230101))
+        self.assertLess(pbversions.parse_version("4.9-PB-20230101"), pbversions.parse_version("4.27-PB-20220101"))
+
+    def test_versions_of_bundle_and_base_version(self):
+        versions = pbversions.get_versions(self.bucket_dir, "editor")
+        self.assertEqual(versions, ["4.27-PB-20221231", "4.27-PB-20230101", "4.27-PB-20230115"])
+        self.assertEqual(pbversions.get_versions(self.bucket_dir, "editor-symbols"), ["4.27-PB-20230120"])
+        self.assertEqual(pbversions.get_versions(self.bucket_dir, "ciengine"), ["4.27-PB-20230130"])
+
+    def test_latest(self):
+        self.assertEqual(pbversions.get_latest(self.bucket_dir, "editor"), "4.27-PB-20230115")
+        self.assertIsNone(pbversions.get_latest(self.bucket_dir, "missing"))
+
+    def test_previous(self):
+        self.assertEqual(pbversions.get_previous(self.bucket_dir, "editor", "4.27-PB-20230115"), ["4.27-PB-20230101"])
+        self.assertEqual(pbversions.get_previous(self.bucket_dir, "editor", "4.27-PB-20230115", count=5), ["4.27-PB-20230101", "4.27-PB-20221231"])
+        # the version itself doesn't have to be published
+        self.assertEqual(pbversions.get_previous(self.bucket_dir, "editor", "4.27-PB-20230110", count=2), ["4.27-PB-20230101", "4.27-PB-20221231"])
+        self.assertEqual(pbversions.get_previous(self.bucket_dir, "editor", "4.27-PB-20221231"), [])
+
+    def test_exists(self):
+        self.assertTrue(pbversions.exists(self.bucket_dir, "editor", "4.27-PB-20230101"))
+        self.assertFalse(pbversions.exists(self.bucket_dir, "editor", "4.27-PB-20230120"))
+        self.assertIsNone(pbversions.exists(os.path.join(self.bucket_dir, "missing"), "editor", "4.27-PB-20230101"))
+
+    def test_cached_listing(self):
+        with mock.patch.object(pbbucket, "list_objects", wraps=pbbucket.list_objects) as list_objects:
+            pbversions.get_latest(self.bucket_dir, "editor")
+            pbversions.get_previous(self.bucket_dir, "editor", "4.27-PB-20230115")
+            pbversions.exists(self.bucket_dir, "editor", "4.27-PB-20230101")
+            self.assertEqual(list_objects.call_count, 1)
+        self.assertTrue(os.path.isfile(os.path.join(self.git_dir, pbversions.version_cache_name)))
+
+    def test_listing_token_change(self):
+        self.assertEqual(pbversions.get_latest(self.bucket_dir, "editor"), "4.27-PB-20230115")
+        self.add_objects("editor-4.27-PB-20230201.7z")
+        # make sure the token changes, even with a coarse modification time
+        stat = os.stat(self.bucket_dir)
+        os.utime(self.bucket_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000 * 1000 * 1000))
+        self.assertEqual(pbversions.get_latest(self.bucket_dir, "editor"), "4.27-PB-20230201")
+
+    def test_published_after_listing(self):
+        # buckets without a listing token, like gs:// ones, only notice new versions after the cache expires
+        with mock.patch.object(pbbucket, "get_listing_token", return_value=None):
+            self.assertEqual(pbversions.get_latest(self.bucket_dir, "editor"), "4.27-PB-20230115")
+            self.add_objects("editor-4.27-PB-20230201.7z")
+            self.assertEqual(pbversions.get_latest(self.bucket_dir, "editor"), "4.27-PB-20230115")
+            self.assertEqual(pbversions.get_latest(self.bucket_dir, "editor", refresh=True), "4.27-PB-20230201")
+            self.add_objects("editor-4.27-PB-20230202.7z")
+            # a version which isn't in the cached listing is looked up again
+            self.assertTrue(pbversions.exists(self.bucket_dir, "editor", "4.27-PB-20230202"))
+            self.assertEqual(pbversions.get_latest(self.bucket_dir, "editor"), "4.27-PB-20230202")
+
+    def test_cache_expiry(self):
+        self.user_config["ue4v-user"]["version_cache_minutes"] = "0"
+        with mock.patch.object(pbbucket, "list_objects", wraps=pbbucket.list_objects) as list_objects:
+            pbversions.get_latest(self.bucket_dir, "editor")
+            pbversions.get_latest(self.bucket_dir, "editor")
+            self.assertEqual(list_objects.call_count, 2)
+
+    def test_ci_uses_cache(self):
+        # pipelines don't list the bucket every run, but a new version is found once the listing token changes
+        self.config["is_ci"] = True
+        with mock.patch.object(pbbucket, "list_objects", wraps=pbbucket.list_objects) as list_objects:
+            self.assertEqual(pbversions.get_latest(self.bucket_dir, "ciengine"), "4.27-PB-20230130")
+            self.assertEqual(pbversions.get_latest(self.bucket_dir, "ciengine"), "4.27-PB-20230130")
+            self.assertEqual(list_objects.call_count, 1)
+            self.add_objects("ciengine-4.27-PB-20230201.7z")
+            stat = os.stat(self.bucket_dir)
+            os.utime(self.bucket_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000 * 1000 * 1000))
+            self.assertEqual(pbversions.get_latest(self.bucket_dir, "ciengine"), "4.27-PB-20230201")
+            self.assertEqual(list_objects.call_count, 2)
+
+if __name__ == "__main__":
+    unittest.main()